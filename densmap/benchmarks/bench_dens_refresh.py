@@ -0,0 +1,73 @@
+"""Speed vs. density preservation of densMAP for different ``dens_refresh``
+intervals (the number of epochs between recomputations of the density
+statistics of the embedding).
+
+For every data set and interval the full fit is timed and the Pearson
+correlation between the original (``ro``) and embedded (``re``) log local
+radii is reported. The data sets are the bundled trial data and Gaussian
+mixtures with clusters of different spread.
+
+    python bench_dens_refresh.py -r 1 2 5 10 -n 20000 100000
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--refresh', type=int, nargs='+', default=[1, 2, 5, 10])
+    parser.add_argument('-n', '--n-points', type=int, nargs='*', default=[20000, 100000],
+                        help='Sizes of the synthetic data sets (default: %(default)s)')
+    parser.add_argument('-f', '--n-features', type=int, default=20)
+    parser.add_argument('-e', '--n-epochs', type=int, default=750)
+    parser.add_argument('-s', '--seed', type=int, default=42)
+    parser.add_argument('--no-trial', action='store_true',
+                        help='Skip the bundled trial data set')
+    return parser
+
+
+def mixture(n_points, n_features, seed):
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(scale=10.0, size=(6, n_features))
+    labels = rng.randint(0, centers.shape[0], n_points)
+    scales = np.linspace(0.5, 3.0, centers.shape[0])[labels]
+    return (centers[labels] + scales[:, None] *
+            rng.normal(size=(n_points, n_features))).astype(np.float32)
+
+
+def main():
+    args = parse_args().parse_args()
+
+    from densmap import densMAP
+
+    datasets = []
+    if not args.no_trial:
+        from densmap.load_trial import load_trial
+        datasets.append(('trial', load_trial().astype(np.float32)))
+    for n in args.n_points:
+        datasets.append(('mixture-%d' % n, mixture(n, args.n_features, args.seed)))
+
+    # compile the kernels before timing anything
+    densMAP(n_epochs=20, random_state=args.seed).fit_transform(
+        mixture(500, args.n_features, args.seed))
+
+    for name, X in datasets:
+        for refresh in args.refresh:
+            start = time.time()
+            emb, ro, re = densMAP(n_epochs=args.n_epochs, dens_refresh=refresh,
+                                  random_state=args.seed).fit_transform(X)
+            elapsed = time.time() - start
+            print(json.dumps({
+                'data': name,
+                'n_points': X.shape[0],
+                'dens_refresh': refresh,
+                'seconds': round(elapsed, 2),
+                'corr_ro_re': round(float(np.corrcoef(ro, re)[0, 1]), 4),
+            }), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Time taken by the nearest neighbor search of the final density pass of
+fit (``final_dens=True``), on clustered two and three dimensional points
+like those of an embedding: the exact grid search against the nearest
+neighbor descent it replaces, with the recall of the latter. ``--outliers``
+moves that many points far away from the others, as detached points of an
+embedding are.
+
+    python bench_embedding_knn.py -n 100000 1000000 -d 2 3 --outliers 0 1 100
+"""
+import argparse
+import itertools
+import json
+import time
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-points', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('-d', '--n-components', type=int, nargs='+', default=[2, 3])
+    parser.add_argument('-k', '--n-nei', type=int, default=30)
+    parser.add_argument('--n-queries', type=int, default=2000,
+                        help='Number of points to measure the recall on '
+                             '(default: %(default)s)')
+    parser.add_argument('--outliers', type=int, nargs='+', default=[0])
+    return parser
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, round(time.perf_counter() - start, 2)
+
+
+def main():
+    args = parse_args().parse_args()
+
+    from sklearn.datasets import make_blobs
+    from sklearn.utils import check_random_state
+    from densmap.densmap_ import nearest_neighbors
+    from densmap.exact_knn import exact_nearest_neighbors
+
+    for n_components in args.n_components:
+        for n_points, n_outliers in itertools.product(args.n_points, args.outliers):
+            X, _ = make_blobs(n_points, n_components, centers=20, random_state=0)
+            X[n_points - n_outliers:] = np.random.RandomState(1).uniform(
+                -1e4, 1e4, size=(n_outliers, n_components))
+            X = X.astype(np.float32)
+            # compile the kernels first
+            nearest_neighbors(X[:500], args.n_nei, 'euclidean', {}, False,
+                              check_random_state(0))
+            exact_nearest_neighbors(X[:500], args.n_nei)
+
+            (grid_indices, _), grid_seconds = timed(
+                lambda: exact_nearest_neighbors(X, args.n_nei))
+            (nnd_indices, _, _), nnd_seconds = timed(lambda: nearest_neighbors(
+                X, args.n_nei, 'euclidean', {}, False, check_random_state(0)))
+            recall = np.mean([len(np.intersect1d(a, b)) for a, b in zip(
+                grid_indices[:args.n_queries], nnd_indices[:args.n_queries])])
+            print(json.dumps({
+                'n_points': n_points, 'n_components': n_components,
+                'n_outliers': n_outliers,
+                'grid_seconds': grid_seconds, 'nndescent_seconds': nnd_seconds,
+                'nndescent_recall': round(recall / args.n_nei, 4),
+            }), flush=True)
+
+
+if __name__ == '__main__':
+    main()
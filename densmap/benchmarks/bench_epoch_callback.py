@@ -0,0 +1,71 @@
+"""Overhead of the epoch callback and of the embedding snapshots on the
+embedding optimization of fit, against a run without either.
+
+The optimization time is read from the ``profile_`` of the model, and each
+configuration is fitted on the same data with the same random state.
+
+    python bench_epoch_callback.py -n 100000 --every 10
+"""
+import argparse
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-points', type=int, default=100000)
+    parser.add_argument('-f', '--n-features', type=int, default=20)
+    parser.add_argument('-e', '--n-epochs', type=int, default=200)
+    parser.add_argument('--every', type=int, default=10,
+                        help='Epochs between callbacks and between snapshots '
+                             '(default: %(default)s)')
+    parser.add_argument('--repeats', type=int, default=3)
+    return parser
+
+
+def optimization_seconds(model):
+    return sum(stage['seconds'] for stage in model.profile_.stages
+               if stage['name'].startswith('optimize_layout'))
+
+
+def main():
+    args = parse_args().parse_args()
+
+    from sklearn.datasets import make_blobs
+    from densmap import densMAP
+
+    X, _ = make_blobs(args.n_points, args.n_features, centers=10, random_state=0)
+    X = X.astype(np.float32)
+    snapshot_path = os.path.join(tempfile.mkdtemp(), 'snapshots.npy')
+    configs = {
+        'none': {},
+        'callback': {'epoch_callback': lambda epoch, elapsed, embedding, corr: False},
+        'snapshots': {'snapshot_path': snapshot_path},
+        'both': {'epoch_callback': lambda epoch, elapsed, embedding, corr: False,
+                 'snapshot_path': snapshot_path},
+    }
+
+    # compile the kernels first
+    densMAP(n_epochs=11, random_state=0, **configs['both']).fit(X[:2000])
+
+    seconds = {name: [] for name in configs}
+    for _ in range(args.repeats):
+        for name, config in configs.items():
+            model = densMAP(n_epochs=args.n_epochs, random_state=0,
+                            callback_every=args.every, snapshot_every=args.every,
+                            final_dens=False, **config).fit(X)
+            seconds[name].append(optimization_seconds(model))
+
+    base = min(seconds['none'])
+    result = {'n_points': args.n_points, 'n_epochs': args.n_epochs, 'every': args.every}
+    for name in configs:
+        result[name + '_seconds'] = round(min(seconds[name]), 2)
+        result[name + '_overhead_percent'] = round(100 * (min(seconds[name]) / base - 1), 2)
+    print(json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Time and peak memory of the exact k-nearest neighbor search used for small
+data sets, against the full pairwise distance matrix it replaces and against
+the approximate nearest neighbor descent used for large data sets.
+
+    python bench_exact_knn.py -n 4000 16000 64000 -m euclidean manhattan
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-points', type=int, nargs='+', default=[4000, 16000, 64000])
+    parser.add_argument('-f', '--n-features', type=int, default=50)
+    parser.add_argument('-k', '--n-nei', type=int, default=30)
+    parser.add_argument('-m', '--metrics', nargs='+', default=['euclidean', 'manhattan'])
+    parser.add_argument('--max-dense', type=int, default=20000,
+                        help='Largest data set to compute the full distance matrix of '
+                             '(default: %(default)s)')
+    return parser
+
+
+def measure(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, round(seconds, 2), peak // 2 ** 20
+
+
+def main():
+    args = parse_args().parse_args()
+
+    from sklearn.metrics import pairwise_distances
+    from sklearn.utils import check_random_state
+    from densmap.densmap_ import nearest_neighbors
+    from densmap.exact_knn import exact_nearest_neighbors
+
+    for metric in args.metrics:
+        # compile the kernels first
+        small = np.random.RandomState(1).normal(size=(500, args.n_features)).astype(np.float32)
+        exact_nearest_neighbors(small, args.n_nei, metric)
+        nearest_neighbors(small, args.n_nei, metric, {}, False, check_random_state(0))
+
+        for n_points in args.n_points:
+            X = np.random.RandomState(0).normal(
+                size=(n_points, args.n_features)).astype(np.float32)
+            (indices, _), seconds, peak_mb = measure(
+                lambda: exact_nearest_neighbors(X, args.n_nei, metric))
+            result = {'metric': metric, 'n_points': n_points,
+                      'exact_seconds': seconds, 'exact_peak_mb': peak_mb}
+
+            if n_points <= args.max_dense:
+                _, seconds, peak_mb = measure(
+                    lambda: pairwise_distances(X, metric=metric).argsort(axis=1)[:, :args.n_nei])
+                result.update({'dense_seconds': seconds, 'dense_peak_mb': peak_mb})
+
+            (nnd_indices, _, _), seconds, peak_mb = measure(
+                lambda: nearest_neighbors(X, args.n_nei, metric, {}, False,
+                                          check_random_state(0)))
+            recall = np.mean([len(np.intersect1d(a, b)) for a, b in zip(indices, nnd_indices)])
+            result.update({'nndescent_seconds': seconds, 'nndescent_peak_mb': peak_mb,
+                           'nndescent_recall': round(recall / args.n_nei, 4)})
+            print(json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Speed of the nearest neighbor searches of fit and transform with the
+cheaper alternative distances of the euclidean and cosine metrics, against
+the same searches with the full distances, on high dimensional data.
+
+Passing the distance function itself as the metric bypasses the
+alternatives, so both are timed in the same process.
+
+    python bench_fast_distances.py -n 100000 -f 500 1000 -m euclidean cosine
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-points', type=int, default=100000)
+    parser.add_argument('-f', '--n-features', type=int, nargs='+', default=[500, 1000])
+    parser.add_argument('-k', '--n-nei', type=int, default=30)
+    parser.add_argument('-q', '--n-queries', type=int, default=2000)
+    parser.add_argument('-m', '--metrics', nargs='+', default=['euclidean', 'cosine'])
+    return parser
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, round(time.perf_counter() - start, 2)
+
+
+def main():
+    args = parse_args().parse_args()
+
+    from sklearn.utils import check_random_state
+    import densmap.distances as dist
+    from densmap import densMAP
+    from densmap.densmap_ import nearest_neighbors
+
+    for n_features in args.n_features:
+        X = np.random.RandomState(0).normal(
+            size=(args.n_points, n_features)).astype(np.float32)
+        queries = np.random.RandomState(1).normal(
+            size=(args.n_queries, n_features)).astype(np.float32)
+
+        for metric in args.metrics:
+            angular = metric == 'cosine'
+            result = {'n_points': args.n_points, 'n_features': n_features, 'metric': metric}
+            for name, metric_arg in (('fast', metric), ('full', dist.named_distances[metric])):
+                # compile the kernels first
+                nearest_neighbors(X[:500], args.n_nei, metric_arg, {}, angular,
+                                  check_random_state(0))
+                _, seconds = timed(lambda: nearest_neighbors(
+                    X, args.n_nei, metric_arg, {}, angular, check_random_state(0)))
+                result[name + '_nn_seconds'] = seconds
+
+                model = densMAP(n_neighbors=args.n_nei, metric=metric_arg, n_epochs=11,
+                                init='random', random_state=0, exact_knn_threshold=0,
+                                angular_rp_forest=angular).fit(X)
+                model.transform(queries[:10])
+                _, seconds = timed(lambda: model.transform(queries))
+                result[name + '_transform_seconds'] = seconds
+            result['nn_speedup'] = round(result['full_nn_seconds'] / result['fast_nn_seconds'], 2)
+            print(json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Peak memory of building the fuzzy graph and the layout optimization
+state, with the compact (32-bit) and the full (64-bit) graph representation.
+
+A synthetic k-neighbor graph (random neighbors, sorted random distances) is
+used so that only the graph pipeline is measured. Each mode runs in a fresh
+process and reports its peak resident set size, along with the bytes held by
+the graph and by the per-edge optimization state.
+
+    python bench_graph_memory.py -n 1000000 -k 30
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-points', type=int, default=1000000)
+    parser.add_argument('-k', '--n-nei', type=int, default=30)
+    parser.add_argument('-e', '--n-epochs', type=int, default=200)
+    parser.add_argument('--worker', choices=['compact', 'full'], help=argparse.SUPPRESS)
+    return parser
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_worker(args):
+    from densmap.densmap_ import fuzzy_simplicial_set, make_epochs_per_sample
+
+    rng = np.random.RandomState(42)
+    n, k = args.n_points, args.n_nei
+    knn_indices = rng.randint(0, n, size=(n, k)).astype(np.int64)
+    knn_indices[:, 0] = np.arange(n)
+    knn_dists = np.sort(rng.exponential(size=(n, k)).astype(np.float32), axis=1)
+    knn_dists[:, 0] = 0.0
+    baseline = peak_rss_mb()
+
+    graph = fuzzy_simplicial_set(
+        np.empty((n, 1), dtype=np.float32), k, rng, 'euclidean', {},
+        knn_indices, knn_dists, compact=args.worker == 'compact').tocoo()
+    del knn_indices, knn_dists
+    # prune the weakest edges as simplicial_set_embedding does
+    graph.data[graph.data < (graph.data.max() / float(args.n_epochs))] = 0.0
+    graph.eliminate_zeros()
+    graph_mb = (graph.row.nbytes + graph.col.nbytes + graph.data.nbytes) / 2.0 ** 20
+    epochs_per_sample = make_epochs_per_sample(graph.data, args.n_epochs)
+    # epochs_per_negative_sample, epoch_of_next_sample and
+    # epoch_of_next_negative_sample in optimize_layout
+    state = [epochs_per_sample / 5.0, epochs_per_sample.copy(),
+             epochs_per_sample / 5.0]
+    state_mb = (epochs_per_sample.nbytes + sum(s.nbytes for s in state)) / 2.0 ** 20
+
+    print(json.dumps({
+        'mode': args.worker,
+        'n_edges': int(graph.nnz),
+        'index_dtype': str(graph.row.dtype),
+        'weight_dtype': str(graph.data.dtype),
+        'graph_mb': round(graph_mb, 1),
+        'sgd_state_mb': round(state_mb, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'peak_rss_above_knn_mb': round(peak_rss_mb() - baseline, 1),
+    }), flush=True)
+
+
+def main():
+    args = parse_args().parse_args()
+    if args.worker:
+        run_worker(args)
+        return
+    for mode in ['full', 'compact']:
+        subprocess.check_call([sys.executable, __file__, '-n', str(args.n_points),
+                               '-k', str(args.n_nei), '-e', str(args.n_epochs),
+                               '--worker', mode])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Peak memory and throughput of the nearest neighbor descent, which are
+driven by the layout of its neighbor heaps.
+
+Each search runs in a fresh process, after compiling the kernels on a small
+data set. The peak RSS reached during the search, above the RSS before it
+(Linux only), and the number of points processed per second are reported.
+Run it on two checkouts to compare heap layouts.
+
+    python bench_heap_memory.py -n 1000000 -f 50 -j 1 -1
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-points', type=int, default=1000000)
+    parser.add_argument('-f', '--n-features', type=int, default=50)
+    parser.add_argument('-k', '--n-nei', type=int, default=30)
+    parser.add_argument('-j', '--n-jobs', type=int, nargs='+', default=[1, -1],
+                        help='Values of n_jobs to run; 1 is the serial kernel '
+                             '(default: %(default)s)')
+    parser.add_argument('--run', type=int, default=None, help=argparse.SUPPRESS)
+    return parser
+
+
+def proc_status_mb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) // 1024
+
+
+def search(args):
+    from sklearn.utils import check_random_state
+    from densmap.densmap_ import nearest_neighbors
+    from densmap.utils import make_heap
+
+    X = np.random.RandomState(0).normal(
+        size=(args.n_points, args.n_features)).astype(np.float32)
+    # compile the kernels first
+    nearest_neighbors(X[:500], args.n_nei, 'euclidean', {}, False,
+                      check_random_state(0), n_jobs=args.run)
+
+    heap = make_heap(args.n_points, args.n_nei)
+    if isinstance(heap, tuple):
+        heap_mb = sum(part.nbytes for part in heap) / 2 ** 20
+    else:
+        heap_mb = heap.nbytes / 2 ** 20
+    del heap
+
+    rss_before = proc_status_mb('VmRSS')
+    start = time.perf_counter()
+    nearest_neighbors(X, args.n_nei, 'euclidean', {}, False,
+                      check_random_state(0), n_jobs=args.run)
+    seconds = time.perf_counter() - start
+
+    print(json.dumps({
+        'n_points': args.n_points, 'n_features': args.n_features, 'n_jobs': args.run,
+        'seconds': round(seconds, 2),
+        'points_per_second': int(args.n_points / seconds),
+        'graph_heap_mb': round(heap_mb, 1),
+        # VmHWM, unlike ru_maxrss, is not inherited from the parent process
+        'search_peak_mb': proc_status_mb('VmHWM') - rss_before,
+    }), flush=True)
+
+
+def main():
+    args = parse_args().parse_args()
+    if args.run is not None:
+        search(args)
+        return
+
+    for n_jobs in args.n_jobs:
+        subprocess.check_call([
+            sys.executable, __file__, '-n', str(args.n_points), '-f', str(args.n_features),
+            '-k', str(args.n_nei), '--run', str(n_jobs),
+        ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Wall-clock time and recall of the serial nearest neighbor descent against
+the parallel one, for several values of n_jobs. The recall is measured
+against the exact nearest neighbors of a random sample of the points.
+
+    NUMBA_NUM_THREADS=16 python bench_nndescent.py -n 1000000 -f 50 -j 1 4 16
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-points', type=int, default=1000000)
+    parser.add_argument('-f', '--n-features', type=int, default=50)
+    parser.add_argument('-k', '--n-nei', type=int, default=30)
+    parser.add_argument('-m', '--metric', default='euclidean')
+    parser.add_argument('-j', '--n-jobs', type=int, nargs='+', default=[1, -1],
+                        help='Values of n_jobs to run; 1 is the serial kernel '
+                             '(default: %(default)s)')
+    parser.add_argument('--n-queries', type=int, default=1000,
+                        help='Number of points to measure the recall on '
+                             '(default: %(default)s)')
+    return parser
+
+
+def main():
+    args = parse_args().parse_args()
+
+    import numba
+    from sklearn.utils import check_random_state
+    from densmap.densmap_ import nearest_neighbors
+    from densmap.exact_knn import exact_nearest_neighbors
+
+    X = np.random.RandomState(0).normal(
+        size=(args.n_points, args.n_features)).astype(np.float32)
+    sample = np.random.RandomState(1).choice(
+        args.n_points, min(args.n_queries, args.n_points), replace=False)
+    true_indices, _ = exact_nearest_neighbors(
+        X, args.n_nei, args.metric, query=X[sample])
+
+    for n_jobs in args.n_jobs:
+        # compile the kernels first
+        nearest_neighbors(X[:500], args.n_nei, args.metric, {}, False,
+                          check_random_state(0), n_jobs=n_jobs)
+
+        start = time.perf_counter()
+        indices, _, _ = nearest_neighbors(X, args.n_nei, args.metric, {}, False,
+                                          check_random_state(0), n_jobs=n_jobs)
+        seconds = time.perf_counter() - start
+        recall = np.mean([len(np.intersect1d(a, b))
+                          for a, b in zip(true_indices, indices[sample])])
+        print(json.dumps({
+            'n_points': args.n_points, 'n_features': args.n_features,
+            'n_jobs': n_jobs, 'n_threads': numba.config.NUMBA_NUM_THREADS,
+            'seconds': round(seconds, 2), 'recall': round(recall / args.n_nei, 4),
+        }), flush=True)
+
+
+if __name__ == '__main__':
+    main()
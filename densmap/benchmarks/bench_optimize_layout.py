@@ -0,0 +1,116 @@
+"""Epoch throughput of densMAP's layout optimization at different thread
+counts.
+
+A k-neighbor fuzzy graph is built once for a synthetic Gaussian mixture and
+cached to disk; every thread count is then timed in a fresh process (numba
+fixes its thread pool size at start-up through NUMBA_NUM_THREADS).
+
+    python bench_optimize_layout.py -n 1000000 -t 8 16 32
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-points', type=int, default=1000000)
+    parser.add_argument('-k', '--n-nei', type=int, default=30)
+    parser.add_argument('-f', '--n-features', type=int, default=20)
+    parser.add_argument('-e', '--n-epochs', type=int, default=20,
+                        help='Epochs timed per phase (default: %(default)s)')
+    parser.add_argument('-t', '--threads', type=int, nargs='+', default=[8, 16, 32])
+    parser.add_argument('-g', '--graph', default='bench_graph.npz',
+                        help='Cache file for the fuzzy graph (default: %(default)s)')
+    parser.add_argument('--deterministic', action='store_true',
+                        help='Also time the single-threaded deterministic mode')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    return parser
+
+
+def build_graph(args):
+    import scipy.sparse
+    from densmap.densmap_ import nearest_neighbors, fuzzy_simplicial_set
+
+    rng = np.random.RandomState(42)
+    centers = rng.normal(scale=10.0, size=(6, args.n_features))
+    labels = rng.randint(0, centers.shape[0], args.n_points)
+    scales = np.linspace(0.5, 3.0, centers.shape[0])[labels]
+    X = (centers[labels] + scales[:, None] *
+         rng.normal(size=(args.n_points, args.n_features))).astype(np.float32)
+
+    knn_indices, knn_dists, _ = nearest_neighbors(
+        X, args.n_nei, 'euclidean', {}, False, rng)
+    graph = fuzzy_simplicial_set(
+        X, args.n_nei, rng, 'euclidean', {}, knn_indices, knn_dists).tocoo()
+    graph.sum_duplicates()
+    init = rng.uniform(-10, 10, size=(args.n_points, 2)).astype(np.float32)
+    np.savez(args.graph, row=graph.row, col=graph.col, data=graph.data,
+             shape=graph.shape, init=init)
+
+
+def run_worker(args):
+    import scipy.sparse
+    from densmap.densmap_ import optimize_layout, make_epochs_per_sample
+
+    f = np.load(args.graph)
+    graph = scipy.sparse.coo_matrix((f['data'], (f['row'], f['col'])),
+                                    shape=tuple(f['shape']))
+    n_vertices = graph.shape[0]
+    n_epochs = 200
+    graph.data[graph.data < (graph.data.max() / float(n_epochs))] = 0.0
+    graph.eliminate_zeros()
+    epochs_per_sample = make_epochs_per_sample(graph.data, n_epochs)
+    mu_sum = np.asarray(graph.sum(axis=0)).ravel() * 2
+    R = np.random.RandomState(0).normal(size=n_vertices).astype(np.float32)
+    rng_state = np.array([12345, 67890, 13579], dtype=np.int64)
+
+    def timed(epochs, dens_frac):
+        embedding = f['init'].copy()
+        start = time.time()
+        optimize_layout(embedding, embedding, graph.row, graph.col, graph.data,
+                        mu_sum, R, epochs, n_vertices, epochs_per_sample,
+                        1.577, 0.895, rng_state.copy(), dens_frac=dens_frac,
+                        dens_lambda=2.0, deterministic=args.deterministic)
+        return time.time() - start
+
+    # compile everything before timing
+    timed(2, 1.0)
+
+    result = {'threads': int(os.environ.get('NUMBA_NUM_THREADS', 0)),
+              'deterministic': args.deterministic,
+              'n_vertices': n_vertices, 'n_edges': int(graph.nnz)}
+    for phase, dens_frac in (('umap', 0.0), ('dens', 1.0)):
+        result[phase + '_epochs_per_sec'] = args.n_epochs / timed(args.n_epochs, dens_frac)
+    print(json.dumps(result))
+
+
+def main(args):
+    if args.worker:
+        run_worker(args)
+        return
+
+    if not os.path.exists(args.graph):
+        print('Building graph for', args.n_points, 'points')
+        build_graph(args)
+
+    runs = [(t, False) for t in args.threads]
+    if args.deterministic:
+        runs = [(1, True)] + runs
+
+    base = [a for a in sys.argv[1:] if a != '--deterministic']
+    for threads, deterministic in runs:
+        env = dict(os.environ, NUMBA_NUM_THREADS=str(threads))
+        cmd = [sys.executable, __file__, '--worker'] + base
+        if deterministic:
+            cmd.append('--deterministic')
+        subprocess.check_call(cmd, env=env)
+
+
+if __name__ == '__main__':
+    main(parse_args().parse_args())
@@ -0,0 +1,106 @@
+"""Time to bring a fitted densMAP model back into a serving process.
+
+A model is fit on a synthetic Gaussian mixture, written both with
+densMAP.save and with pickle, and each copy is then loaded in a fresh
+process which answers one transform of a single point. The load time, the
+first transform latency (which includes compiling the search functions) and
+the peak RSS of the process (Linux only) are reported.
+
+    python bench_persistence.py -n 1000000 --dir /tmp/densmap_models
+"""
+import argparse
+import json
+import os
+import pickle
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-points', type=int, default=1000000)
+    parser.add_argument('-f', '--n-features', type=int, default=50)
+    parser.add_argument('-k', '--n-nei', type=int, default=30)
+    parser.add_argument('-e', '--n-epochs', type=int, default=50)
+    parser.add_argument('--dir', default='densmap_models',
+                        help='Directory in which to save the models (default: %(default)s)')
+    parser.add_argument('--load', choices=['mmap', 'memory', 'pickle'], default=None,
+                        help=argparse.SUPPRESS)
+    return parser
+
+
+def mixture(n_points, n_features, rng):
+    centers = np.random.RandomState(42).normal(scale=10.0, size=(6, n_features))
+    labels = rng.randint(0, centers.shape[0], n_points)
+    scales = np.linspace(0.5, 3.0, centers.shape[0])[labels]
+    return (centers[labels] + scales[:, None] *
+            rng.normal(size=(n_points, n_features))).astype(np.float32)
+
+
+def peak_rss_mb():
+    # VmHWM, unlike ru_maxrss, is not inherited from the parent process
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) // 1024
+
+
+def load_and_query(args):
+    from densmap import densMAP
+
+    start = time.perf_counter()
+    if args.load == 'pickle':
+        with open(os.path.join(args.dir, 'model.pkl'), 'rb') as f:
+            model = pickle.load(f)
+    else:
+        model = densMAP.load(os.path.join(args.dir, 'model'), mmap=args.load == 'mmap')
+    load_seconds = time.perf_counter() - start
+
+    query = mixture(1, args.n_features, np.random.RandomState(1))
+    start = time.perf_counter()
+    model.transform(query)
+    first_transform_seconds = time.perf_counter() - start
+
+    print(json.dumps({
+        'load': args.load,
+        'load_seconds': round(load_seconds, 3),
+        'first_transform_seconds': round(first_transform_seconds, 3),
+        'peak_rss_mb': peak_rss_mb(),
+    }), flush=True)
+
+
+def main():
+    args = parse_args().parse_args()
+    if args.load is not None:
+        load_and_query(args)
+        return
+
+    from densmap import densMAP
+
+    X = mixture(args.n_points, args.n_features, np.random.RandomState(0))
+    model = densMAP(n_neighbors=args.n_nei, n_epochs=args.n_epochs, random_state=42,
+                    final_dens=False).fit(X)
+
+    if not os.path.isdir(args.dir):
+        os.makedirs(args.dir)
+    start = time.perf_counter()
+    model.save(os.path.join(args.dir, 'model'))
+    save_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    with open(os.path.join(args.dir, 'model.pkl'), 'wb') as f:
+        pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+    pickle_seconds = time.perf_counter() - start
+    print(json.dumps({'n_points': args.n_points,
+                      'save_seconds': round(save_seconds, 2),
+                      'pickle_seconds': round(pickle_seconds, 2)}), flush=True)
+
+    for load in ['mmap', 'memory', 'pickle']:
+        subprocess.check_call([sys.executable, __file__, '--dir', args.dir,
+                               '-f', str(args.n_features), '--load', load])
+
+
+if __name__ == '__main__':
+    main()
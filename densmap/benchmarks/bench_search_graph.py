@@ -0,0 +1,70 @@
+"""Time taken by fit to build the symmetrized k-nearest neighbor graph that
+``transform`` searches, against the construction through Python lists and
+scipy that it replaces. The neighbors are random, as only their number
+matters here.
+
+    python bench_search_graph.py -n 100000 1000000 -k 15 30
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-points', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('-k', '--n-nei', type=int, nargs='+', default=[15, 30])
+    parser.add_argument('--skip-lists', action='store_true',
+                        help='Do not time the list-based construction, which is slow '
+                             'on large inputs')
+    return parser
+
+
+def list_search_graph(knn_indices, knn_dists):
+    import scipy.sparse
+
+    knn_data = (knn_dists != 0).astype(np.int8)
+    indices = []
+    indptr = [0]
+    data = []
+    for i, row in enumerate(knn_indices):
+        indices += list(row)
+        indptr += [indptr[-1] + len(row)]
+        data += list(knn_data[i])
+    graph = scipy.sparse.csr_matrix((data, indices, indptr))
+    return graph.maximum(graph.transpose())
+
+
+def main():
+    args = parse_args().parse_args()
+
+    from densmap.densmap_ import search_graph_csr
+
+    # compile the kernel first
+    search_graph_csr(np.zeros((2, 1), dtype=np.int32), np.ones((2, 1), dtype=np.float32))
+
+    for n_points in args.n_points:
+        for n_nei in args.n_nei:
+            rng = np.random.RandomState(0)
+            knn_indices = rng.randint(0, n_points, (n_points, n_nei)).astype(np.int32)
+            knn_indices[:, 0] = np.arange(n_points)
+            knn_dists = rng.uniform(size=(n_points, n_nei)).astype(np.float32)
+            knn_dists[:, 0] = 0
+
+            result = {'n_points': n_points, 'n_nei': n_nei}
+            start = time.perf_counter()
+            indptr, _ = search_graph_csr(knn_indices, knn_dists)
+            result['csr_seconds'] = round(time.perf_counter() - start, 3)
+            result['n_edges'] = int(indptr[-1])
+            if not args.skip_lists:
+                start = time.perf_counter()
+                list_search_graph(knn_indices, knn_dists)
+                result['lists_seconds'] = round(time.perf_counter() - start, 3)
+                result['speedup'] = round(result['lists_seconds'] / result['csr_seconds'], 1)
+            print(json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    main()
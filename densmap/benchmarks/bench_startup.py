@@ -0,0 +1,77 @@
+"""Start-up cost of densMAP: the time of the first fits in a fresh process,
+with a cold and with a warm on-disk cache of compiled kernels.
+
+Each run is a new Python process which imports densmap and fits the same
+data twice. The first run uses an empty numba cache directory ("cold"), the
+second one the cache the first run filled ("warm"). The second fit of each
+process shows what is left once the metric-specialised functions (nearest
+neighbor descent, from 4096 points up) are memoized in the process.
+
+    python bench_startup.py -n 1000 5000
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-points', type=int, nargs='+', default=[1000])
+    parser.add_argument('-f', '--n-features', type=int, default=20)
+    parser.add_argument('-e', '--n-epochs', type=int, default=200)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    return parser
+
+
+def fit_twice(args):
+    start = time.perf_counter()
+    from densmap import densMAP
+    import_seconds = time.perf_counter() - start
+
+    X = np.random.RandomState(0).normal(
+        size=(args.n_points[0], args.n_features)).astype(np.float32)
+    fit_seconds = []
+    for _ in range(2):
+        start = time.perf_counter()
+        densMAP(n_epochs=args.n_epochs, random_state=42).fit(X)
+        fit_seconds.append(time.perf_counter() - start)
+
+    print(json.dumps({
+        'import_seconds': round(import_seconds, 2),
+        'first_fit_seconds': round(fit_seconds[0], 2),
+        'second_fit_seconds': round(fit_seconds[1], 2),
+    }), flush=True)
+
+
+def main():
+    args = parse_args().parse_args()
+    if args.child:
+        fit_twice(args)
+        return
+
+    for n_points in args.n_points:
+        cache_dir = tempfile.mkdtemp(prefix='densmap-numba-cache-')
+        env = dict(os.environ, NUMBA_CACHE_DIR=cache_dir)
+        try:
+            for cache in ['cold', 'warm']:
+                output = subprocess.check_output(
+                    [sys.executable, __file__, '--child', '-n', str(n_points),
+                     '-f', str(args.n_features), '-e', str(args.n_epochs)],
+                    env=env,
+                )
+                result = json.loads(output.decode().strip().splitlines()[-1])
+                result.update({'n_points': n_points, 'cache': cache})
+                print(json.dumps(result), flush=True)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
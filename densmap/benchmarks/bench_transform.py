@@ -0,0 +1,74 @@
+"""Latency of densMAP.transform for single points and small and large
+batches of new points.
+
+A model is fit on a synthetic Gaussian mixture (the k-nearest neighbor graph
+can be cached across runs with --knn-cache), then batches of held-out points
+are transformed repeatedly and the p50 / p99 latencies are reported.
+
+    python bench_transform.py -n 500000 -b 1 64 4096 --knn-cache /tmp/knn
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-points', type=int, default=500000)
+    parser.add_argument('-f', '--n-features', type=int, default=20)
+    parser.add_argument('-k', '--n-nei', type=int, default=30)
+    parser.add_argument('-e', '--n-epochs', type=int, default=200,
+                        help='Epochs of the fit; transform uses a third (default: %(default)s)')
+    parser.add_argument('-b', '--batch-sizes', type=int, nargs='+', default=[1, 64, 4096])
+    parser.add_argument('-r', '--repeats', type=int, default=100,
+                        help='Timed calls per batch size (default: %(default)s)')
+    parser.add_argument('--knn-cache', default=None,
+                        help='Directory in which to cache the k-NN graph of the training data')
+    return parser
+
+
+def mixture(n_points, n_features, rng):
+    centers = np.random.RandomState(42).normal(scale=10.0, size=(6, n_features))
+    labels = rng.randint(0, centers.shape[0], n_points)
+    scales = np.linspace(0.5, 3.0, centers.shape[0])[labels]
+    return (centers[labels] + scales[:, None] *
+            rng.normal(size=(n_points, n_features))).astype(np.float32)
+
+
+def main():
+    args = parse_args().parse_args()
+
+    from densmap import densMAP
+
+    rng = np.random.RandomState(0)
+    X = mixture(args.n_points, args.n_features, rng)
+    queries = mixture(max(args.batch_sizes) * 4, args.n_features, rng)
+
+    start = time.time()
+    model = densMAP(n_neighbors=args.n_nei, n_epochs=args.n_epochs, random_state=42,
+                    final_dens=False, knn_cache_dir=args.knn_cache).fit(X)
+    print(json.dumps({'fit_seconds': round(time.time() - start, 1),
+                      'n_points': args.n_points}), flush=True)
+
+    for batch_size in args.batch_sizes:
+        # the first call compiles the kernels for this batch shape
+        model.transform(queries[:batch_size])
+        latencies = []
+        for i in range(args.repeats):
+            offset = (i * batch_size) % (queries.shape[0] - batch_size + 1)
+            start = time.perf_counter()
+            model.transform(queries[offset:offset + batch_size])
+            latencies.append(time.perf_counter() - start)
+        latencies = np.array(latencies) * 1000.0
+        print(json.dumps({
+            'batch_size': batch_size,
+            'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 2),
+            'points_per_sec': round(batch_size * 1000.0 / float(np.median(latencies)), 1),
+        }), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,35 @@
 import sys
+import os
 import numpy as np
 import argparse
 import pickle
+import tempfile
 
 import densmap
-from sklearn.datasets import load_digits
+
+# Rows of the transposed input written at a time, bounding the memory used
+TRANSPOSE_CHUNK_BYTES = 2 ** 26
+
+def transpose_to_disk(data, path):
+    """Write the transpose of a memory-mapped array to a float32 C-ordered
+    .npy file at path, chunk by chunk, and memory-map it. The transposed
+    view of a C-ordered array is Fortran-ordered, and would otherwise be
+    copied into memory as a whole by densMAP."""
+    n_rows, n_cols = data.shape[1], data.shape[0]
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                    shape=(n_rows, n_cols))
+    chunk = max(1, TRANSPOSE_CHUNK_BYTES // (4 * n_cols))
+    for start in range(0, n_rows, chunk):
+        out[start:start + chunk] = data[:, start:start + chunk].T
+    out.flush()
+    del out
+    return np.load(path, mmap_mode='r')
 
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('-i','--input', help='Input .txt or .pkl', default='data.txt')
+    parser.add_argument('-i','--input', help='Input .txt, .npy or .pkl (.npy files are memory-mapped; '
+                        'a .npy array with fewer rows than columns is first transposed into a temporary file)',
+                        default='data.txt')
     parser.add_argument('-o','--outname', help='Output prefix for saving _emb.txt, _dens.txt',
                         default='out')
     parser.add_argument('-f','--dens_frac', type=float, default=0.3)
@@ -23,16 +44,27 @@ def parse_args():
     return parser
 
 def main(args):
+    # Compile the kernels while the input is being read
+    densmap.warmup(n_components=args.ndim)
+
     if args.input.endswith('.txt'):
         data = np.loadtxt(args.input)
+    elif args.input.endswith('.npy'):
+        # Memory-mapped; float32 C-ordered arrays are never loaded as a whole
+        data = np.load(args.input, mmap_mode='r')
     elif args.input.endswith('.pkl'):
         data = pickle.load(open(args.input,'rb'))
     else:
         raise RuntimeError(f'File format for {args.input} not supported')
 
+    tmp_dir = None
     if data.shape[0] < data.shape[1]:
-        data = data.T
-    
+        if isinstance(data, np.memmap) and not data.T.flags.c_contiguous:
+            tmp_dir = tempfile.TemporaryDirectory()
+            data = transpose_to_disk(data, os.path.join(tmp_dir.name, 'input_T.npy'))
+        else:
+            data = data.T
+
     emb = densmap.densMAP(verbose=True,
                           n_components=args.ndim,
                           n_neighbors=args.n_nei,
@@ -42,6 +74,9 @@ def main(args):
                           logdist_shift=0,
                           var_shift=args.var_shift,
                           final_dens=args.final_dens).fit_transform(data)
+    if tmp_dir is not None:
+        del data
+        tmp_dir.cleanup()
 
     outname = args.outname
     if args.final_dens:
@@ -1,10 +1,41 @@
-from .densmap_ import densMAP
+import sys
 
 # Workaround: https://github.com/numba/numba/issues/3341
 import numba
 
 numba.config.THREADING_LAYER = "workqueue"
 
-import pkg_resources
+from .startup import warmup
 
-__version__ = pkg_resources.get_distribution("densmap-learn").version
+
+def _get_version():
+    try:
+        from importlib.metadata import version
+    except ImportError:  # Python < 3.8
+        import pkg_resources
+
+        return pkg_resources.get_distribution("densmap-learn").version
+    return version("densmap-learn")
+
+
+__version__ = _get_version()
+
+# densMAP and local_radius are imported on first use (PEP 562), since their
+# module pulls in scikit-learn and scipy
+_lazy_attributes = {"densMAP": "densmap.densmap_", "local_radius": "densmap.densmap_"}
+
+if sys.version_info < (3, 7):
+    from .densmap_ import densMAP, local_radius
+else:
+
+    def __getattr__(name):
+        if name in _lazy_attributes:
+            import importlib
+
+            value = getattr(importlib.import_module(_lazy_attributes[name]), name)
+            globals()[name] = value
+            return value
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+    def __dir__():
+        return sorted(list(globals()) + list(_lazy_attributes))
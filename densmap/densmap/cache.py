@@ -0,0 +1,220 @@
+# Authors: Ashwin Narayan and Hyunghoon Cho
+#
+# License: MIT
+"""On-disk cache of the k-nearest neighbor graphs computed by densMAP.
+
+Every cached graph lives in its own subdirectory of the cache directory,
+named after a hash of the data and of the parameters the graph depends on.
+It holds the neighbor indices and distances and the arrays of each
+flattened random projection tree as ``.npy`` files, so that they can be
+memory-mapped when loaded. When the cache grows beyond its size limit, the
+least recently used graphs are removed.
+"""
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+try:
+    import joblib
+except ImportError:
+    # sklearn.externals.joblib is deprecated in 0.21, will be removed in 0.23
+    from sklearn.externals import joblib
+
+from densmap.rp_tree import FlatTree
+
+META_FILE = "meta.json"
+
+
+def knn_cache_key(
+    data_hash, n_neighbors, metric, metric_kwds, angular, n_blocks=None
+):
+    """The key of the k-nearest neighbor graph of a data set in the cache.
+
+    Parameters
+    ----------
+    data_hash: str
+        The ``joblib.hash`` of the data.
+
+    n_neighbors: int
+        The number of neighbors in the graph.
+
+    metric: string
+        The name of the metric the graph was computed with.
+
+    metric_kwds: dict
+        The arguments to the metric.
+
+    angular: bool
+        Whether an angular random projection forest was requested.
+
+    n_blocks: int or None (optional, default None)
+        The number of blocks of the parallel nearest neighbor descent the
+        graph was computed with, or None for the serial descent. The two
+        descents, and the parallel one with different numbers of blocks,
+        find different graphs.
+
+    Returns
+    -------
+    key: str
+        A hash of all the arguments.
+    """
+    return joblib.hash(
+        (
+            data_hash,
+            int(n_neighbors),
+            metric,
+            sorted(metric_kwds.items()),
+            bool(angular),
+            None if n_blocks is None else int(n_blocks),
+        )
+    )
+
+
+class KNNGraphCache(object):
+    """A directory of cached k-nearest neighbor graphs, with an optional
+    limit on its total size.
+
+    Parameters
+    ----------
+    cache_dir: str
+        The directory holding the cache. It is created if needed.
+
+    max_bytes: int or None (optional, default None)
+        The maximum total size of the cached graphs. After storing a graph,
+        the least recently used other graphs are removed until the cache
+        fits. If None the cache is unbounded.
+
+    mmap: bool (optional, default True)
+        Whether to memory-map the arrays of loaded graphs rather than read
+        them into memory.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None, mmap=True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.mmap = mmap
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key):
+        """Load a cached graph.
+
+        Parameters
+        ----------
+        key: str
+            The key of the graph, see ``knn_cache_key``.
+
+        Returns
+        -------
+        cached: tuple or None
+            ``(knn_indices, knn_dists, rp_forest)`` as returned by
+            ``nearest_neighbors``, or None if the graph is not cached.
+        """
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+
+        mmap_mode = "r" if self.mmap else None
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+        def load_array(name):
+            # a plain ndarray view, which the compiled kernels accept as is
+            return np.asarray(
+                np.load(os.path.join(entry_dir, name + ".npy"), mmap_mode=mmap_mode)
+            )
+
+        knn_indices = load_array("knn_indices")
+        knn_dists = load_array("knn_dists")
+        rp_forest = [
+            FlatTree(*[load_array("tree%d_%s" % (i, field)) for field in FlatTree._fields])
+            for i in range(meta["n_trees"])
+        ]
+
+        # mark the entry as recently used
+        os.utime(entry_dir, None)
+        return knn_indices, knn_dists, rp_forest
+
+    def store(self, key, knn_indices, knn_dists, rp_forest):
+        """Add a graph to the cache, and evict least recently used graphs if
+        the cache is then over its size limit.
+
+        Parameters
+        ----------
+        key: str
+            The key of the graph, see ``knn_cache_key``.
+
+        knn_indices: array of shape (n_samples, n_neighbors)
+            The indices of the nearest neighbors of each point.
+
+        knn_dists: array of shape (n_samples, n_neighbors)
+            The distances to the nearest neighbors of each point.
+
+        rp_forest: list of FlatTree
+            The flattened random projection trees.
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        # write to a temporary directory first so that concurrent readers
+        # never see a partially written entry
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        try:
+            np.save(os.path.join(tmp_dir, "knn_indices.npy"), knn_indices)
+            np.save(os.path.join(tmp_dir, "knn_dists.npy"), knn_dists)
+            for i, tree in enumerate(rp_forest):
+                for field in FlatTree._fields:
+                    np.save(
+                        os.path.join(tmp_dir, "tree%d_%s.npy" % (i, field)),
+                        getattr(tree, field),
+                    )
+            with open(os.path.join(tmp_dir, META_FILE), "w") as f:
+                json.dump({"n_trees": len(rp_forest)}, f)
+
+            entry_dir = self._entry_dir(key)
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.isdir(self._entry_dir(key)):
+                raise
+
+        self.evict(keep=key)
+
+    def entries(self):
+        """The cached graphs as a list of ``(last_used, size_in_bytes, key)``
+        tuples, least recently used first."""
+        result = []
+        if not os.path.isdir(self.cache_dir):
+            return result
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self._entry_dir(key)
+            if key.startswith(".") or not os.path.isdir(entry_dir):
+                continue
+            size = 0
+            for name in os.listdir(entry_dir):
+                size += os.path.getsize(os.path.join(entry_dir, name))
+            result.append((os.path.getmtime(entry_dir), size, key))
+        return sorted(result)
+
+    def evict(self, keep=None):
+        """Remove least recently used graphs, other than ``keep``, until the
+        total size of the cache is at most ``max_bytes``."""
+        if self.max_bytes is None:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total -= size
@@ -0,0 +1,375 @@
+# Authors: Ashwin Narayan and Hyunghoon Cho
+#
+# License: MIT
+"""Compiled edge aggregation kernels used for the local radius (density)
+statistics of densMAP.
+
+The local radius of a vertex is a membership weighted average of the squared
+lengths of its incident edges. Computing it amounts to a per-edge map (the
+squared edge length) followed by a scatter-add of each edge into both of its
+endpoints. The scatter-add is made thread safe by giving every thread a
+private accumulation buffer over a contiguous block of edges, and then
+reducing the buffers over vertices.
+"""
+import numpy as np
+import numba
+
+import scipy.sparse
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def edge_squared_distances(data, head, tail):
+    """Squared euclidean length of every edge of a graph whose vertices are
+    the rows of a dense array.
+
+    Parameters
+    ----------
+    data: array of shape (n_samples, n_features)
+        The coordinates of the vertices.
+
+    head: array of shape (n_edges,)
+        The index of the first endpoint of each edge.
+
+    tail: array of shape (n_edges,)
+        The index of the second endpoint of each edge.
+
+    Returns
+    -------
+    sq_dists: array of shape (n_edges,)
+        The squared euclidean distance between the endpoints of each edge.
+    """
+    result = np.empty(head.shape[0], dtype=np.float32)
+    for i in numba.prange(head.shape[0]):
+        j = head[i]
+        k = tail[i]
+        d = 0.0
+        for f in range(data.shape[1]):
+            diff = data[j, f] - data[k, f]
+            d += diff * diff
+        result[i] = d
+    return result
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def sparse_edge_squared_distances(indptr, indices, data, head, tail):
+    """Squared euclidean length of every edge of a graph whose vertices are
+    the rows of a CSR matrix with sorted indices.
+
+    Parameters
+    ----------
+    indptr: array
+        CSR format index pointer array of the matrix
+
+    indices: array
+        CSR format (sorted) index array of the matrix
+
+    data: array
+        CSR format data array of the matrix
+
+    head: array of shape (n_edges,)
+        The index of the first endpoint of each edge.
+
+    tail: array of shape (n_edges,)
+        The index of the second endpoint of each edge.
+
+    Returns
+    -------
+    sq_dists: array of shape (n_edges,)
+        The squared euclidean distance between the endpoints of each edge.
+    """
+    result = np.empty(head.shape[0], dtype=np.float32)
+    for i in numba.prange(head.shape[0]):
+        i1 = indptr[head[i]]
+        end1 = indptr[head[i] + 1]
+        i2 = indptr[tail[i]]
+        end2 = indptr[tail[i] + 1]
+        d = 0.0
+
+        # merge the two sorted index lists
+        while i1 < end1 and i2 < end2:
+            j1 = indices[i1]
+            j2 = indices[i2]
+            if j1 == j2:
+                diff = data[i1] - data[i2]
+                i1 += 1
+                i2 += 1
+            elif j1 < j2:
+                diff = data[i1]
+                i1 += 1
+            else:
+                diff = data[i2]
+                i2 += 1
+            d += diff * diff
+
+        while i1 < end1:
+            d += data[i1] * data[i1]
+            i1 += 1
+
+        while i2 < end2:
+            d += data[i2] * data[i2]
+            i2 += 1
+
+        result[i] = d
+    return result
+
+
+def squared_edge_lengths(data, head, tail):
+    """Squared euclidean length of every edge ``(head[i], tail[i])`` of a
+    graph on the rows of ``data``, which may be a dense array or a CSR
+    matrix."""
+    if scipy.sparse.isspmatrix_csr(data):
+        if not data.has_sorted_indices:
+            data = data.sorted_indices()
+        return sparse_edge_squared_distances(
+            data.indptr, data.indices, data.data, head, tail
+        )
+    return edge_squared_distances(data, head, tail)
+
+
+@numba.njit(parallel=True, cache=True)
+def csr_edge_lookup(indptr, indices, data, head, tail, missing=-1.0):
+    """Look up the entries ``(head[i], tail[i])`` of a CSR matrix with
+    sorted indices, using a binary search within each row.
+
+    Parameters
+    ----------
+    indptr: array
+        CSR format index pointer array of the matrix
+
+    indices: array
+        CSR format (sorted) index array of the matrix
+
+    data: array
+        CSR format data array of the matrix
+
+    head: array of shape (n_edges,)
+        The row of each entry to look up.
+
+    tail: array of shape (n_edges,)
+        The column of each entry to look up.
+
+    missing: float (optional, default -1.0)
+        The value to return for entries that are not stored in the matrix.
+
+    Returns
+    -------
+    values: array of shape (n_edges,)
+        The value of each requested entry.
+    """
+    result = np.empty(head.shape[0], dtype=np.float32)
+    for i in numba.prange(head.shape[0]):
+        lo = indptr[head[i]]
+        hi = indptr[head[i] + 1]
+        target = tail[i]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if indices[mid] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < indptr[head[i] + 1] and indices[lo] == target:
+            result[i] = data[lo]
+        else:
+            result[i] = missing
+    return result
+
+
+def precomputed_edge_squared_lengths(dmat, head, tail):
+    """Squared length of every edge ``(head[i], tail[i])`` of a graph, read
+    from a distance matrix ``dmat``. If ``dmat`` is sparse, the edges it does
+    not store are taken to have length zero."""
+    if scipy.sparse.issparse(dmat):
+        dmat = dmat.tocsr()
+        if not dmat.has_sorted_indices:
+            dmat = dmat.sorted_indices()
+        dists = csr_edge_lookup(
+            dmat.indptr, dmat.indices, dmat.data, head, tail, 0.0
+        )
+    else:
+        dists = np.asarray(dmat[head, tail], dtype=np.float32)
+    return dists * dists
+
+
+def graph_edge_squared_lengths(
+    data, head, tail, graph_dists=None, precomputed=False
+):
+    """Squared length of every edge ``(head[i], tail[i])`` of a graph on the
+    rows of ``data``, or on the points between which ``data`` holds the
+    distances if ``precomputed`` is True.
+
+    If ``graph_dists`` (a sparse matrix of distances along the edges, as
+    returned by ``fuzzy_simplicial_set`` with ``return_dists=True``) is given,
+    the lengths are looked up from it and only the edges it does not store
+    (zero distances, or edges added after the k-neighbor graph was built) are
+    recomputed from ``data``.
+    """
+    if precomputed:
+        edge_lengths = precomputed_edge_squared_lengths
+    else:
+        edge_lengths = squared_edge_lengths
+
+    if graph_dists is None:
+        return edge_lengths(data, head, tail)
+
+    graph_dists = graph_dists.tocsr()
+    if not graph_dists.has_sorted_indices:
+        graph_dists.sort_indices()
+
+    dists = csr_edge_lookup(
+        graph_dists.indptr,
+        graph_dists.indices,
+        graph_dists.data,
+        head,
+        tail,
+    )
+    missing = dists < 0.0
+    sq_dists = dists * dists
+    if np.any(missing):
+        sq_dists[missing] = edge_lengths(
+            data, head[missing], tail[missing]
+        )
+    return sq_dists
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def edge_scatter_sum(head, tail, weights, values, n_vertices, n_threads):
+    """Accumulate a weighted per-edge value into both endpoints of each edge.
+    Each of the ``n_threads`` blocks of edges is accumulated into its own
+    buffer, so no two threads ever write to the same location.
+
+    Parameters
+    ----------
+    head: array of shape (n_edges,)
+        The index of the first endpoint of each edge.
+
+    tail: array of shape (n_edges,)
+        The index of the second endpoint of each edge.
+
+    weights: array of shape (n_edges,)
+        The weight (membership strength) of each edge.
+
+    values: array of shape (n_edges,)
+        The value to be averaged over the edges, e.g. squared edge lengths.
+
+    n_vertices: int
+        The number of vertices in the graph.
+
+    n_threads: int
+        The number of edge blocks (and private buffers) to use.
+
+    Returns
+    -------
+    value_sum: array of shape (n_vertices,)
+        The sum of ``weights * values`` over the edges incident to each vertex.
+
+    weight_sum: array of shape (n_vertices,)
+        The sum of ``weights`` over the edges incident to each vertex.
+    """
+    n_edges = head.shape[0]
+    block_size = (n_edges + n_threads - 1) // n_threads
+
+    value_buffer = np.zeros((n_threads, n_vertices), dtype=np.float32)
+    weight_buffer = np.zeros((n_threads, n_vertices), dtype=np.float32)
+
+    for t in numba.prange(n_threads):
+        start = t * block_size
+        end = min(start + block_size, n_edges)
+        for i in range(start, end):
+            j = head[i]
+            k = tail[i]
+            w = weights[i]
+            v = w * values[i]
+
+            value_buffer[t, j] += v
+            value_buffer[t, k] += v
+            weight_buffer[t, j] += w
+            weight_buffer[t, k] += w
+
+    value_sum = np.zeros(n_vertices, dtype=np.float32)
+    weight_sum = np.zeros(n_vertices, dtype=np.float32)
+    for j in numba.prange(n_vertices):
+        for t in range(n_threads):
+            value_sum[j] += value_buffer[t, j]
+            weight_sum[j] += weight_buffer[t, j]
+
+    return value_sum, weight_sum
+
+
+def edge_local_radius(head, tail, weights, sq_dists, n_vertices, logdist_shift=0.0):
+    """Compute the log local radius of every vertex of a graph from the
+    squared lengths of its edges.
+
+    Parameters
+    ----------
+    head: array of shape (n_edges,)
+        The index of the first endpoint of each edge.
+
+    tail: array of shape (n_edges,)
+        The index of the second endpoint of each edge.
+
+    weights: array of shape (n_edges,)
+        The membership strength of each edge.
+
+    sq_dists: array of shape (n_edges,)
+        The squared length of each edge.
+
+    n_vertices: int
+        The number of vertices in the graph.
+
+    logdist_shift: float (optional, default 0.0)
+        Constant added to the local radius before taking the log.
+
+    Returns
+    -------
+    radius: array of shape (n_vertices,)
+        The log local radius of each vertex.
+
+    weight_sum: array of shape (n_vertices,)
+        The total membership strength of the edges incident to each vertex.
+    """
+    radius, weight_sum = edge_scatter_sum(
+        head,
+        tail,
+        weights,
+        sq_dists,
+        n_vertices,
+        numba.config.NUMBA_NUM_THREADS,
+    )
+    radius = np.log(np.float32(logdist_shift) + (radius / weight_sum))
+    return radius, weight_sum
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def knn_local_radius(knn_dists, weights, logdist_shift=0.0):
+    """Compute the log local radius of points from the distances to, and
+    membership strengths of, their nearest neighbors in a reference set.
+
+    Parameters
+    ----------
+    knn_dists: array of shape (n_samples, n_neighbors)
+        The distances to the nearest reference points of each point.
+
+    weights: array of shape (n_samples, n_neighbors)
+        The membership strength of the edge to each of these neighbors.
+
+    logdist_shift: float (optional, default 0.0)
+        Constant added to the local radius before taking the log.
+
+    Returns
+    -------
+    radius: array of shape (n_samples,)
+        The log of the membership weighted average of the squared distances
+        to the neighbors of each point.
+    """
+    n_samples, n_neighbors = knn_dists.shape
+    result = np.empty(n_samples, dtype=np.float32)
+    for i in numba.prange(n_samples):
+        value_sum = 0.0
+        weight_sum = 0.0
+        for j in range(n_neighbors):
+            d = knn_dists[i, j]
+            value_sum += weights[i, j] * d * d
+            weight_sum += weights[i, j]
+        result[i] = np.log(logdist_shift + value_sum / weight_sum)
+    return result
@@ -7,20 +7,22 @@
 #
 # License: BSD 3 clause
 from __future__ import print_function
+from collections import namedtuple
 from warnings import warn
+import threading
 import time
+import types
 
 # Silence NumbaPerformanceWarning (see Issue #252 on UMAP repository)
 import warnings
 from numba.errors import NumbaPerformanceWarning
 warnings.filterwarnings("ignore", category=NumbaPerformanceWarning)
 
-from scipy.optimize import curve_fit
+# The heavier parts of scipy and scikit-learn (scipy.optimize,
+# sklearn.metrics, sklearn.neighbors, ...) are imported by the functions that
+# use them, so that importing densmap stays fast
 from sklearn.base import BaseEstimator
 from sklearn.utils import check_random_state, check_array
-from sklearn.metrics import pairwise_distances
-from sklearn.preprocessing import normalize
-from sklearn.neighbors import KDTree
 
 try:
     import joblib
@@ -40,18 +42,35 @@ import densmap.sparse as sparse
 from densmap.utils import (
     tau_rand_int,
     deheap_sort,
-    submatrix,
     ts,
     fast_knn_indices,
+    fast_sparse_knn,
+    space_filling_curve_order,
 )
 from densmap.rp_tree import rptree_leaf_array, make_forest
 from densmap.nndescent import (
     make_nn_descent,
+    make_parallel_nn_descent,
     make_initialisations,
     make_initialized_nnd_search,
     initialise_search,
 )
 from densmap.spectral import spectral_layout
+from densmap.density import (
+    csr_edge_lookup,
+    graph_edge_squared_lengths,
+    edge_local_radius,
+    knn_local_radius,
+)
+from densmap.cache import KNNGraphCache, knn_cache_key
+from densmap.exact_knn import (
+    GRID_KNN_MAX_DIM,
+    exact_nearest_neighbors,
+    make_exact_knn,
+)
+from densmap.persistence import save_model, load_model
+from densmap.profiling import FitProfile
+from densmap.startup import wait_for_warmup
 
 import locale
 
@@ -64,9 +83,31 @@ SMOOTH_K_TOLERANCE = 1e-5
 MIN_K_DIST_SCALE = 1e-3
 NPY_INFINITY = np.inf
 
+# Rows of the input are checked for non-finite values in chunks of about this
+# many bytes when the input is used without a copy
+FINITE_CHECK_CHUNK_BYTES = 1 << 26
+
+# Layouts with fewer edges than this are optimized on a single thread, as the
+# cost of starting the parallel epochs would outweigh their work
+PARALLEL_LAYOUT_MIN_EDGES = 2048
+
+# The number of vertices over which the epoch callback of optimize_layout
+# estimates the correlation of the local radii
+CALLBACK_DENSITY_SAMPLE = 2000
+
+LayoutWorkspace = namedtuple(
+    "LayoutWorkspace",
+    [
+        "epochs_per_sample",
+        "epochs_per_negative_sample",
+        "epoch_of_next_sample",
+        "epoch_of_next_negative_sample",
+    ],
+)
+
 
 @numba.njit(
-    fastmath=True
+    fastmath=True, cache=True
 )  # benchmarking `parallel=True` shows it to *decrease* performance
 def smooth_knn_dist(
     distances,
@@ -189,6 +230,201 @@ def smooth_knn_dist(
     return result, rho
 
 
+def check_input_array(X):
+    """Validate the input data of ``densMAP.fit`` like ``check_array(X,
+    dtype=np.float32, accept_sparse="csr")``, but without making a copy of
+    arrays that are already float32 and C-contiguous, such as ``np.memmap``
+    backed arrays. These are checked for non-finite values one chunk of rows
+    at a time, so no temporary the size of the input is allocated either.
+
+    Parameters
+    ----------
+    X: array or sparse matrix of shape (n_samples, n_features)
+        The input data.
+
+    Returns
+    -------
+    X: array or sparse matrix of shape (n_samples, n_features)
+        The validated data, which is ``X`` itself if it could be used as is.
+    """
+    if (
+        type(X) not in (np.ndarray, np.memmap)
+        or X.dtype != np.float32
+        or X.ndim != 2
+        or not X.flags.c_contiguous
+        or X.size == 0
+    ):
+        return check_array(X, dtype=np.float32, accept_sparse="csr")
+
+    chunk_rows = max(1, FINITE_CHECK_CHUNK_BYTES // X.strides[0])
+    with np.errstate(over="ignore", invalid="ignore"):
+        for start in range(0, X.shape[0], chunk_rows):
+            chunk = X[start : start + chunk_rows]
+            # The sum overflows or is nan if any element is non-finite
+            if not np.isfinite(chunk.sum()) and not np.all(np.isfinite(chunk)):
+                raise ValueError(
+                    "Input contains NaN, infinity or a value too large for "
+                    "dtype('float32')."
+                )
+    return X
+
+
+def check_precomputed_knn(precomputed_knn, n_samples, n_neighbors):
+    """Validate a k-nearest neighbor graph computed outside of densMAP.
+
+    Parameters
+    ----------
+    precomputed_knn: tuple
+        A pair ``(knn_indices, knn_dists)`` of arrays of shape (n_samples,
+        n_nearest) with n_nearest >= n_neighbors, holding for each point the
+        indices of and distances to its nearest neighbors (conventionally
+        including the point itself at distance 0). Missing neighbors are
+        marked by an index of -1.
+
+    n_samples: int
+        The number of points in the data.
+
+    n_neighbors: int
+        The number of nearest neighbors to use.
+
+    Returns
+    -------
+    knn_indices: array of shape (n_samples, n_neighbors)
+        The indices of the ``n_neighbors`` closest points, sorted by
+        distance.
+
+    knn_dists: array of shape (n_samples, n_neighbors)
+        The distances to the ``n_neighbors`` closest points.
+    """
+    if len(precomputed_knn) != 2:
+        raise ValueError(
+            "precomputed_knn must be a pair (knn_indices, knn_dists)"
+        )
+    knn_indices = np.asarray(precomputed_knn[0])
+    knn_dists = np.asarray(precomputed_knn[1], dtype=np.float32)
+    if knn_indices.ndim != 2 or knn_indices.shape != knn_dists.shape:
+        raise ValueError(
+            "The precomputed knn_indices and knn_dists must be 2D arrays of "
+            "the same shape"
+        )
+    if not np.issubdtype(knn_indices.dtype, np.integer):
+        raise ValueError("The precomputed knn_indices must be integers")
+    knn_indices = knn_indices.astype(np.int32)
+    if knn_indices.shape[0] != n_samples:
+        raise ValueError(
+            "The precomputed k-nearest neighbor graph must have a row for "
+            "every sample of X"
+        )
+    if knn_indices.shape[1] < n_neighbors:
+        raise ValueError(
+            "The precomputed k-nearest neighbor graph must have at least "
+            "n_neighbors neighbors per sample"
+        )
+    if np.any(knn_indices >= n_samples):
+        raise ValueError(
+            "The precomputed knn_indices must be smaller than the number of "
+            "samples"
+        )
+
+    knn_dists = np.where(knn_indices < 0, np.float32(np.inf), knn_dists)
+    if np.any(knn_dists[:, 1:] < knn_dists[:, :-1]):
+        order = np.argsort(knn_dists, axis=1, kind="mergesort")
+        knn_indices = np.take_along_axis(knn_indices, order, axis=1)
+        knn_dists = np.take_along_axis(knn_dists, order, axis=1)
+
+    return (
+        np.ascontiguousarray(knn_indices[:, :n_neighbors]),
+        np.ascontiguousarray(knn_dists[:, :n_neighbors]),
+    )
+
+
+def fast_distance_alternative(metric, X):
+    """The cheaper distance function that ranks the rows of ``X`` as
+    ``metric`` does, with the data to apply it to, or None if ``metric`` has
+    no such alternative.
+
+    The squared euclidean distance saves a square root per pair of points.
+    For the cosine distance the rows are scaled to unit norm once, here, so
+    that each distance is a single dot product.
+
+    Parameters
+    ----------
+    metric: string or callable
+        The metric of the nearest neighbor search.
+
+    X: array of shape (n_samples, n_features)
+        The points to compute distances between.
+
+    Returns
+    -------
+    alternative: tuple or None
+        The pair ``(distance_func, data)``.
+    """
+    if not isinstance(metric, str) or metric not in dist.fast_distance_alternatives:
+        return None
+    if metric == "cosine":
+        norms = np.sqrt(np.einsum("ij,ij->i", X, X))
+        norms[norms == 0.0] = 1.0
+        X = X / norms[:, None].astype(X.dtype)
+    return dist.fast_distance_alternatives[metric], X
+
+
+def correct_alternative_distances(metric, data, query, knn_indices, knn_dists):
+    """Turn the distances to the nearest neighbors found with the
+    ``fast_distance_alternative`` of ``metric`` into distances under
+    ``metric``.
+
+    Parameters
+    ----------
+    metric: string
+        The metric of the nearest neighbor search.
+
+    data: array of shape (n_samples, n_features)
+        The points among which the neighbors were found.
+
+    query: array of shape (n_queries, n_features)
+        The points whose neighbors were found.
+
+    knn_indices: array of shape (n_queries, n_neighbors)
+        The indices in ``data`` of the neighbors of each query point, sorted
+        by the alternative distance, -1 marking missing neighbors.
+
+    knn_dists: array of shape (n_queries, n_neighbors)
+        The alternative distances to the neighbors.
+
+    Returns
+    -------
+    knn_indices: array of shape (n_queries, n_neighbors)
+        The indices of the neighbors, sorted by distance.
+
+    knn_dists: array of shape (n_queries, n_neighbors)
+        The distances to the neighbors.
+    """
+    if metric in ("euclidean", "l2"):
+        return knn_indices, np.sqrt(knn_dists)
+
+    # The exact distances, e.g. between rows of zeros, which the
+    # alternative does not tell apart from the others
+    _, candidate_distances = make_exact_knn(dist.named_distances[metric], ())
+    knn_dists = candidate_distances(query, data, np.maximum(knn_indices, 0))
+    knn_dists[knn_indices < 0] = np.inf
+    order = np.argsort(knn_dists, axis=1, kind="stable")
+    return (
+        np.take_along_axis(knn_indices, order, axis=1),
+        np.take_along_axis(knn_dists, order, axis=1),
+    )
+
+
+def _nn_descent_blocks(n_jobs):
+    """The number of blocks the nearest neighbor descent of dense data is
+    split into for a given ``n_jobs``, or None for the serial descent."""
+    if n_jobs is None or n_jobs == 1:
+        return None
+    if n_jobs < 0:
+        return max(1, numba.config.NUMBA_NUM_THREADS + 1 + n_jobs)
+    return n_jobs
+
+
 def nearest_neighbors(
     X,
     n_neighbors,
@@ -197,6 +433,8 @@ def nearest_neighbors(
     angular,
     random_state,
     verbose=False,
+    n_jobs=None,
+    profile=None,
 ):
     """Compute the ``n_neighbors`` nearest points for each data point in ``X``
     under ``metric``. This may be exact, but more likely is approximated via
@@ -205,7 +443,10 @@ def nearest_neighbors(
     Parameters
     ----------
     X: array of shape (n_samples, n_features)
-        The input data to compute the k-neighbor graph of.
+        The input data to compute the k-neighbor graph of. This may be an
+        ``np.memmap``, in which case the data is read from it in place. If
+        ``metric`` is 'precomputed' this is a square distance matrix, which
+        may be sparse (only the stored entries are then candidate neighbors).
 
     n_neighbors: int
         The number of nearest neighbors to compute for each sample in ``X``.
@@ -225,6 +466,16 @@ def nearest_neighbors(
     verbose: bool
         Whether to print status data during the computation.
 
+    n_jobs: int or None (optional, default None)
+        The number of blocks the nearest neighbor descent of dense data is
+        split into to run in parallel; -1 means one per numba thread, -2 one
+        less, and so on. None or 1 runs the serial nearest neighbor descent.
+
+    profile: FitProfile or None (optional, default None)
+        The report to record the stages of the search in: the random
+        projection forest and the nearest neighbor descent, with the number
+        of graph updates of each of its iterations.
+
     Returns
     -------
     knn_indices: array of shape (n_samples, n_neighbors)
@@ -235,16 +486,38 @@ def nearest_neighbors(
     """
     if verbose:
         print(ts(), "Finding Nearest Neighbors")
+    if profile is None:
+        profile = FitProfile()
+
+    if isinstance(X, np.memmap):
+        # A plain ndarray view of the mapped memory, which the compiled
+        # kernels accept as is
+        X = np.asarray(X)
+
+    if metric == "precomputed" and scipy.sparse.issparse(X):
+        # Only the stored entries of a sparse distance matrix are candidate
+        # neighbors; the diagonal is taken to be zero
+        X = X.tocsr()
+        with profile.stage("precomputed_knn"):
+            knn_indices, knn_dists = fast_sparse_knn(
+                X.indptr, X.indices, X.data, n_neighbors
+            )
+        if np.any(knn_indices < 0):
+            warn(
+                "Some rows of the precomputed distance matrix have fewer "
+                "than n_neighbors entries. Results may be less than ideal."
+            )
 
-    if metric == "precomputed":
-        # Note that this does not support sparse distance matrices yet ...
-        # Compute indices of n nearest neighbors
-        knn_indices = fast_knn_indices(X, n_neighbors)
-        # Compute the nearest neighbor distances
-        #   (equivalent to np.sort(X)[:,:n_neighbors])
-        knn_dists = X[
-            np.arange(X.shape[0])[:, None], knn_indices
-        ].copy()
+        rp_forest = []
+    elif metric == "precomputed":
+        with profile.stage("precomputed_knn"):
+            # Compute indices of n nearest neighbors
+            knn_indices = fast_knn_indices(X, n_neighbors)
+            # Compute the nearest neighbor distances
+            #   (equivalent to np.sort(X)[:,:n_neighbors])
+            knn_dists = X[
+                np.arange(X.shape[0])[:, None], knn_indices
+            ].copy()
 
         rp_forest = []
     else:
@@ -301,10 +574,11 @@ def nearest_neighbors(
                     "trees",
                 )
 
-            rp_forest = make_forest(
-                X, n_neighbors, n_trees, rng_state, angular
-            )
-            leaf_array = rptree_leaf_array(rp_forest)
+            with profile.stage("rp_forest", n_trees=n_trees):
+                rp_forest = make_forest(
+                    X, n_neighbors, n_trees, rng_state, angular
+                )
+                leaf_array = rptree_leaf_array(rp_forest)
 
             if verbose:
                 print(
@@ -313,23 +587,37 @@ def nearest_neighbors(
                     str(n_iters),
                     "iterations",
                 )
-            knn_indices, knn_dists = metric_nn_descent(
-                X.indices,
-                X.indptr,
-                X.data,
-                X.shape[0],
-                n_neighbors,
-                rng_state,
-                max_candidates=60,
-                rp_tree_init=True,
-                leaf_array=leaf_array,
-                n_iters=n_iters,
-                verbose=verbose,
-            )
+            update_counts = np.full(n_iters, -1, dtype=np.int64)
+            with profile.stage("nn_descent", n_iters=n_iters, n_jobs=None) as stage:
+                knn_indices, knn_dists = metric_nn_descent(
+                    X.indices,
+                    X.indptr,
+                    X.data,
+                    X.shape[0],
+                    n_neighbors,
+                    rng_state,
+                    max_candidates=60,
+                    rp_tree_init=True,
+                    leaf_array=leaf_array,
+                    n_iters=n_iters,
+                    verbose=verbose,
+                    update_counts=update_counts,
+                )
+                stage["update_counts"] = update_counts[update_counts >= 0].tolist()
         else:
-            metric_nn_descent = make_nn_descent(
-                distance_func, tuple(metric_kwds.values())
-            )
+            search_data = X
+            alternative = fast_distance_alternative(metric, X)
+            if alternative is not None:
+                distance_func, search_data = alternative
+            n_jobs = _nn_descent_blocks(n_jobs)
+            if n_jobs is None:
+                metric_nn_descent = make_nn_descent(
+                    distance_func, tuple(metric_kwds.values())
+                )
+            else:
+                metric_nn_descent = make_parallel_nn_descent(
+                    distance_func, tuple(metric_kwds.values())
+                )
             # TODO: Hacked values for now
             n_trees = 5 + int(
                 round((X.shape[0]) ** 0.5 / 20.0)
@@ -345,10 +633,11 @@ def nearest_neighbors(
                     str(n_trees),
                     "trees",
                 )
-            rp_forest = make_forest(
-                X, n_neighbors, n_trees, rng_state, angular
-            )
-            leaf_array = rptree_leaf_array(rp_forest)
+            with profile.stage("rp_forest", n_trees=n_trees):
+                rp_forest = make_forest(
+                    X, n_neighbors, n_trees, rng_state, angular
+                )
+                leaf_array = rptree_leaf_array(rp_forest)
             if verbose:
                 print(
                     ts(),
@@ -356,16 +645,32 @@ def nearest_neighbors(
                     str(n_iters),
                     "iterations",
                 )
-            knn_indices, knn_dists = metric_nn_descent(
-                X,
-                n_neighbors,
-                rng_state,
-                max_candidates=60,
-                rp_tree_init=True,
-                leaf_array=leaf_array,
-                n_iters=n_iters,
-                verbose=verbose,
-            )
+            if n_jobs is None:
+                nn_descent_rng_state = rng_state
+            else:
+                # One random state per block, drawn from the shared one
+                nn_descent_rng_state = np.empty((n_jobs, 3), dtype=np.int64)
+                for block in range(n_jobs):
+                    for c in range(3):
+                        nn_descent_rng_state[block, c] = tau_rand_int(rng_state)
+            update_counts = np.full(n_iters, -1, dtype=np.int64)
+            with profile.stage("nn_descent", n_iters=n_iters, n_jobs=n_jobs) as stage:
+                knn_indices, knn_dists = metric_nn_descent(
+                    search_data,
+                    n_neighbors,
+                    nn_descent_rng_state,
+                    max_candidates=60,
+                    rp_tree_init=True,
+                    leaf_array=leaf_array,
+                    n_iters=n_iters,
+                    verbose=verbose,
+                    update_counts=update_counts,
+                )
+                if alternative is not None:
+                    knn_indices, knn_dists = correct_alternative_distances(
+                        metric, X, X, knn_indices, knn_dists
+                    )
+                stage["update_counts"] = update_counts[update_counts >= 0].tolist()
 
         if np.any(knn_indices < 0):
             warn(
@@ -378,9 +683,9 @@ def nearest_neighbors(
     return knn_indices, knn_dists, rp_forest
 
 
-@numba.njit(parallel=True, fastmath=True)
+@numba.njit(parallel=True, fastmath=True, cache=True)
 def compute_membership_strengths(
-    knn_indices, knn_dists, sigmas, rhos
+    knn_indices, knn_dists, sigmas, rhos, return_dists=False, bipartite=False
 ):
     """Construct the membership strength data for the 1-skeleton of each local
     fuzzy simplicial set -- this is formed as a sparse matrix where each row is
@@ -401,6 +706,14 @@ def compute_membership_strengths(
     rhos: array of shape(n_samples)
         The local connectivity adjustment.
 
+    return_dists: bool (optional, default False)
+        Whether to also return the distance associated with each entry.
+
+    bipartite: bool (optional, default False)
+        Whether the neighbors are points of another data set than the rows
+        (as when transforming new data), in which case a neighbor index
+        equal to the row index does not denote the point itself.
+
     Returns
     -------
     rows: array of shape (n_samples * n_neighbors)
@@ -411,19 +724,27 @@ def compute_membership_strengths(
 
     vals: array of shape (n_samples * n_neighbors)
         Entries for the resulting sparse matrix (coo format)
+
+    dists: array of shape (n_samples * n_neighbors) or None
+        Distance associated with each entry of the resulting sparse matrix
+        (coo format), if ``return_dists`` is True.
     """
     n_samples = knn_indices.shape[0]
     n_neighbors = knn_indices.shape[1]
 
-    rows = np.zeros(knn_indices.size, dtype=np.int64)
-    cols = np.zeros(knn_indices.size, dtype=np.int64)
-    vals = np.zeros(knn_indices.size, dtype=np.float64)
+    rows = np.zeros(knn_indices.size, dtype=np.int32)
+    cols = np.zeros(knn_indices.size, dtype=np.int32)
+    vals = np.zeros(knn_indices.size, dtype=np.float32)
+    if return_dists:
+        dists = np.zeros(knn_indices.size, dtype=np.float32)
+    else:
+        dists = None
 
     for i in range(n_samples):
         for j in range(n_neighbors):
             if knn_indices[i, j] == -1:
                 continue  # We didn't get the full knn for i
-            if knn_indices[i, j] == i:
+            if knn_indices[i, j] == i and not bipartite:
                 val = 0.0
             elif knn_dists[i, j] - rhos[i] <= 0.0:
                 val = 1.0
@@ -438,8 +759,91 @@ def compute_membership_strengths(
             rows[i * n_neighbors + j] = i
             cols[i * n_neighbors + j] = knn_indices[i, j]
             vals[i * n_neighbors + j] = val
+            if return_dists:
+                dists[i * n_neighbors + j] = knn_dists[i, j]
 
-    return rows, cols, vals
+    return rows, cols, vals, dists
+
+
+@numba.njit(parallel=True, cache=True)
+def _search_graph_csr(knn_indices, knn_dists):
+    """The CSR arrays of ``search_graph_csr``, with int64 row pointers."""
+    n_samples = knn_indices.shape[0]
+    n_neighbors = knn_indices.shape[1]
+
+    degrees = np.zeros(n_samples, dtype=np.int64)
+    for i in range(n_samples):
+        for j in range(n_neighbors):
+            k = knn_indices[i, j]
+            if k < 0 or knn_dists[i, j] == 0:
+                continue
+            degrees[i] += 1
+            degrees[k] += 1
+
+    starts = np.zeros(n_samples + 1, dtype=np.int64)
+    starts[1:] = np.cumsum(degrees)
+    edges = np.empty(starts[-1], dtype=np.int32)
+    fill = starts[:-1].copy()
+    for i in range(n_samples):
+        for j in range(n_neighbors):
+            k = knn_indices[i, j]
+            if k < 0 or knn_dists[i, j] == 0:
+                continue
+            edges[fill[i]] = k
+            fill[i] += 1
+            edges[fill[k]] = i
+            fill[k] += 1
+
+    # sort each row and count its distinct neighbors
+    for i in numba.prange(n_samples):
+        row = edges[starts[i] : starts[i + 1]]
+        row.sort()
+        n_unique = 0
+        for j in range(row.shape[0]):
+            if j == 0 or row[j] != row[j - 1]:
+                n_unique += 1
+        degrees[i] = n_unique
+
+    indptr = np.zeros(n_samples + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(degrees)
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    for i in numba.prange(n_samples):
+        pos = indptr[i]
+        for j in range(starts[i], starts[i + 1]):
+            if j == starts[i] or edges[j] != edges[j - 1]:
+                indices[pos] = edges[j]
+                pos += 1
+
+    return indptr, indices
+
+
+def search_graph_csr(knn_indices, knn_dists):
+    """Build the undirected k-nearest neighbor graph searched by ``transform``
+    directly in CSR form. An edge joins two points whenever either one is
+    among the nearest neighbors of the other at a non-zero distance; missing
+    neighbors (index -1) are skipped.
+
+    Parameters
+    ----------
+    knn_indices: array of shape (n_samples, n_neighbors)
+        The indices on the ``n_neighbors`` closest points in the dataset.
+
+    knn_dists: array of shape (n_samples, n_neighbors)
+        The distances to the ``n_neighbors`` closest points in the dataset.
+
+    Returns
+    -------
+    indptr: array of shape (n_samples + 1,)
+        CSR row pointers of the graph, as int32, or as int64 if the graph
+        has more edges than int32 can count.
+
+    indices: array of shape (n_edges,)
+        CSR column indices of the graph, sorted within each row, as int32.
+    """
+    indptr, indices = _search_graph_csr(knn_indices, knn_dists)
+    if indptr[-1] <= np.iinfo(np.int32).max:
+        indptr = indptr.astype(np.int32)
+    return indptr, indices
 
 
 def fuzzy_simplicial_set(
@@ -454,6 +858,8 @@ def fuzzy_simplicial_set(
     set_op_mix_ratio=1.0,
     local_connectivity=1.0,
     verbose=False,
+    return_dists=False,
+    compact=True,
 ):
     """Given a set of data X, a neighborhood size, and a measure of distance
     compute the fuzzy simplicial set (here represented as a fuzzy graph in
@@ -551,12 +957,28 @@ def fuzzy_simplicial_set(
     verbose: bool (optional, default False)
         Whether to report information on the current progress of the algorithm.
 
+    return_dists: bool (optional, default False)
+        Whether to also return the (symmetrized) k-nearest neighbor distances
+        along the edges of the fuzzy simplicial set.
+
+    compact: bool (optional, default True)
+        Whether to store the fuzzy simplicial set with 32-bit indices and
+        float32 membership strengths, which halves the memory used by the
+        graph and by the optimization state derived from it. Graphs with
+        more than 2**31 - 1 edges keep 64-bit indices. Otherwise the graph
+        is stored with 64-bit indices and values.
+
     Returns
     -------
     fuzzy_simplicial_set: coo_matrix
         A fuzzy simplicial set represented as a sparse matrix. The (i,
         j) entry of the matrix represents the membership strength of the
         1-simplex between the ith and jth sample points.
+
+    dists: csr_matrix (only if ``return_dists`` is True)
+        The distance between the ith and jth sample points for each edge
+        of the fuzzy simplicial set, symmetrized by taking the maximum.
+        Zero distances are not stored.
     """
     if knn_indices is None or knn_dists is None:
         knn_indices, knn_dists, _ = nearest_neighbors(
@@ -575,15 +997,26 @@ def fuzzy_simplicial_set(
         local_connectivity=local_connectivity,
     )
 
-    rows, cols, vals = compute_membership_strengths(
-        knn_indices, knn_dists, sigmas, rhos
+    rows, cols, vals, dists = compute_membership_strengths(
+        knn_indices, knn_dists, sigmas, rhos, return_dists
     )
 
+    if not compact:
+        rows = rows.astype(np.int64)
+        cols = cols.astype(np.int64)
+        vals = vals.astype(np.float64)
+
     result = scipy.sparse.coo_matrix(
         (vals, (rows, cols)), shape=(X.shape[0], X.shape[0])
     )
     result.eliminate_zeros()
 
+    if return_dists:
+        dmat = scipy.sparse.coo_matrix(
+            (dists, (rows, cols)), shape=(X.shape[0], X.shape[0])
+        ).tocsr()
+        dmat = dmat.maximum(dmat.transpose()).tocsr()
+
     transpose = result.transpose()
 
     prod_matrix = result.multiply(transpose)
@@ -595,11 +1028,193 @@ def fuzzy_simplicial_set(
     )
 
     result.eliminate_zeros()
+    if compact:
+        result = result.astype(np.float32, copy=False)
+        # As in search_graph_csr, the index arrays stay int64 when the
+        # graph has more edges than int32 can count
+        if result.indptr[-1] <= np.iinfo(np.int32).max:
+            result.indptr = result.indptr.astype(np.int32, copy=False)
+            result.indices = result.indices.astype(np.int32, copy=False)
+
+    if return_dists:
+        return result, dmat
+    else:
+        return result
 
-    return result
+
+def _knn_edge_squared_lengths(knn_indices, knn_dists, head, tail):
+    """Squared length of every edge ``(head[i], tail[i])`` of a graph, read
+    from the k-nearest neighbor distances of either endpoint."""
+    n_samples = knn_indices.shape[0]
+    valid = knn_indices >= 0
+    rows = np.repeat(np.arange(n_samples), knn_indices.shape[1])[valid.ravel()]
+    knn_graph = scipy.sparse.csr_matrix(
+        (knn_dists[valid], (rows, knn_indices[valid])), shape=(n_samples, n_samples)
+    )
+    knn_graph.sort_indices()
+
+    dists = csr_edge_lookup(
+        knn_graph.indptr, knn_graph.indices, knn_graph.data, head, tail
+    )
+    missing = dists < 0.0
+    dists[missing] = csr_edge_lookup(
+        knn_graph.indptr,
+        knn_graph.indices,
+        knn_graph.data,
+        tail[missing],
+        head[missing],
+    )
+    if np.any(dists < 0.0):
+        raise ValueError(
+            "graph has edges between points that are not nearest neighbors "
+            "of one another; pass the data instead of its nearest neighbors"
+        )
+    return dists * dists
+
+
+def local_radius(
+    X_or_knn,
+    graph=None,
+    n_neighbors=30,
+    metric="euclidean",
+    metric_kwds=None,
+    logdist_shift=0.0,
+    set_op_mix_ratio=1.0,
+    local_connectivity=1.0,
+    random_state=None,
+    n_jobs=None,
+    verbose=False,
+):
+    """Compute the log local radius of every point of a data set or of an
+    embedding, as densMAP does for the original data (``ro``) and for its
+    embedding (``re``). The embedding does not need to come from densMAP:
+    this can as well evaluate how UMAP or t-SNE preserve the local
+    densities.
+
+    The local radius of a point is the membership weighted average of the
+    squared lengths of the edges of the fuzzy simplicial set incident to it.
+
+    Parameters
+    ----------
+    X_or_knn: array of shape (n_samples, n_features) or tuple
+        The points, or a tuple ``(knn_indices, knn_dists)`` of their nearest
+        neighbors, as returned by ``nearest_neighbors``.
+
+    graph: sparse matrix of shape (n_samples, n_samples) (optional)
+        The fuzzy simplicial set to average over, such as the ``graph_`` of
+        a fitted densMAP model. By default it is built from the nearest
+        neighbors of the points. Its edges are measured in ``X``, in
+        euclidean distance whatever the metric (as densMAP measures ``ro``),
+        or read from the given nearest neighbor distances.
+
+    n_neighbors: int (optional, default 30)
+        The number of nearest neighbors to search for when ``X`` is given.
+
+    metric: string or function (optional, default 'euclidean')
+        The metric of the nearest neighbor search, as for densMAP.
+
+    metric_kwds: dict (optional, default None)
+        Arguments to pass to the metric.
+
+    logdist_shift: float (optional, default 0)
+        Constant added to the local radii before taking the log.
+
+    set_op_mix_ratio: float (optional, default 1.0)
+        Interpolation between the union and the intersection of the local
+        fuzzy simplicial sets, as for densMAP.
+
+    local_connectivity: int (optional, default 1)
+        The local connectivity required, as for densMAP.
+
+    random_state: int, RandomState instance or None (optional, default None)
+        The random state of the nearest neighbor search.
+
+    n_jobs: int (optional, default None)
+        The number of blocks of the nearest neighbor descent, as for
+        densMAP.
+
+    verbose: bool (optional, default False)
+        Whether to report on the progress.
+
+    Returns
+    -------
+    radius: array of shape (n_samples,)
+        The log local radius of each point.
+    """
+    wait_for_warmup()
+    random_state = check_random_state(random_state)
+    if metric_kwds is None:
+        metric_kwds = {}
+
+    if isinstance(X_or_knn, tuple):
+        X = None
+        knn_indices, knn_dists = X_or_knn
+        n_samples = knn_indices.shape[0]
+    else:
+        X = check_input_array(X_or_knn)
+        n_samples = X.shape[0]
+
+    graph_dists = None
+    if graph is None:
+        if X is not None:
+            n_neighbors = min(n_neighbors, n_samples - 1)
+            if (
+                not scipy.sparse.issparse(X)
+                and metric in ("euclidean", "l2")
+                and X.shape[1] <= GRID_KNN_MAX_DIM
+            ):
+                knn_indices, knn_dists = exact_nearest_neighbors(X, n_neighbors)
+            else:
+                knn_indices, knn_dists, _ = nearest_neighbors(
+                    X,
+                    n_neighbors,
+                    metric,
+                    metric_kwds,
+                    False,
+                    random_state,
+                    verbose,
+                    n_jobs=n_jobs,
+                )
+
+        # Only the number of rows of the first argument is used when the
+        # nearest neighbors are given
+        graph, graph_dists = fuzzy_simplicial_set(
+            knn_indices if X is None else X,
+            knn_indices.shape[1],
+            random_state,
+            metric,
+            metric_kwds,
+            knn_indices,
+            knn_dists,
+            False,
+            set_op_mix_ratio,
+            local_connectivity,
+            verbose,
+            return_dists=True,
+        )
+
+    graph = graph.tocoo(copy=True)
+    graph.sum_duplicates()
+    graph.eliminate_zeros()
+    head = graph.row
+    tail = graph.col
+    if X is None:
+        sq_dists = _knn_edge_squared_lengths(knn_indices, knn_dists, head, tail)
+    else:
+        # As for ro, the edges are measured in euclidean distance
+        if metric not in ("euclidean", "l2", "precomputed"):
+            graph_dists = None
+        sq_dists = graph_edge_squared_lengths(
+            X, head, tail, graph_dists, metric == "precomputed"
+        )
+
+    radius, _ = edge_local_radius(
+        head, tail, graph.data, sq_dists, n_samples, logdist_shift
+    )
+    return radius
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def fast_intersection(
     rows,
     cols,
@@ -667,6 +1282,8 @@ def reset_local_connectivity(simplicial_set):
         The recalculated simplicial set, now with the local connectivity
         assumption restored.
     """
+    from sklearn.preprocessing import normalize
+
     simplicial_set = normalize(simplicial_set, norm="max")
     transpose = simplicial_set.transpose()
     prod_matrix = simplicial_set.multiply(transpose)
@@ -761,10 +1378,15 @@ def make_epochs_per_sample(weights, n_epochs):
 
     Returns
     -------
-    An array of number of epochs per sample, one for each 1-simplex.
+    An array of number of epochs per sample, one for each 1-simplex. It is
+    float32 if ``weights`` is, and float64 otherwise.
     """
+    if weights.dtype == np.float32:
+        dtype = np.float32
+    else:
+        dtype = np.float64
     result = -1.0 * np.ones(
-        weights.shape[0], dtype=np.float64
+        weights.shape[0], dtype=dtype
     )
     n_samples = n_epochs * (weights / weights.max())
     result[n_samples > 0] = (
@@ -773,7 +1395,7 @@ def make_epochs_per_sample(weights, n_epochs):
     return result
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def clip(val, bound=4.0):
     """Standard clamping of a value into a fixed range (in this case -4.0 to
     4.0)
@@ -795,7 +1417,7 @@ def clip(val, bound=4.0):
         return val
 
 
-@numba.njit("f4(f4[:],f4[:])", fastmath=True)
+@numba.njit(fastmath=True, cache=True)
 def rdist(x, y):
     """Reduced Euclidean distance.
 
@@ -812,10 +1434,360 @@ def rdist(x, y):
     for i in range(x.shape[0]):
         result += (x[i] - y[i]) ** 2
 
-    return result
+    return np.float32(result)
+
+
+@numba.njit(cache=True)
+def _fill_incident_edges(head, tail, indptr, edges):
+    """Counting sort of the edge endpoints for ``_incident_edges``."""
+    n_vertices = indptr.shape[0] - 1
+    for i in range(head.shape[0]):
+        indptr[head[i] + 1] += 1
+        indptr[tail[i] + 1] += 1
+    for j in range(n_vertices):
+        indptr[j + 1] += indptr[j]
+
+    position = indptr[:-1].copy()
+    for i in range(head.shape[0]):
+        edges[position[head[i]]] = i
+        position[head[i]] += 1
+        edges[position[tail[i]]] = i
+        position[tail[i]] += 1
+
+
+def _incident_edges(head, tail, n_vertices):
+    """Index the edges incident to each vertex of a graph, so that
+    ``edges[indptr[j]:indptr[j + 1]]`` are the edges with ``j`` as their
+    head or tail (a loop is listed twice). The index takes ``n_vertices + 1``
+    64-bit and ``2 * n_edges`` 32-bit integers (64-bit if the edge count
+    overflows int32).
+    """
+    n_edges = head.shape[0]
+    if n_edges <= np.iinfo(np.int32).max:
+        index_dtype = np.int32
+    else:
+        index_dtype = np.int64
+    indptr = np.zeros(n_vertices + 1, dtype=np.int64)
+    edges = np.empty(2 * n_edges, dtype=index_dtype)
+    _fill_incident_edges(head, tail, indptr, edges)
+    return indptr, edges
+
+
+def _optimize_layout_density_stats(
+    head_embedding,
+    tail_embedding,
+    head,
+    tail,
+    a,
+    b,
+    R,
+    logdist_shift,
+    var_shift,
+    incident_indptr,
+    incident_edges,
+    phi_edge,
+    re_edge,
+    phi_sum,
+    re_sum,
+):
+    """Compute the aggregate terms of the density preservation gradient for
+    the current embedding. The total low dimensional membership of each
+    vertex is written to ``phi_sum`` and its log local radius in the
+    embedding to ``re_sum``; the mean, (shifted) standard deviation and
+    covariance with the standardized original local radii ``R`` of the
+    latter are returned.
+
+    The terms of each edge are first written to ``phi_edge`` and
+    ``re_edge``, and then summed at each vertex over the edges incident to
+    it (as indexed by ``_incident_edges``). Both passes write every location
+    once, so they can run concurrently without per-thread copies of the
+    vertex sums, and each costs O(n_edges) whatever the number of threads.
+    """
+    n_vertices = phi_sum.shape[0]
+    n_edges = head.shape[0]
+
+    for i in numba.prange(n_edges):
+        dist_squared = rdist(head_embedding[head[i]], tail_embedding[tail[i]])
+        phi = 1.0 / (1.0 + a * pow(dist_squared, b))
+        phi_edge[i] = phi
+        re_edge[i] = phi * dist_squared
+
+    for j in numba.prange(n_vertices):
+        phi = 0.0
+        re = 0.0
+        for e in range(incident_indptr[j], incident_indptr[j + 1]):
+            i = incident_edges[e]
+            phi += phi_edge[i]
+            re += re_edge[i]
+        phi_sum[j] = phi
+        re_sum[j] = np.log(logdist_shift + (re / phi))
+
+    re_mean = 0.0
+    for j in numba.prange(n_vertices):
+        re_mean += re_sum[j]
+    re_mean /= n_vertices
+
+    re_var = 0.0
+    re_dot = 0.0
+    for j in numba.prange(n_vertices):
+        re_var += (re_sum[j] - re_mean) * (re_sum[j] - re_mean)
+        re_dot += re_sum[j] * R[j]
+
+    re_std = np.sqrt(re_var / n_vertices + var_shift)
+    re_cov = re_dot / (n_vertices - 1)
+
+    return re_mean, re_std, re_cov
+
+
+@numba.njit(fastmath=True, cache=True)
+def _sample_density_corr(
+    head_embedding,
+    tail_embedding,
+    head,
+    tail,
+    edges,
+    sample_index,
+    a,
+    b,
+    R_sample,
+    logdist_shift,
+):
+    """Pearson correlation between the log local radii in the embedding of
+    a sample of vertices and their original radii ``R_sample``. The radii
+    are accumulated over the ``edges`` incident to a sampled vertex, given
+    by its position ``sample_index`` in the sample (-1 if not sampled)."""
+    n_sample = R_sample.shape[0]
+    phi_sum = np.zeros(n_sample)
+    re_sum = np.zeros(n_sample)
+    for e in edges:
+        j = head[e]
+        k = tail[e]
+        dist_squared = rdist(head_embedding[j], tail_embedding[k])
+        phi = 1.0 / (1.0 + a * pow(dist_squared, b))
+        if sample_index[j] >= 0:
+            phi_sum[sample_index[j]] += phi
+            re_sum[sample_index[j]] += phi * dist_squared
+        if sample_index[k] >= 0:
+            phi_sum[sample_index[k]] += phi
+            re_sum[sample_index[k]] += phi * dist_squared
+
+    count = 0
+    re_mean = 0.0
+    r_mean = 0.0
+    for i in range(n_sample):
+        if phi_sum[i] > 0.0:
+            re_sum[i] = np.log(logdist_shift + re_sum[i] / phi_sum[i])
+            re_mean += re_sum[i]
+            r_mean += R_sample[i]
+            count += 1
+    if count < 2:
+        return 0.0
+    re_mean /= count
+    r_mean /= count
+
+    cov = 0.0
+    re_var = 0.0
+    r_var = 0.0
+    for i in range(n_sample):
+        if phi_sum[i] > 0.0:
+            cov += (re_sum[i] - re_mean) * (R_sample[i] - r_mean)
+            re_var += (re_sum[i] - re_mean) ** 2
+            r_var += (R_sample[i] - r_mean) ** 2
+    if re_var == 0.0 or r_var == 0.0:
+        return 0.0
+    return cov / np.sqrt(re_var * r_var)
+
+
+def _jit_variant(func, name, **options):
+    """Compile a copy of ``func`` named ``name`` with the given numba
+    options, cached on disk. Numba keys its on-disk cache on the function
+    and the argument types only, so every variant of a function compiled
+    with different options needs a name of its own."""
+    variant = types.FunctionType(
+        func.__code__, func.__globals__, name, func.__defaults__, func.__closure__
+    )
+    variant.__qualname__ = name
+    variant.__doc__ = func.__doc__
+    return numba.njit(cache=True, **options)(variant)
+
+
+_optimize_layout_parallel_density_stats = _jit_variant(
+    _optimize_layout_density_stats,
+    "_optimize_layout_parallel_density_stats",
+    fastmath=True,
+    parallel=True,
+)
+_optimize_layout_serial_density_stats = _jit_variant(
+    _optimize_layout_density_stats,
+    "_optimize_layout_serial_density_stats",
+    fastmath=True,
+)
+
+
+def _optimize_layout_epoch(
+    head_embedding,
+    tail_embedding,
+    head,
+    tail,
+    mu,
+    mu_tot,
+    R,
+    n_vertices,
+    epochs_per_sample,
+    epochs_per_negative_sample,
+    epoch_of_next_sample,
+    epoch_of_next_negative_sample,
+    a,
+    b,
+    rng_states,
+    gamma,
+    alpha,
+    move_other,
+    n,
+    dens_lambda,
+    dens_activation,
+    phi_sum,
+    re_sum,
+    re_mean,
+    re_std,
+    re_cov,
+):
+    """Perform a single epoch of stochastic gradient descent over the
+    1-simplices. The edges are split into one contiguous block per row of
+    ``rng_states``; each block is processed sequentially with its own random
+    state, and the blocks are processed concurrently (when compiled with
+    ``parallel=True``) with lock-free, Hogwild style updates of the shared
+    embedding.
+    """
+    dim = head_embedding.shape[1]
+    n_edges = epochs_per_sample.shape[0]
+    n_blocks = rng_states.shape[0]
+    block_size = (n_edges + n_blocks - 1) // n_blocks
+    dens_active = dens_lambda > 0 and dens_activation > 0.02
+
+    for block in numba.prange(n_blocks):
+        rng_state = rng_states[block]
+        for i in range(
+            block * block_size, min((block + 1) * block_size, n_edges)
+        ):
+            if epoch_of_next_sample[i] > n:
+                continue
+
+            j = head[i]
+            k = tail[i]
+
+            current = head_embedding[j]
+            other = tail_embedding[k]
+
+            dist_squared = rdist(current, other)
+
+            grad_cor_coeff = 0.0
+            if dens_active and dist_squared > 0.0:
+
+                phi = 1.0 / (1.0 + a * pow(dist_squared, b))
+                dphi_term = (
+                    a
+                    * b
+                    * pow(dist_squared, b - 1)
+                    / (1.0 + a * pow(dist_squared, b))
+                )
+
+                q_jk = phi / phi_sum[k]
+                q_kj = phi / phi_sum[j]
+
+                drk = q_jk * (
+                    (1.0 - b * (1 - phi)) / np.exp(re_sum[k]) + dphi_term
+                )
+                drj = q_kj * (
+                    (1.0 - b * (1 - phi)) / np.exp(re_sum[j]) + dphi_term
+                )
+
+                weight_k = R[k] - re_cov * (re_sum[k] - re_mean) / (
+                    re_std * re_std
+                )
+                weight_j = R[j] - re_cov * (re_sum[j] - re_mean) / (
+                    re_std * re_std
+                )
+
+                grad_cor_coeff = (
+                    dens_lambda
+                    * mu_tot
+                    * (weight_k * drk + weight_j * drj)
+                    / (mu[i] * re_std)
+                    / n_vertices
+                )
+
+            if dist_squared > 0.0:
+                grad_coeff = -2.0 * a * b * pow(dist_squared, b - 1.0)
+                grad_coeff /= a * pow(dist_squared, b) + 1.0
+            else:
+                grad_coeff = 0.0
+
+            for d in range(dim):
+                grad_d = clip(grad_coeff * (current[d] - other[d]))
+
+                ## densmap
+                if dens_active:
+                    grad_d += clip(
+                        2
+                        * dens_activation
+                        * grad_cor_coeff
+                        * (current[d] - other[d]),
+                        bound=4.0,
+                    )
+                ##
+
+                current[d] += grad_d * alpha
+                if move_other:
+                    other[d] += -grad_d * alpha
+
+            epoch_of_next_sample[i] += epochs_per_sample[i]
+
+            n_neg_samples = int(
+                (n - epoch_of_next_negative_sample[i])
+                / epochs_per_negative_sample[i]
+            )
+
+            for p in range(n_neg_samples):
+                k = tau_rand_int(rng_state) % n_vertices
+
+                other = tail_embedding[k]
+
+                dist_squared = rdist(current, other)
+
+                if dist_squared > 0.0:
+                    grad_coeff = 2.0 * gamma * b
+                    grad_coeff /= (0.001 + dist_squared) * (
+                        a * pow(dist_squared, b) + 1
+                    )
+                elif j == k:
+                    continue
+                else:
+                    grad_coeff = 0.0
+
+                for d in range(dim):
+                    if grad_coeff > 0.0:
+                        grad_d = clip(grad_coeff * (current[d] - other[d]))
+                    else:
+                        grad_d = 4.0
+                    current[d] += grad_d * alpha
+
+            epoch_of_next_negative_sample[i] += (
+                n_neg_samples * epochs_per_negative_sample[i]
+            )
+
+
+_optimize_layout_parallel_epoch = _jit_variant(
+    _optimize_layout_epoch,
+    "_optimize_layout_parallel_epoch",
+    fastmath=True,
+    parallel=True,
+)
+_optimize_layout_serial_epoch = _jit_variant(
+    _optimize_layout_epoch, "_optimize_layout_serial_epoch", fastmath=True
+)
 
 
-@numba.njit(fastmath=True, parallel=True)
 def optimize_layout(
     head_embedding,
     tail_embedding,
@@ -839,6 +1811,16 @@ def optimize_layout(
     dens_lambda=0,
     logdist_shift=0.0001,
     var_shift=0.1,
+    deterministic=False,
+    dens_refresh=1,
+    move_other=None,
+    workspace=None,
+    profile=None,
+    callback=None,
+    callback_every=10,
+    snapshots=None,
+    snapshot_every=10,
+    vertex_order=None,
 ):
     """Improve an embedding using stochastic gradient descent to minimize the
     fuzzy set cross entropy between the 1-skeletons of the high dimensional
@@ -863,6 +1845,17 @@ def optimize_layout(
     tail: array of shape (n_1_simplices)
         The indices of the tails of 1-simplices with non-zero membership.
 
+    mu: array of shape (n_1_simplices)
+        The membership strength of each 1-simplex.
+
+    mu_sum: array of shape (n_vertices)
+        The total membership strength of the 1-simplices incident to each
+        vertex.
+
+    R: array of shape (n_vertices)
+        The standardized log local radius of each vertex in the original
+        space.
+
     n_epochs: int
         The number of training epochs to use in optimization.
 
@@ -894,163 +1887,267 @@ def optimize_layout(
     verbose: bool (optional, default False)
         Whether to report information on the current progress of the algorithm.
 
+    dens_frac: float (optional, default 0)
+        The fraction of the epochs (at the end) during which the density
+        preservation term is active.
+
+    dens_lambda: float (optional, default 0)
+        The weight of the density preservation term.
+
+    logdist_shift: float (optional, default 0.0001)
+        Constant added to the local radii before taking the log.
+
+    var_shift: float (optional, default 0.1)
+        Regularization added to the variance of the embedded local radii.
+
+    deterministic: bool (optional, default False)
+        Whether to run the epochs on a single thread so that the result only
+        depends on ``rng_state``. By default the edges are split into one
+        block per thread, each with its own random state derived from
+        ``rng_state``, and the blocks update the embedding concurrently
+        without locking. Graphs with fewer than ``PARALLEL_LAYOUT_MIN_EDGES``
+        edges are always optimized on a single thread.
+
+    dens_refresh: int (optional, default 1)
+        The number of epochs between recomputations of the density aggregate
+        terms (the local radii of the embedding and their statistics) while
+        the density preservation term is active. In between, the gradient
+        uses the terms from the last recomputation.
+
+    move_other: bool or None (optional, default None)
+        Whether to also move the tail of each sampled edge. If None, the tails
+        are moved if ``head_embedding`` and ``tail_embedding`` have the same
+        number of points, i.e. when they are the same embedding.
+
+    workspace: LayoutWorkspace or None (optional, default None)
+        Preallocated arrays, at least as long as ``epochs_per_sample`` and of
+        the same dtype, in which to keep the per edge state of the
+        optimization instead of allocating it.
+
+    profile: FitProfile or None (optional, default None)
+        The report to record the epochs in, as two stages: the epochs before
+        the density preservation term is active ('optimize_layout') and
+        those during which it is ('optimize_layout_density').
+
+    callback: function or None (optional, default None)
+        Called as ``callback(epoch, elapsed, embedding, density_corr)``
+        every ``callback_every`` epochs and after the last one, with the
+        number of epochs completed, the seconds elapsed since the
+        optimization started, the current embedding (in ``vertex_order``)
+        and an estimate of the correlation between the log local radii of
+        the embedding and ``R``, over ``CALLBACK_DENSITY_SAMPLE`` evenly
+        spaced vertices. The embedding may be the array being optimized,
+        and must be copied to be kept. If the callback returns True, the
+        optimization stops there.
+
+    callback_every: int (optional, default 10)
+        The number of epochs between calls to ``callback``.
+
+    snapshots: array of shape (n_snapshots, n_samples, n_components) or None
+        (optional, default None)
+        An array, such as an ``np.memmap``, to copy the embedding into every
+        ``snapshot_every`` epochs: snapshot ``i`` is the embedding after
+        ``(i + 1) * snapshot_every`` epochs.
+
+    snapshot_every: int (optional, default 10)
+        The number of epochs between snapshots.
+
+    vertex_order: array of shape (n_samples,) or None (optional)
+        The row of ``head_embedding`` to give as each row of the embedding
+        to ``callback`` and of the snapshots, if they are to be in another
+        order.
+
     Returns
     -------
     embedding: array of shape (n_samples, n_components)
         The optimized embedding.
     """
+    if profile is None:
+        profile = FitProfile()
 
-    dim = head_embedding.shape[1]
-    move_other = (
-        head_embedding.shape[0] == tail_embedding.shape[0]
-    )
+    if move_other is None:
+        move_other = (
+            head_embedding.shape[0] == tail_embedding.shape[0]
+        )
     alpha = initial_alpha
 
-    epochs_per_negative_sample = (
-        epochs_per_sample / negative_sample_rate
-    )
-    epoch_of_next_negative_sample = (
-        epochs_per_negative_sample.copy()
-    )
-    epoch_of_next_sample = epochs_per_sample.copy()
-    
-    for n in range(n_epochs):
-
-        #dens_activation = 1.0 / (1.0 + np.exp(-(n/float(n_epochs) - 0.7)/0.025))
-        dens_activation = 1 if (n+1.0)/float(n_epochs) > (1 - dens_frac) else 0
-
-        if dens_lambda > 0 and dens_activation > 0.02:
-            # Compute aggregate terms
-            phi_sum = np.zeros(n_vertices, dtype=np.float32)
-            re_sum = np.zeros(n_vertices, dtype=np.float32)
-
-            for i in range(epochs_per_sample.shape[0]):
-                j = head[i]
-                k = tail[i]
-                current = head_embedding[j]
-                other = tail_embedding[k]
-                dist_squared = rdist(current, other)
-
-                phi = 1.0 / (1.0 + a * pow(dist_squared, b))
-
-                re_sum[j] += phi * dist_squared
-                re_sum[k] += phi * dist_squared
-                phi_sum[j] += phi
-                phi_sum[k] += phi
-
-            re_sum = np.log(np.float32(logdist_shift) + (re_sum / phi_sum))
-            re_std = np.sqrt(np.var(re_sum) + var_shift)
-            re_mean = np.mean(re_sum)
-            re_cov = np.dot(re_sum, R) / (n_vertices - 1)
-
-        mu_tot = np.sum(mu_sum) / 2
-
-        for i in range(epochs_per_sample.shape[0]):
-            if epoch_of_next_sample[i] <= n:
-                j = head[i]
-                k = tail[i]
-
-                current = head_embedding[j]
-                other = tail_embedding[k]
-
-                dist_squared = rdist(current, other)
-
-                if dens_lambda > 0 and dens_activation > 0.02:
-
-                    phi = 1.0 / (1.0 + a * pow(dist_squared, b))
-                    dphi_term = a * b * pow(dist_squared, b-1) / (1.0 + a * pow(dist_squared, b))
-
-                    q_jk = phi / phi_sum[k]
-                    q_kj = phi / phi_sum[j]
-
-                    drk = q_jk * ((1.0 - b * (1 - phi)) / np.exp(re_sum[k]) + dphi_term)
-                    drj = q_kj * ((1.0 - b * (1 - phi)) / np.exp(re_sum[j]) + dphi_term)
-
-                    weight_k = R[k] - re_cov * (re_sum[k] - re_mean) / (re_std * re_std)
-                    weight_j = R[j] - re_cov * (re_sum[j] - re_mean) / (re_std * re_std)
-
-                    grad_cor_coeff = dens_lambda * mu_tot * (weight_k * drk + weight_j * drj) / (mu[i] * re_std) / n_vertices
-
-                if dist_squared > 0.0:
-                    grad_coeff = (
-                        -2.0
-                        * a
-                        * b
-                        * pow(dist_squared, b - 1.0)
-                    )
-                    grad_coeff /= (
-                        a * pow(dist_squared, b) + 1.0
-                    )
-                else:
-                    grad_coeff = 0.0
-
-                for d in range(dim):
-                    grad_d = clip(
-                        grad_coeff * (current[d] - other[d])
-                    )
-
-                    ## densmap
-                    if dens_lambda > 0 and dens_activation > 0.02:
-                        grad_d += clip(
-                            2 * dens_activation * grad_cor_coeff * (current[d] - other[d]),
-                            bound=4.0
-                        )
-                    ##
-
-                    current[d] += grad_d * alpha
-                    if move_other:
-                        other[d] += -grad_d * alpha
+    n_edges = epochs_per_sample.shape[0]
+    if workspace is None:
+        epochs_per_negative_sample = (
+            epochs_per_sample / negative_sample_rate
+        )
+        epoch_of_next_negative_sample = (
+            epochs_per_negative_sample.copy()
+        )
+        epoch_of_next_sample = epochs_per_sample.copy()
+    else:
+        epochs_per_negative_sample = workspace.epochs_per_negative_sample[:n_edges]
+        np.divide(
+            epochs_per_sample,
+            negative_sample_rate,
+            out=epochs_per_negative_sample,
+        )
+        epoch_of_next_negative_sample = workspace.epoch_of_next_negative_sample[
+            :n_edges
+        ]
+        epoch_of_next_negative_sample[:] = epochs_per_negative_sample
+        epoch_of_next_sample = workspace.epoch_of_next_sample[:n_edges]
+        epoch_of_next_sample[:] = epochs_per_sample
+
+    if deterministic or n_edges < PARALLEL_LAYOUT_MIN_EDGES:
+        optimize_epoch = _optimize_layout_serial_epoch
+        density_stats = _optimize_layout_serial_density_stats
+        n_blocks = 1
+        rng_states = rng_state.reshape(1, 3)
+    else:
+        optimize_epoch = _optimize_layout_parallel_epoch
+        density_stats = _optimize_layout_parallel_density_stats
+        n_blocks = numba.config.NUMBA_NUM_THREADS
+        rng_states = np.empty((n_blocks, 3), dtype=np.int64)
+        for block in range(n_blocks):
+            for c in range(3):
+                rng_states[block, c] = tau_rand_int(rng_state)
+
+    mu_tot = np.sum(mu_sum) / 2
+
+    # Buffers for the density aggregate terms are allocated once, and only
+    # if the density term is ever active: the incident edge index and two
+    # float32 values per edge, i.e. 16 bytes per edge (and 8 per vertex)
+    if dens_lambda > 0 and dens_frac > 0:
+        incident_indptr, incident_edges = _incident_edges(
+            head, tail, n_vertices
+        )
+        phi_edge = np.zeros(n_edges, dtype=np.float32)
+        re_edge = np.zeros(n_edges, dtype=np.float32)
+        phi_sum = np.zeros(n_vertices, dtype=np.float32)
+        re_sum = np.zeros(n_vertices, dtype=np.float32)
+    else:
+        phi_sum = np.zeros(1, dtype=np.float32)
+        re_sum = np.zeros(1, dtype=np.float32)
+    re_mean = re_std = re_cov = 0.0
+    dens_epoch = 0
+
+    if callback is not None:
+        # Evenly spaced vertices, so as not to draw from rng_state; when the
+        # vertices are ordered along a space-filling curve these are spread
+        # over the whole embedding
+        sample = np.arange(
+            0, n_vertices, max(1, n_vertices // CALLBACK_DENSITY_SAMPLE)
+        )
+        sample_index = np.full(n_vertices, -1, dtype=np.int64)
+        sample_index[sample] = np.arange(sample.shape[0])
+        sample_edges = np.flatnonzero(
+            (sample_index[head] >= 0) | (sample_index[tail] >= 0)
+        )
+        R_sample = R[sample].astype(np.float64)
+    start = time.perf_counter()
 
-                epoch_of_next_sample[
-                    i
-                ] += epochs_per_sample[i]
+    phase = profile.begin("optimize_layout", n_epochs=0)
+    for n in range(n_epochs):
 
-                n_neg_samples = int(
-                    (n - epoch_of_next_negative_sample[i])
-                    / epochs_per_negative_sample[i]
-                )
+        #dens_activation = 1.0 / (1.0 + np.exp(-(n/float(n_epochs) - 0.7)/0.025))
+        dens_activation = 1 if (n+1.0)/float(n_epochs) > (1 - dens_frac) else 0
 
-                for p in range(n_neg_samples):
-                    k = tau_rand_int(rng_state) % n_vertices
+        if dens_activation and phase["name"] == "optimize_layout":
+            profile.end(phase)
+            phase = profile.begin("optimize_layout_density", n_epochs=0)
+        phase["n_epochs"] += 1
 
-                    other = tail_embedding[k]
+        if dens_lambda > 0 and dens_activation > 0.02:
+            dens_epoch += 1
 
-                    dist_squared = rdist(current, other)
+        if dens_lambda > 0 and dens_activation > 0.02 and (
+            (dens_epoch - 1) % dens_refresh == 0
+        ):
+            # Compute aggregate terms
+            re_mean, re_std, re_cov = density_stats(
+                head_embedding,
+                tail_embedding,
+                head,
+                tail,
+                a,
+                b,
+                R,
+                np.float32(logdist_shift),
+                float(var_shift),
+                incident_indptr,
+                incident_edges,
+                phi_edge,
+                re_edge,
+                phi_sum,
+                re_sum,
+            )
 
-                    if dist_squared > 0.0:
-                        grad_coeff = 2.0 * gamma * b
-                        grad_coeff /= (
-                            0.001 + dist_squared
-                        ) * (a * pow(dist_squared, b) + 1)
-                    elif j == k:
-                        continue
-                    else:
-                        grad_coeff = 0.0
-
-                    for d in range(dim):
-                        if grad_coeff > 0.0:
-                            grad_d = clip(
-                                grad_coeff
-                                * (current[d] - other[d])
-                            )
-                        else:
-                            grad_d = 4.0
-                        current[d] += grad_d * alpha
-
-                epoch_of_next_negative_sample[i] += (
-                    n_neg_samples
-                    * epochs_per_negative_sample[i]
-                )
+        optimize_epoch(
+            head_embedding,
+            tail_embedding,
+            head,
+            tail,
+            mu,
+            mu_tot,
+            R,
+            n_vertices,
+            epochs_per_sample,
+            epochs_per_negative_sample,
+            epoch_of_next_sample,
+            epoch_of_next_negative_sample,
+            a,
+            b,
+            rng_states,
+            gamma,
+            alpha,
+            move_other,
+            n,
+            float(dens_lambda),
+            float(dens_activation),
+            phi_sum,
+            re_sum,
+            re_mean,
+            re_std,
+            re_cov,
+        )
 
         alpha = initial_alpha * (
             1.0 - (float(n) / float(n_epochs))
         )
 
-        if verbose and n % int(n_epochs / 10) == 0:
+        if verbose and n % max(1, int(n_epochs / 10)) == 0:
             print(
                 "\tcompleted ", n, " / ", n_epochs, "epochs"
             )
 
+        if snapshots is not None and (n + 1) % snapshot_every == 0:
+            snapshot = (n + 1) // snapshot_every - 1
+            if snapshot < snapshots.shape[0]:
+                if vertex_order is None:
+                    snapshots[snapshot] = head_embedding
+                else:
+                    snapshots[snapshot] = head_embedding[vertex_order]
+
+        if callback is not None and (
+            (n + 1) % callback_every == 0 or n + 1 == n_epochs
+        ):
+            density_corr = _sample_density_corr(
+                head_embedding,
+                tail_embedding,
+                head,
+                tail,
+                sample_edges,
+                sample_index,
+                a,
+                b,
+                R_sample,
+                float(logdist_shift),
+            )
+            if vertex_order is None:
+                embedding = head_embedding
+            else:
+                embedding = head_embedding[vertex_order]
+            if callback(n + 1, time.perf_counter() - start, embedding, density_corr):
+                phase["stopped"] = True
+                break
+    profile.end(phase)
+
     return head_embedding
 
 
@@ -1074,6 +2171,15 @@ def simplicial_set_embedding(
     dens_lambda,
     logdist_shift,
     var_shift,
+    graph_dists=None,
+    deterministic=False,
+    dens_refresh=1,
+    reorder_vertices=True,
+    profile=None,
+    callback=None,
+    callback_every=10,
+    snapshot_path=None,
+    snapshot_every=10,
 ):
     """Perform a fuzzy simplicial set embedding, using a specified
     initialisation method and then minimizing the fuzzy set cross entropy
@@ -1137,12 +2243,57 @@ def simplicial_set_embedding(
     verbose: bool (optional, default False)
         Whether to report information on the current progress of the algorithm.
 
+    graph_dists: sparse matrix (optional, default None)
+        The distances along the edges of ``graph`` as returned by
+        ``fuzzy_simplicial_set`` with ``return_dists=True``. If given, and
+        the metric is euclidean (or precomputed), the local radii are
+        computed from these rather than from ``data``. Under other metrics
+        the local radii are measured in euclidean distance in ``data``.
+
+    deterministic: bool (optional, default False)
+        Whether to run the optimization on a single thread so that the
+        result is reproducible for a given ``random_state``.
+
+    dens_refresh: int (optional, default 1)
+        The number of epochs between recomputations of the density
+        aggregate terms during the optimization.
+
+    reorder_vertices: bool (optional, default True)
+        Whether to relabel the vertices along a space-filling curve over the
+        initial embedding, and sort the edges by their head, before the
+        optimization. This makes the memory accesses of the optimization
+        far more local on large graphs; the relabeling is undone on the
+        returned embedding.
+
+    profile: FitProfile or None (optional, default None)
+        The report to record the stages of the embedding in.
+
+    callback: function or None (optional, default None)
+        Called every ``callback_every`` epochs of the optimization, see
+        ``optimize_layout``.
+
+    callback_every: int (optional, default 10)
+        The number of epochs between calls to ``callback``.
+
+    snapshot_path: str or None (optional, default None)
+        A ``.npy`` file to write the embedding to every ``snapshot_every``
+        epochs, as an array of shape (n_epochs // snapshot_every, n_samples,
+        n_components) mapped to memory while it is being written. Snapshots
+        not reached, if the callback stops the optimization, are left at
+        zero.
+
+    snapshot_every: int (optional, default 10)
+        The number of epochs between snapshots; at most ``n_epochs``.
+
     Returns
     -------
     embedding: array of shape (n_samples, n_components)
         The optimized of ``graph`` into an ``n_components`` dimensional
         euclidean space.
     """
+    if profile is None:
+        profile = FitProfile()
+
     graph = graph.tocoo()
     graph.sum_duplicates()
     n_vertices = graph.shape[1]
@@ -1159,6 +2310,20 @@ def simplicial_set_embedding(
     ] = 0.0
     graph.eliminate_zeros()
 
+    snapshots = None
+    if snapshot_path is not None:
+        if snapshot_every > n_epochs:
+            raise ValueError("snapshot_every must not be larger than n_epochs")
+        snapshots = np.lib.format.open_memmap(
+            snapshot_path,
+            mode="w+",
+            dtype=np.float32,
+            shape=(n_epochs // snapshot_every, graph.shape[0], n_components),
+        )
+
+    init_stage = profile.begin(
+        "init", method=init if isinstance(init, str) else "array"
+    )
     if isinstance(init, str) and init == "random":
         embedding = random_state.uniform(
             low=-10.0,
@@ -1191,6 +2356,8 @@ def simplicial_set_embedding(
                 np.unique(init_data, axis=0).shape[0]
                 < init_data.shape[0]
             ):
+                from sklearn.neighbors import KDTree
+
                 tree = KDTree(init_data)
                 dist, ind = tree.query(init_data, k=2)
                 nndist = np.mean(dist[:, 1])
@@ -1200,6 +2367,7 @@ def simplicial_set_embedding(
                 ).astype(np.float32)
             else:
                 embedding = init_data
+    profile.end(init_stage)
 
     epochs_per_sample = make_epochs_per_sample(
         graph.data, n_epochs
@@ -1212,25 +2380,43 @@ def simplicial_set_embedding(
     if verbose:
         print("Computing ro ...")
 
-    mu_sum = np.zeros(n_vertices, dtype=np.float32)
-    ro = np.zeros(n_vertices, dtype=np.float32)
-    for i in range(len(head)):
-        j = head[i]
-        k = tail[i]
-
-        dist_squared = np.sum((data[j] - data[k]) ** 2)
-        mu = graph.data[i]
-
-        ro[j] += mu * dist_squared
-        ro[k] += mu * dist_squared
-        mu_sum[j] += mu
-        mu_sum[k] += mu
-    # print('Problem?')
-    ro = np.log(np.float32(logdist_shift) + (ro / mu_sum))
-    R = (ro - np.mean(ro)) / np.std(ro)
-    # print('Problem!')
+    # The local radii are euclidean, and the k-neighbor distances of other
+    # metrics are not the euclidean lengths of the edges
+    if metric not in ("euclidean", "l2", "precomputed"):
+        graph_dists = None
+    with profile.stage("ro"):
+        ro, mu_sum = edge_local_radius(
+            head,
+            tail,
+            graph.data,
+            graph_edge_squared_lengths(
+                data, head, tail, graph_dists, metric == "precomputed"
+            ),
+            n_vertices,
+            logdist_shift,
+        )
+        R = (ro - np.mean(ro)) / np.std(ro)
 ###########
 
+    weights = graph.data
+    if reorder_vertices:
+        # order[new_label] = old_label and inverse[old_label] = new_label
+        order = space_filling_curve_order(embedding)
+        inverse = np.empty(n_vertices, dtype=head.dtype)
+        inverse[order] = np.arange(n_vertices, dtype=head.dtype)
+
+        head = inverse[head]
+        tail = inverse[tail]
+        edge_order = np.lexsort((tail, head))
+        head = head[edge_order]
+        tail = tail[edge_order]
+        weights = weights[edge_order]
+        epochs_per_sample = epochs_per_sample[edge_order]
+
+        embedding = embedding[order]
+        mu_sum = mu_sum[order]
+        R = R[order]
+
     rng_state = random_state.randint(
         INT32_MIN, INT32_MAX, 3
     ).astype(np.int64)
@@ -1241,7 +2427,7 @@ def simplicial_set_embedding(
         embedding,
         head,
         tail,
-        graph.data,
+        weights,
         mu_sum,
         R,
         n_epochs,
@@ -1259,14 +2445,28 @@ def simplicial_set_embedding(
         dens_lambda=dens_lambda,
         logdist_shift=logdist_shift,
         var_shift=var_shift,
+        deterministic=deterministic,
+        dens_refresh=dens_refresh,
+        profile=profile,
+        callback=callback,
+        callback_every=callback_every,
+        snapshots=snapshots,
+        snapshot_every=snapshot_every,
+        vertex_order=inverse if reorder_vertices else None,
     )
+    if snapshots is not None:
+        snapshots.flush()
+        del snapshots
+
+    if reorder_vertices:
+        embedding = embedding[inverse]
 
 
     ## densmap
     return embedding, ro
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def init_transform(indices, weights, embedding):
     """Given indices and weights and an original embeddings
     initialize the positions of new points relative to the
@@ -1312,6 +2512,8 @@ def find_ab_params(spread, min_dist):
     best matches an offset exponential decay.
     """
 
+    from scipy.optimize import curve_fit
+
     def curve(x, a, b):
         return 1.0 / (1.0 + a * x ** (2 * b))
 
@@ -1491,6 +2693,111 @@ class densMAP(BaseEstimator):
 
     verbose: bool (optional, default False)
         Controls verbosity of logging.
+
+    dens_frac: float (optional, default 0.3)
+        The fraction of epochs (at the end of the optimization) during which
+        the density preservation term is included.
+
+    dens_lambda: float (optional, default 2.0)
+        The weight of the density preservation term. A value of 0.0
+        reduces to UMAP.
+
+    logdist_shift: float (optional, default 0)
+        Constant added to the local radii before taking the log.
+
+    var_shift: float (optional, default 0.1)
+        Regularization added to the variance of the embedded local radii.
+
+    final_dens: bool or 'lazy' (optional, default True)
+        Whether to compute the local radii of the final embedding and return
+        ``(embedding, ro, re)`` rather than just the embedding. With 'lazy',
+        just the embedding is returned and the local radii of the embedding
+        are only computed when ``re_`` is first accessed.
+
+    deterministic: bool (optional, default False)
+        Whether to run the embedding optimization on a single thread. By
+        default the optimization is spread over all numba threads with
+        lock-free updates, which makes the result vary slightly from run to
+        run even with a fixed ``random_state``.
+
+    dens_refresh: int (optional, default 1)
+        The number of epochs between recomputations of the local radii of
+        the embedding and their statistics, which are the main added cost
+        of densMAP over UMAP. Values larger than 1 trade some accuracy of
+        the density preservation gradient for speed.
+
+    reorder_vertices: bool (optional, default True)
+        Whether to relabel the points along a space-filling curve over the
+        initial embedding for the optimization, which improves its memory
+        locality on large data sets. The output is in the original order
+        either way.
+
+    knn_cache_dir: str or None (optional, default None)
+        A directory in which to cache the k-nearest neighbor graph and the
+        random projection forest of the data, keyed by a hash of the data
+        and by ``n_neighbors``, ``metric``, ``metric_kwds`` and
+        ``angular_rp_forest``. Fitting the same data again, e.g. with other
+        embedding parameters, then reuses the cached graph instead of
+        recomputing it. Only used for data sets large enough to use
+        approximate nearest neighbor search, and a string ``metric``.
+
+    knn_cache_max_bytes: int or None (optional, default 10 * 2 ** 30)
+        The maximum total size of the cache directory. The least recently
+        used graphs are removed when it is exceeded. If None the cache is
+        unbounded.
+
+    precomputed_knn: tuple or None (optional, default None)
+        A k-nearest neighbor graph of the data computed elsewhere, as a pair
+        ``(knn_indices, knn_dists)`` of arrays of shape (n_samples,
+        n_nearest) with n_nearest >= ``n_neighbors``. Each row holds the
+        indices of and distances to the nearest neighbors of a point
+        (conventionally including the point itself at distance 0), with -1
+        marking missing neighbors. If given, no nearest neighbor search is
+        done on the data, and the original local radii are computed from
+        these distances.
+
+    transform_batch_size: int (optional, default 4096)
+        The maximum number of points transformed at once; larger inputs to
+        ``transform`` are processed in batches of this size. This bounds the
+        memory used by transform, whose per edge optimization state is kept
+        in buffers reused across calls.
+
+    exact_knn_threshold: int (optional, default 4096)
+        Data sets with fewer points than this get exact nearest neighbors,
+        computed by brute force one block of points at a time, and larger
+        ones approximate nearest neighbors from nearest neighbor descent.
+        The exact search needs memory linear in the number of points, and
+        stays affordable up to about 100000 points.
+
+    n_jobs: int or None (optional, default None)
+        The number of blocks the approximate nearest neighbor search of dense
+        data is split into to run in parallel; -1 means one per numba thread
+        (see ``NUMBA_NUM_THREADS``), -2 one less, and so on. None or 1 runs
+        the serial nearest neighbor descent. The parallel search finds the
+        same neighbors for a given ``random_state`` and ``n_jobs``, whatever
+        the number of threads it actually runs on.
+
+    epoch_callback: function or None (optional, default None)
+        Called as ``epoch_callback(epoch, elapsed, embedding, density_corr)``
+        every ``callback_every`` epochs of the embedding optimization of
+        ``fit`` and after its last epoch, with the number of epochs
+        completed, the seconds elapsed since the optimization started, the
+        current embedding (which must be copied to be kept) and an estimate
+        of the correlation between the log local radii of the embedding and
+        of the original data. Returning True stops the optimization there.
+
+    callback_every: int (optional, default 10)
+        The number of epochs between calls to ``epoch_callback``.
+
+    snapshot_path: str or None (optional, default None)
+        A ``.npy`` file to write the embedding to every ``snapshot_every``
+        epochs of the optimization, as an array of shape
+        (n_epochs // snapshot_every, n_samples, n_components) mapped to
+        memory, which can be read with ``np.load(snapshot_path,
+        mmap_mode="r")`` while ``fit`` runs.
+
+    snapshot_every: int (optional, default 10)
+        The number of epochs between snapshots; at most ``n_epochs``.
     """
 
     def __init__(
@@ -1524,8 +2831,21 @@ class densMAP(BaseEstimator):
         dens_lambda=2.,
         logdist_shift=0,
         var_shift=0.1,
-        final_dens=True
+        final_dens=True,
         ##
+        deterministic=False,
+        dens_refresh=1,
+        reorder_vertices=True,
+        knn_cache_dir=None,
+        knn_cache_max_bytes=10 * 2 ** 30,
+        precomputed_knn=None,
+        transform_batch_size=4096,
+        exact_knn_threshold=4096,
+        n_jobs=None,
+        epoch_callback=None,
+        callback_every=10,
+        snapshot_path=None,
+        snapshot_every=10,
     ):
 
         self.n_neighbors = n_neighbors
@@ -1559,6 +2879,19 @@ class densMAP(BaseEstimator):
         self.var_shift = var_shift
         self.final_dens = final_dens
         ##
+        self.deterministic = deterministic
+        self.dens_refresh = dens_refresh
+        self.reorder_vertices = reorder_vertices
+        self.knn_cache_dir = knn_cache_dir
+        self.knn_cache_max_bytes = knn_cache_max_bytes
+        self.precomputed_knn = precomputed_knn
+        self.transform_batch_size = transform_batch_size
+        self.exact_knn_threshold = exact_knn_threshold
+        self.n_jobs = n_jobs
+        self.epoch_callback = epoch_callback
+        self.callback_every = callback_every
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every
 
         self.a = a
         self.b = b
@@ -1642,19 +2975,99 @@ class densMAP(BaseEstimator):
                 "n_epochs must be a positive integer "
                 "larger than 10"
             )
+        if (
+            not isinstance(self.dens_refresh, (int, np.integer))
+            or self.dens_refresh < 1
+        ):
+            raise ValueError(
+                "dens_refresh must be a positive integer"
+            )
+        if (
+            not isinstance(self.transform_batch_size, (int, np.integer))
+            or self.transform_batch_size < 1
+        ):
+            raise ValueError(
+                "transform_batch_size must be a positive integer"
+            )
+        if (
+            not isinstance(self.exact_knn_threshold, (int, np.integer))
+            or self.exact_knn_threshold < 0
+        ):
+            raise ValueError(
+                "exact_knn_threshold must be a non-negative integer"
+            )
+        if self.n_jobs is not None and (
+            not isinstance(self.n_jobs, (int, np.integer)) or self.n_jobs == 0
+        ):
+            raise ValueError("n_jobs must be None or a non-zero integer")
+        if self.final_dens not in (True, False, "lazy"):
+            raise ValueError('final_dens must be True, False or "lazy"')
+        if self.epoch_callback is not None and not callable(self.epoch_callback):
+            raise ValueError("epoch_callback must be None or callable")
+        for name in ("callback_every", "snapshot_every"):
+            value = getattr(self, name)
+            if not isinstance(value, (int, np.integer)) or value < 1:
+                raise ValueError("{} must be a positive integer".format(name))
+        if (
+            self.snapshot_path is not None
+            and self.n_epochs is not None
+            and self.snapshot_every > self.n_epochs
+        ):
+            raise ValueError("snapshot_every must not be larger than n_epochs")
+
+    def _returns_densities(self):
+        """Whether fit computes ``re_`` and the embeddings come along with
+        the local radii."""
+        return not isinstance(self.final_dens, str) and bool(self.final_dens)
+
+    def _embedding_local_radius(self, random_state):
+        """The log local radius of each point in the embedding (``re_``)."""
+        if self.verbose:
+            print("Computing re (based on KNN in embedding) ...")
+        return local_radius(
+            self.embedding_,
+            n_neighbors=self._n_neighbors,
+            logdist_shift=self.logdist_shift,
+            set_op_mix_ratio=self.set_op_mix_ratio,
+            local_connectivity=self.local_connectivity,
+            random_state=random_state,
+            n_jobs=self.n_jobs,
+            verbose=self.verbose,
+        )
+
+    def __getattr__(self, name):
+        # With final_dens="lazy", re_ is computed on first access and then
+        # kept as a plain attribute
+        if (
+            name != "re_"
+            or self.__dict__.get("final_dens") != "lazy"
+            or "embedding_" not in self.__dict__
+        ):
+            raise AttributeError(
+                "{!r} object has no attribute {!r}".format(type(self).__name__, name)
+            )
+        wait_for_warmup()
+        self.re_ = self._embedding_local_radius(check_random_state(self.random_state))
+        return self.re_
 
     def fit(self, X, y=None):
         """Fit X into an embedded space.
 
         Optionally use y for supervised dimension reduction.
 
+        The wall-clock time and peak memory of every stage of the fit are
+        recorded in ``profile_``, a ``densmap.profiling.FitProfile`` that
+        can be written as JSON with its ``to_json`` method.
+
         Parameters
         ----------
         X : array, shape (n_samples, n_features) or (n_samples, n_samples)
             If the metric is 'precomputed' X must be a square distance
-            matrix. Otherwise it contains a sample per row. If the method
-            is 'exact', X may be a sparse matrix of type 'csr', 'csc'
-            or 'coo'.
+            matrix, which may be sparse, in which case only its stored
+            entries are candidate neighbors. Otherwise it contains a sample
+            per row. If the method is 'exact', X may be a sparse matrix of
+            type 'csr', 'csc' or 'coo'. A float32 C-contiguous array (e.g.
+            an ``np.memmap``) is used without a copy.
 
         y : array, shape (n_samples)
             A target array for supervised dimension reduction. How this is
@@ -1663,9 +3076,15 @@ class densMAP(BaseEstimator):
             ``target_metric_kwds``.
         """
 
-        X = check_array(
-            X, dtype=np.float32, accept_sparse="csr"
-        )
+        wait_for_warmup()
+        # Created here (and on unpickling) rather than on first use, so
+        # that concurrent transforms can never race to create two locks
+        self._transform_lock = threading.Lock()
+        self.profile_ = profile = FitProfile()
+        with profile.stage("validate_input") as stage:
+            checked = check_input_array(X)
+            stage["copied"] = checked is not X
+        X = checked
         self._raw_data = X
 
         # Handle all the optional arguments, setting default
@@ -1701,6 +3120,8 @@ class densMAP(BaseEstimator):
         self._initial_alpha = self.learning_rate
 
         self._validate_parameters()
+        # re_ of a previous fit
+        self.__dict__.pop("re_", None)
 
         if self.verbose:
             print(str(self))
@@ -1711,6 +3132,8 @@ class densMAP(BaseEstimator):
                 self.embedding_ = np.zeros(
                     (1, self.n_components)
                 )  # needed to sklearn comparability
+                self.ro_ = np.zeros(1, dtype=np.float32)
+                self.re_ = np.zeros(1, dtype=np.float32)
                 return self
 
             warn(
@@ -1729,74 +3152,134 @@ class densMAP(BaseEstimator):
             self._sparse_data = False
 
         random_state = check_random_state(self.random_state)
+        data_hash = None
 
         if self.verbose:
             print("Construct fuzzy simplicial set")
 
-        # Handle small cases efficiently by computing all distances
-        if X.shape[0] < 4096:
+        # Handle small cases efficiently by computing exact nearest neighbors
+        if (
+            X.shape[0] < self.exact_knn_threshold
+            and self.precomputed_knn is None
+        ):
             self._small_data = True
-            dmat = pairwise_distances(
-                X, metric=self.metric, **self._metric_kwds
-            )
-            self.graph_ = fuzzy_simplicial_set(
-                dmat,
-                self._n_neighbors,
-                random_state,
-                "precomputed",
-                self._metric_kwds,
-                None,
-                None,
-                self.angular_rp_forest,
-                self.set_op_mix_ratio,
-                self.local_connectivity,
-                self.verbose,
-            )
+            with profile.stage("exact_knn"):
+                self._knn_indices, self._knn_dists = exact_nearest_neighbors(
+                    X, self._n_neighbors, self.metric, self._metric_kwds
+                )
+            with profile.stage("fuzzy_simplicial_set"):
+                self.graph_, self.graph_dists_ = fuzzy_simplicial_set(
+                    X,
+                    self._n_neighbors,
+                    random_state,
+                    self.metric,
+                    self._metric_kwds,
+                    self._knn_indices,
+                    self._knn_dists,
+                    self.angular_rp_forest,
+                    self.set_op_mix_ratio,
+                    self.local_connectivity,
+                    self.verbose,
+                    return_dists=True,
+                )
         else:
             self._small_data = False
-            # Standard case
-            (
-                self._knn_indices,
-                self._knn_dists,
-                self._rp_forest,
-            ) = nearest_neighbors(
-                X,
-                self._n_neighbors,
-                self.metric,
-                self._metric_kwds,
-                self.angular_rp_forest,
-                random_state,
-                self.verbose,
-            )
+            knn_cache = None
+            cached = None
+            if self.precomputed_knn is not None:
+                with profile.stage("precomputed_knn"):
+                    self._knn_indices, self._knn_dists = check_precomputed_knn(
+                        self.precomputed_knn, X.shape[0], self._n_neighbors
+                    )
+                cached = (self._knn_indices, self._knn_dists, [])
+            elif self.knn_cache_dir is not None and isinstance(self.metric, str):
+                with profile.stage("knn_cache_load") as stage:
+                    knn_cache = KNNGraphCache(
+                        self.knn_cache_dir, self.knn_cache_max_bytes
+                    )
+                    data_hash = joblib.hash(X)
+                    # The graph of the parallel descent depends on its
+                    # number of blocks
+                    if self.metric == "precomputed" or scipy.sparse.issparse(X):
+                        n_blocks = None
+                    else:
+                        n_blocks = _nn_descent_blocks(self.n_jobs)
+                    knn_key = knn_cache_key(
+                        data_hash,
+                        self._n_neighbors,
+                        self.metric,
+                        self._metric_kwds,
+                        self.angular_rp_forest,
+                        n_blocks,
+                    )
+                    cached = knn_cache.load(knn_key)
+                    stage["hit"] = cached is not None
+
+            if cached is not None:
+                if self.verbose and self.precomputed_knn is None:
+                    print(ts(), "Loaded nearest neighbors from cache")
+                (
+                    self._knn_indices,
+                    self._knn_dists,
+                    self._rp_forest,
+                ) = cached
+                if self.metric != "precomputed" and self.precomputed_knn is None:
+                    # Consume the random state as nearest_neighbors would,
+                    # so that the embedding does not depend on cache hits
+                    random_state.randint(INT32_MIN, INT32_MAX, 3)
+            else:
+                # Standard case
+                (
+                    self._knn_indices,
+                    self._knn_dists,
+                    self._rp_forest,
+                ) = nearest_neighbors(
+                    X,
+                    self._n_neighbors,
+                    self.metric,
+                    self._metric_kwds,
+                    self.angular_rp_forest,
+                    random_state,
+                    self.verbose,
+                    n_jobs=self.n_jobs,
+                    profile=profile,
+                )
+                if knn_cache is not None:
+                    with profile.stage("knn_cache_store"):
+                        knn_cache.store(
+                            knn_key,
+                            self._knn_indices,
+                            self._knn_dists,
+                            self._rp_forest,
+                        )
 
-            self.graph_ = fuzzy_simplicial_set(
-                X,
-                self.n_neighbors,
-                random_state,
-                self.metric,
-                self._metric_kwds,
-                self._knn_indices,
-                self._knn_dists,
-                self.angular_rp_forest,
-                self.set_op_mix_ratio,
-                self.local_connectivity,
-                self.verbose,
-            )
+            with profile.stage("fuzzy_simplicial_set"):
+                self.graph_, self.graph_dists_ = fuzzy_simplicial_set(
+                    X,
+                    self.n_neighbors,
+                    random_state,
+                    self.metric,
+                    self._metric_kwds,
+                    self._knn_indices,
+                    self._knn_dists,
+                    self.angular_rp_forest,
+                    self.set_op_mix_ratio,
+                    self.local_connectivity,
+                    self.verbose,
+                    return_dists=True,
+                )
+
+            with profile.stage("search_graph") as stage:
+                indptr, indices = search_graph_csr(self._knn_indices, self._knn_dists)
+                self._search_graph = scipy.sparse.csr_matrix(
+                    (np.ones(indices.shape[0], dtype=np.int8), indices, indptr),
+                    shape=(indptr.shape[0] - 1, indptr.shape[0] - 1),
+                )
+            if self.verbose:
+                print(
+                    ts(), "Built search graph in %.2f seconds" % stage["seconds"]
+                )
 
-            knn_data = (self._knn_dists != 0).astype(np.int8)
-            
-            indices = []
-            indptr = [0]
-            data = []
-
-            for i, row in enumerate(self._knn_indices):
-                d = list(knn_data[i])
-                indices += list(row)
-                indptr += [indptr[-1] + len(row)]
-                data += d
-            self._search_graph = scipy.sparse.csr_matrix((data, indices, indptr))
-            self._search_graph = self._search_graph.maximum(self._search_graph.transpose())
-            
             if callable(self.metric):
                 self._distance_func = self.metric
             elif self.metric in dist.named_distances:
@@ -1814,16 +3297,12 @@ class densMAP(BaseEstimator):
                 )
 
             if self.metric != "precomputed":
+                # The search functions are compiled for the metric on the
+                # first transform, see _get_search_functions
                 self._dist_args = tuple(
                     self._metric_kwds.values()
                 )
-
-                self._random_init, self._tree_init = make_initialisations(
-                    self._distance_func, self._dist_args
-                )
-                self._search = make_initialized_nnd_search(
-                    self._distance_func, self._dist_args
-                )
+                self._search_functions = None
 
         if y is not None:
             if len(X) != len(y):
@@ -1832,6 +3311,7 @@ class densMAP(BaseEstimator):
                         len_x=len(X), len_y=len(y)
                     )
                 )
+            target_stage = profile.begin("target_graph")
             y_ = check_array(y, ensure_2d=False)
             if self.target_metric == "categorical":
                 if self.target_weight < 1.0:
@@ -1853,6 +3333,8 @@ class densMAP(BaseEstimator):
 
                 # Handle the small case as precomputed as before
                 if y.shape[0] < 4096:
+                    from sklearn.metrics import pairwise_distances
+
                     ydmat = pairwise_distances(
                         y_[np.newaxis, :].T,
                         metric=self.target_metric,
@@ -1899,6 +3381,7 @@ class densMAP(BaseEstimator):
                 self.graph_ = reset_local_connectivity(
                     self.graph_
                 )
+            profile.end(target_stage)
 
         if self.n_epochs is None:
             n_epochs = 0
@@ -1908,7 +3391,7 @@ class densMAP(BaseEstimator):
         if self.verbose:
             print(ts(), "Construct embedding")
 
-        self.embedding_ = simplicial_set_embedding(
+        embedding, self.ro_ = simplicial_set_embedding(
             self._raw_data,
             self.graph_,
             self.n_components,
@@ -1928,81 +3411,34 @@ class densMAP(BaseEstimator):
             self.dens_lambda,
             self.logdist_shift,
             self.var_shift,
+            self.graph_dists_,
+            self.deterministic,
+            self.dens_refresh,
+            self.reorder_vertices,
+            profile=profile,
+            callback=self.epoch_callback,
+            callback_every=self.callback_every,
+            snapshot_path=self.snapshot_path,
+            snapshot_every=self.snapshot_every,
         )
 
         if self.verbose:
             print(ts() + " Finished embedding")
 
-            if self.final_dens: 
+            if self._returns_densities():
                 print("Computing density")
 
-        if self.final_dens: 
-            ## densmap ##
-            # Compute P in embedding
-            (emb, ro) = self.embedding_
-
-            (
-                knn_indices,
-                knn_dists,
-                rp_forest,
-            ) = nearest_neighbors(
-                emb,
-                self._n_neighbors,
-                "euclidean",
-                {},
-                False,
-                random_state,
-                self.verbose,
-            )
-
-            graph = fuzzy_simplicial_set(
-                emb,
-                self.n_neighbors,
-                random_state,
-                "euclidean",
-                {},
-                knn_indices,
-                knn_dists,
-                False,
-                self.set_op_mix_ratio,
-                self.local_connectivity,
-                self.verbose,
-            )
-
-
-            if self.verbose:
-                print("Computing re (based on KNN in embedding) ...")
-
-            graph = graph.tocoo()
-            graph.sum_duplicates()
-            n_vertices = graph.shape[1]
-            graph.eliminate_zeros()
-
-            mu_sum = np.zeros(n_vertices, dtype=np.float32)
-            re = np.zeros(n_vertices, dtype=np.float32)
-
-            head = graph.row
-            tail = graph.col
-            for i in range(len(head)):
-                j = head[i]
-                k = tail[i]
-
-                dist_squared = np.sum((emb[j] - emb[k]) ** 2)
-                mu = graph.data[i]
+        # Kept as a float32 C-contiguous array, so that transform can use it
+        # as is
+        self.embedding_ = np.ascontiguousarray(embedding, dtype=np.float32)
 
-                re[j] += mu * dist_squared
-                re[k] += mu * dist_squared
-                mu_sum[j] += mu
-                mu_sum[k] += mu
+        if self._returns_densities():
+            with profile.stage("final_dens"):
+                self.re_ = self._embedding_local_radius(random_state)
 
-            re = np.log(np.float32(self.logdist_shift) + (re / mu_sum))
-
-            self.embedding_ = (emb, ro, re)
-
-        else:
-            self.embedding_ = self.embedding_[0]
-                
-        self._input_hash = joblib.hash(self._raw_data)
+        if data_hash is None:
+            data_hash = joblib.hash(self._raw_data)
+        self._input_hash = data_hash
 
         return self
 
@@ -2026,102 +3462,151 @@ class densMAP(BaseEstimator):
         -------
         X_new : array, shape (n_samples, n_components)
             Embedding of the training data in low-dimensional space.
+
+        ro : array, shape (n_samples,)
+            The log local radius of each point in the original space (only
+            if ``final_dens`` is True).
+
+        re : array, shape (n_samples,)
+            The log local radius of each point in the embedding (only if
+            ``final_dens`` is True).
         """
         self.fit(X, y)
+        if self._returns_densities():
+            return self.embedding_, self.ro_, self.re_
         return self.embedding_
 
-    def transform(self, X):
-        """Transform X into the existing embedded space and return that
-        transformed output.
+    def __getstate__(self):
+        # The transform workspace and search functions are only caches, and
+        # locks can't be pickled
+        state = dict(super(densMAP, self).__getstate__())
+        state.pop("_transform_workspace", None)
+        state.pop("_transform_lock", None)
+        state.pop("_search_functions", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._transform_lock = threading.Lock()
+
+    def save(self, path):
+        """Save the fitted model to a directory, as flat ``.npy`` arrays and
+        a small pickle of its other attributes.
 
         Parameters
         ----------
-        X : array, shape (n_samples, n_features)
-            New data to be transformed.
+        path : str
+            The directory to save the model to. It must not exist, unless it
+            holds a previously saved model, which is then replaced.
+        """
+        save_model(self, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a model saved with ``save``.
+
+        Parameters
+        ----------
+        path : str
+            The directory the model was saved to.
+
+        mmap : bool (optional, default True)
+            Whether to memory-map the arrays of the model (copy-on-write)
+            rather than read them into memory. Loading is then nearly
+            instantaneous whatever the size of the model.
 
         Returns
         -------
-        X_new : array, shape (n_samples, n_components)
-            Embedding of the new data in low-dimensional space.
+        model : densMAP
+            The fitted model.
         """
-        # If we fit just a single instance then error
-        if self.embedding_.shape[0] == 1:
+        model = load_model(path, mmap=mmap)
+        if not isinstance(model, cls):
             raise ValueError(
-                "Transform unavailable when model was fit with"
-                "only a single data sample."
+                "{} does not hold a saved {}".format(path, cls.__name__)
             )
-        # If we just have the original input then short circuit things
-        X = check_array(
-            X, dtype=np.float32, accept_sparse="csr"
-        )
-        x_hash = joblib.hash(X)
-        if x_hash == self._input_hash:
-            return self.embedding_
-
-        if self._sparse_data:
-            raise ValueError(
-                "Transform not available for sparse input."
+        return model
+
+    def _get_search_functions(self):
+        """The functions initialising and running the nearest neighbor
+        search of transform, compiled for the metric on first use, and the
+        training data they search (see ``fast_distance_alternative``)."""
+        search_functions = getattr(self, "_search_functions", None)
+        if search_functions is None:
+            distance_func = self._distance_func
+            search_data = self._raw_data
+            alternative = fast_distance_alternative(self.metric, self._raw_data)
+            if alternative is not None:
+                distance_func, search_data = alternative
+            random_init, tree_init = make_initialisations(
+                distance_func, self._dist_args
             )
-        elif self.metric == "precomputed":
-            raise ValueError(
-                "Transform  of new data not available for "
-                "precomputed metric."
+            search = make_initialized_nnd_search(
+                distance_func, self._dist_args
             )
-
-        X = check_array(X, dtype=np.float32, order="C")
-        random_state = check_random_state(
-            self.transform_seed
-        )
-        rng_state = random_state.randint(
-            INT32_MIN, INT32_MAX, 3
-        ).astype(np.int64)
-
+            search_functions = (random_init, tree_init, search, search_data)
+            self._search_functions = search_functions
+        return search_functions
+
+    def _get_transform_workspace(self, n_edges):
+        """The per edge optimization state of transform, reallocated only
+        when a batch needs more edges than it holds."""
+        workspace = getattr(self, "_transform_workspace", None)
+        if workspace is None or workspace.epochs_per_sample.shape[0] < n_edges:
+            workspace = LayoutWorkspace(
+                *[np.empty(n_edges, dtype=np.float32) for _ in LayoutWorkspace._fields]
+            )
+            self._transform_workspace = workspace
+        return workspace
+
+    def _transform_batch(self, X, embedding, rng_state, n_epochs, densities=False):
+        """Embed a batch of new points ``X`` (a float32 C-contiguous array)
+        into the existing ``embedding`` of the training data. If
+        ``densities`` is True, also return the log local radii of the new
+        points in the original space and in the embedding."""
         if self._small_data:
-            dmat = pairwise_distances(
-                X,
+            indices, dists = exact_nearest_neighbors(
                 self._raw_data,
-                metric=self.metric,
-                **self._metric_kwds
-            )
-            indices = np.argpartition(
-                dmat, self._n_neighbors
-            )[:, : self._n_neighbors]
-            dmat_shortened = submatrix(
-                dmat, indices, self._n_neighbors
-            )
-            indices_sorted = np.argsort(dmat_shortened)
-            indices = submatrix(
-                indices, indices_sorted, self._n_neighbors
-            )
-            dists = submatrix(
-                dmat_shortened,
-                indices_sorted,
                 self._n_neighbors,
+                self.metric,
+                self._metric_kwds,
+                query=X,
             )
         else:
+            random_init, tree_init, search, search_data = (
+                self._get_search_functions()
+            )
+            query = X
+            alternative = fast_distance_alternative(self.metric, X)
+            if alternative is not None:
+                query = alternative[1]
             init = initialise_search(
                 self._rp_forest,
-                self._raw_data,
-                X,
+                search_data,
+                query,
                 int(
                     self._n_neighbors
                     * self.transform_queue_size
                 ),
-                self._random_init,
-                self._tree_init,
+                random_init,
+                tree_init,
                 rng_state,
             )
-            result = self._search(
-                self._raw_data,
+            result = search(
+                search_data,
                 self._search_graph.indptr,
                 self._search_graph.indices,
                 init,
-                X,
+                query,
             )
 
             indices, dists = deheap_sort(result)
             indices = indices[:, : self._n_neighbors]
             dists = dists[:, : self._n_neighbors]
+            if alternative is not None:
+                indices, dists = correct_alternative_distances(
+                    self.metric, self._raw_data, X, indices, dists
+                )
 
         adjusted_local_connectivity = max(
             0, self.local_connectivity - 1.0
@@ -2132,86 +3617,176 @@ class densMAP(BaseEstimator):
             local_connectivity=adjusted_local_connectivity,
         )
 
-        rows, cols, vals = compute_membership_strengths(
-            indices, dists, sigmas, rhos
+        rows, cols, vals, _ = compute_membership_strengths(
+            indices, dists, sigmas, rhos, bipartite=True
         )
 
-        graph = scipy.sparse.coo_matrix(
-            (vals, (rows, cols)),
-            shape=(X.shape[0], self._raw_data.shape[0]),
+        # Every new point has exactly n_neighbors edges, so the row
+        # normalized weights can be read off directly
+        weights = vals.reshape(X.shape[0], self._n_neighbors)
+        weight_sums = weights.sum(axis=1)
+        weight_sums[weight_sums == 0.0] = 1.0
+        new_embedding = init_transform(
+            cols.reshape(X.shape[0], self._n_neighbors),
+            weights / weight_sums[:, None],
+            embedding,
+        )
+
+        keep = vals >= (vals.max() / float(n_epochs))
+        head = rows[keep]
+        tail = cols[keep]
+        vals = vals[keep]
+
+        workspace = self._get_transform_workspace(vals.shape[0])
+        # As make_epochs_per_sample, as no weight is zero
+        epochs_per_sample = workspace.epochs_per_sample[: vals.shape[0]]
+        np.divide(vals.max(), vals, out=epochs_per_sample)
+
+        # The new points are placed with respect to the fixed embedding of
+        # the training data, without the density preservation term: its
+        # statistics are defined over the training data only.
+        new_embedding = optimize_layout(
+            new_embedding,
+            embedding,
+            head,
+            tail,
+            vals,
+            np.zeros(1, dtype=np.float32),
+            np.zeros(1, dtype=np.float32),
+            n_epochs,
+            embedding.shape[0],
+            epochs_per_sample,
+            self._a,
+            self._b,
+            rng_state,
+            self.repulsion_strength,
+            self._initial_alpha,
+            self.negative_sample_rate,
+            deterministic=self.deterministic,
+            move_other=False,
+            workspace=workspace,
         )
+        if not densities:
+            return new_embedding
 
-        # This was a very specially constructed graph with constant degree.
-        # That lets us do fancy unpacking by reshaping the csr matrix indices
-        # and data. Doing so relies on the constant degree assumption!
-        csr_graph = normalize(graph.tocsr(), norm="l1")
-        inds = csr_graph.indices.reshape(
-            X.shape[0], self._n_neighbors
+        ## densmap ##
+        # Local radii over the edges from each new point to its nearest
+        # training points, measured in either space, as fit does over the
+        # edges of the fuzzy simplicial set. Like ro_, the original space is
+        # measured in euclidean distance whatever the metric.
+        if self.metric in ("euclidean", "l2"):
+            data_dists = dists
+        else:
+            _, candidate_distances = make_exact_knn(dist.euclidean, ())
+            data_dists = candidate_distances(X, self._raw_data, indices)
+        # Missing neighbors (index -1) have no weight, and no length
+        data_dists = np.where(indices < 0, 0.0, data_dists).astype(np.float32)
+        neighbor_embedding = embedding[cols.reshape(X.shape[0], self._n_neighbors)]
+        embedded_dists = np.sqrt(
+            ((neighbor_embedding - new_embedding[:, None, :]) ** 2).sum(axis=2)
         )
-        weights = csr_graph.data.reshape(
-            X.shape[0], self._n_neighbors
+        ro = knn_local_radius(data_dists, weights, np.float32(self.logdist_shift))
+        re = knn_local_radius(
+            embedded_dists, weights, np.float32(self.logdist_shift)
         )
-        embedding = init_transform(
-            inds, weights, self.embedding_
+        return new_embedding, ro, re
+
+    def transform(self, X):
+        """Transform X into the existing embedded space and return that
+        transformed output.
+
+        New points are embedded by optimizing their positions relative to
+        the (fixed) embedding of the training data, in batches of at most
+        ``transform_batch_size`` points.
+
+        Parameters
+        ----------
+        X : array, shape (n_samples, n_features)
+            New data to be transformed.
+
+        Returns
+        -------
+        X_new : array, shape (n_samples, n_components)
+            Embedding of the new data in low-dimensional space.
+
+        ro : array, shape (n_samples,)
+            The log local radius of each new point in the original space,
+            averaged over its nearest neighbors among the training data
+            (only if ``final_dens`` is True).
+
+        re : array, shape (n_samples,)
+            The log local radius of each new point in the embedding,
+            averaged over its nearest neighbors among the embedded training
+            data (only if ``final_dens`` is True).
+        """
+        wait_for_warmup()
+        # If we fit just a single instance then error
+        if self.embedding_.shape[0] == 1:
+            raise ValueError(
+                "Transform unavailable when model was fit with"
+                "only a single data sample."
+            )
+        X = check_input_array(X)
+        # If we just have the original input then short circuit things; only
+        # inputs of the right shape are worth hashing
+        if X.shape == self._raw_data.shape and joblib.hash(X) == self._input_hash:
+            if self._returns_densities():
+                return self.embedding_, self.ro_, self.re_
+            return self.embedding_
+
+        if self._sparse_data:
+            raise ValueError(
+                "Transform not available for sparse input."
+            )
+        elif self.metric == "precomputed":
+            raise ValueError(
+                "Transform  of new data not available for "
+                "precomputed metric."
+            )
+
+        X = np.ascontiguousarray(X)
+        random_state = check_random_state(
+            self.transform_seed
         )
 
         if self.n_epochs is None:
             # For smaller datasets we can use more epochs
-            if graph.shape[0] <= 10000:
+            if X.shape[0] <= 10000:
                 n_epochs = 100
             else:
                 n_epochs = 30
         else:
-            n_epochs = self.n_epochs // 3.0
-
-        graph.data[
-            graph.data
-            < (graph.data.max() / float(n_epochs))
-        ] = 0.0
-        graph.eliminate_zeros()
-
-        epochs_per_sample = make_epochs_per_sample(
-            graph.data, n_epochs
-        )
-
-        head = graph.row
-        tail = graph.col
+            n_epochs = max(1, int(self.n_epochs // 3))
 
-        ## densmap ##
-        if self.verbose:
-            print("Computing ro ...")
-        ro = np.zeros(len(head), dtype=np.float32)
-        for i in range(len(head)):
-            ro[i] = np.sum((X[head[i]] - X[tail[i]]) ** 2)
-        ro = np.log(ro + np.float32(self.logdist_shift))
-        R = (ro - np.mean(ro)) / np.std(ro)
+        # Only copied if embedding_ was replaced by an array of another type
+        embedding = np.ascontiguousarray(self.embedding_, dtype=np.float32)
 
-        embedding = optimize_layout(
-        ###########
-            embedding,
-            self.embedding_.astype(
-              np.float32, copy=True
-            ),  # Fixes #179 & #217
-            head,
-            tail,
-            graph.data,
-            R,
-            n_epochs,
-            graph.shape[1],
-            epochs_per_sample,
-            self._a,
-            self._b,
-            rng_state,
-            self.repulsion_strength,
-            self._initial_alpha,
-            self.negative_sample_rate,
-            verbose=self.verbose,
-            ## densmap
-            dens_frac=self.dens_frac,
-            dens_lambda=self.dens_lambda,
-            logdist_shift=self.logdist_shift,
-            var_shift=self.var_shift,
+        result = np.empty(
+            (X.shape[0], self.embedding_.shape[1]), dtype=np.float32
         )
+        densities = self._returns_densities()
+        if densities:
+            ro = np.empty(X.shape[0], dtype=np.float32)
+            re = np.empty(X.shape[0], dtype=np.float32)
+
+        with self._transform_lock:
+            for start in range(0, X.shape[0], self.transform_batch_size):
+                end = min(start + self.transform_batch_size, X.shape[0])
+                rng_state = random_state.randint(
+                    INT32_MIN, INT32_MAX, 3
+                ).astype(np.int64)
+                batch = self._transform_batch(
+                    X[start:end],
+                    embedding,
+                    rng_state,
+                    n_epochs,
+                    densities=densities,
+                )
+                if densities:
+                    result[start:end], ro[start:end], re[start:end] = batch
+                else:
+                    result[start:end] = batch
 
-        ## densmap
-        return embedding, ro
+        if densities:
+            return result, ro, re
+        return result
@@ -8,7 +8,7 @@ _mock_identity = np.eye(2, dtype=np.float64)
 _mock_ones = np.ones(2, dtype=np.float64)
 
 
-@numba.njit(fastmath=True)
+@numba.njit(fastmath=True, cache=True)
 def euclidean(x, y):
     """Standard euclidean distance.
 
@@ -21,7 +21,21 @@ def euclidean(x, y):
     return np.sqrt(result)
 
 
-@numba.njit()
+@numba.njit(fastmath=True, cache=True)
+def squared_euclidean(x, y):
+    """Squared euclidean distance, which ranks points as the euclidean
+    distance does without taking a square root.
+
+    ..math::
+        D(x, y) = \sum_i (x_i - y_i)^2
+    """
+    result = 0.0
+    for i in range(x.shape[0]):
+        result += (x[i] - y[i]) ** 2
+    return result
+
+
+@numba.njit(cache=True)
 def standardised_euclidean(x, y, sigma=_mock_ones):
     """Euclidean distance standardised against a vector of standard
     deviations per coordinate.
@@ -36,7 +50,7 @@ def standardised_euclidean(x, y, sigma=_mock_ones):
     return np.sqrt(result)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def manhattan(x, y):
     """Manhatten, taxicab, or l1 distance.
 
@@ -50,7 +64,7 @@ def manhattan(x, y):
     return result
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def chebyshev(x, y):
     """Chebyshev or l-infinity distance.
 
@@ -64,7 +78,7 @@ def chebyshev(x, y):
     return result
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def minkowski(x, y, p=2):
     """Minkowski distance.
 
@@ -83,7 +97,7 @@ def minkowski(x, y, p=2):
     return result ** (1.0 / p)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def weighted_minkowski(x, y, w=_mock_ones, p=2):
     """A weighted version of Minkowski distance.
 
@@ -101,7 +115,7 @@ def weighted_minkowski(x, y, w=_mock_ones, p=2):
     return result ** (1.0 / p)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def mahalanobis(x, y, vinv=_mock_identity):
     result = 0.0
 
@@ -119,7 +133,7 @@ def mahalanobis(x, y, vinv=_mock_identity):
     return np.sqrt(result)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def hamming(x, y):
     result = 0.0
     for i in range(x.shape[0]):
@@ -129,7 +143,7 @@ def hamming(x, y):
     return float(result) / x.shape[0]
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def canberra(x, y):
     result = 0.0
     for i in range(x.shape[0]):
@@ -140,7 +154,7 @@ def canberra(x, y):
     return result
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def bray_curtis(x, y):
     numerator = 0.0
     denominator = 0.0
@@ -154,7 +168,7 @@ def bray_curtis(x, y):
         return 0.0
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def jaccard(x, y):
     num_non_zero = 0.0
     num_equal = 0.0
@@ -170,7 +184,7 @@ def jaccard(x, y):
         return float(num_non_zero - num_equal) / num_non_zero
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def matching(x, y):
     num_not_equal = 0.0
     for i in range(x.shape[0]):
@@ -181,7 +195,7 @@ def matching(x, y):
     return float(num_not_equal) / x.shape[0]
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def dice(x, y):
     num_true_true = 0.0
     num_not_equal = 0.0
@@ -197,7 +211,7 @@ def dice(x, y):
         return num_not_equal / (2.0 * num_true_true + num_not_equal)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def kulsinski(x, y):
     num_true_true = 0.0
     num_not_equal = 0.0
@@ -215,7 +229,7 @@ def kulsinski(x, y):
         )
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def rogers_tanimoto(x, y):
     num_not_equal = 0.0
     for i in range(x.shape[0]):
@@ -226,7 +240,7 @@ def rogers_tanimoto(x, y):
     return (2.0 * num_not_equal) / (x.shape[0] + num_not_equal)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def russellrao(x, y):
     num_true_true = 0.0
     for i in range(x.shape[0]):
@@ -240,7 +254,7 @@ def russellrao(x, y):
         return float(x.shape[0] - num_true_true) / (x.shape[0])
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sokal_michener(x, y):
     num_not_equal = 0.0
     for i in range(x.shape[0]):
@@ -251,7 +265,7 @@ def sokal_michener(x, y):
     return (2.0 * num_not_equal) / (x.shape[0] + num_not_equal)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sokal_sneath(x, y):
     num_true_true = 0.0
     num_not_equal = 0.0
@@ -267,7 +281,7 @@ def sokal_sneath(x, y):
         return num_not_equal / (0.5 * num_true_true + num_not_equal)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def haversine(x, y):
     if x.shape[0] != 2:
         raise ValueError("haversine is only defined for 2 dimensional data")
@@ -277,7 +291,7 @@ def haversine(x, y):
     return 2.0 * np.arcsin(result)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def yule(x, y):
     num_true_true = 0.0
     num_true_false = 0.0
@@ -299,7 +313,7 @@ def yule(x, y):
         )
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def cosine(x, y):
     result = 0.0
     norm_x = 0.0
@@ -317,7 +331,21 @@ def cosine(x, y):
         return 1.0 - (result / np.sqrt(norm_x * norm_y))
 
 
-@numba.njit()
+@numba.njit(fastmath=True, cache=True)
+def normalized_cosine(x, y):
+    """Cosine distance between vectors of unit norm, i.e. one minus their
+    dot product.
+
+    ..math::
+        D(x, y) = 1 - \sum_i x_i y_i
+    """
+    result = 0.0
+    for i in range(x.shape[0]):
+        result += x[i] * y[i]
+    return 1.0 - result
+
+
+@numba.njit(cache=True)
 def correlation(x, y):
     mu_x = 0.0
     mu_y = 0.0
@@ -383,3 +411,11 @@ named_distances = {
     "sokalmichener": sokal_michener,
     "yule": yule,
 }
+
+# Cheaper distances that rank points as the named metrics do, used by the
+# nearest neighbor searches (normalized_cosine on rows scaled to unit norm)
+fast_distance_alternatives = {
+    "euclidean": squared_euclidean,
+    "l2": squared_euclidean,
+    "cosine": normalized_cosine,
+}
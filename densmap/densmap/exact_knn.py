@@ -0,0 +1,555 @@
+# Authors: Ashwin Narayan and Hyunghoon Cho
+#
+# License: MIT
+"""Exact k-nearest neighbors by brute force, without the full matrix of
+pairwise distances.
+
+The query points are processed one block at a time, and only the nearest
+neighbors found so far are kept for each of them, so the memory used does
+not grow with the square of the number of points.
+
+For the euclidean, cosine and correlation metrics the distances of a block
+are obtained from a single matrix product (GEMM). The product only serves to
+pick the nearest neighbors: their distances are then computed again exactly,
+with the same functions as the nearest neighbor descent. Other metrics of
+``densmap.distances``, and numba compiled callables, are computed by a numba
+kernel that compares tiles of query points with tiles of data points.
+
+Euclidean neighbors in at most three dimensions, as in a densMAP embedding,
+are instead found through a uniform grid of cells: the cells around each
+query point are scanned ring by ring, until no point of the cells left
+can be closer than its current neighbors.
+"""
+import numpy as np
+import numba
+import scipy.sparse
+
+import densmap.distances as dist
+from densmap.specializations import memoize_specialization
+from densmap.utils import fast_knn_indices, fast_sparse_knn
+
+# Metrics whose distances are computed from a matrix product
+GEMM_METRICS = ("euclidean", "l2", "cosine", "correlation")
+
+# The size of the block of similarities computed at once by the matrix
+# product, and of the tiles of the numba kernel
+EXACT_KNN_BLOCK_BYTES = 1 << 26
+
+# How many times n_neighbors candidates the matrix product passes on to the
+# exact distances, to make up for its rounding
+EXACT_KNN_OVERFETCH = 2
+EXACT_KNN_TILE_SIZE = 256
+
+# The largest dimension searched through a grid, and the mean number of
+# points per cell of the grid
+GRID_KNN_MAX_DIM = 3
+GRID_KNN_CELL_SIZE = 2
+
+# The fraction of the points left out of the grid at each end of every
+# axis, and put in its border cells instead, so that a few distant points do
+# not stretch the cells
+GRID_KNN_OUTLIER_QUANTILE = 0.001
+
+# The cells are made smaller, up to GRID_KNN_MAX_CELLS cells per point,
+# while the points share their cell with more than four times
+# GRID_KNN_CELL_SIZE points on average, as happens when they are clustered.
+# Where the grid still does not fit the data the search goes through a k-d
+# tree instead: for all the query points if they would share their cell
+# with more than GRID_KNN_MAX_CROWDING times GRID_KNN_CELL_SIZE points, and
+# for each query point whose search has scanned GRID_KNN_MAX_SCANNED_CELLS
+# cells without completing
+GRID_KNN_MAX_CELLS = 8
+GRID_KNN_MAX_CROWDING = 16
+GRID_KNN_MAX_SCANNED_CELLS = 4096
+
+
+@numba.njit(cache=True)
+def _max_heap_replace_root(dists, indices, d, j):
+    """Replace the largest distance of a max-heap of distances (and the
+    matching indices) by ``d`` (and ``j``), and restore the heap order."""
+    size = dists.shape[0]
+    i = 0
+    while True:
+        left = 2 * i + 1
+        right = left + 1
+        if left >= size:
+            break
+        if right >= size or dists[left] >= dists[right]:
+            child = left
+        else:
+            child = right
+        if dists[child] <= d:
+            break
+        dists[i] = dists[child]
+        indices[i] = indices[child]
+        i = child
+    dists[i] = d
+    indices[i] = j
+
+
+@numba.njit(cache=True)
+def _scan_grid_cell(q, points, order, cell_start, cell, dists, indices):
+    """Offer the points of a grid cell to the max-heap of squared distances
+    (and matching indices) of the query point ``q``."""
+    for p in range(cell_start[cell], cell_start[cell + 1]):
+        d = 0.0
+        for a in range(3):
+            diff = points[p, a] - q[a]
+            d += diff * diff
+        if d < dists[0]:
+            _max_heap_replace_root(dists, indices, d, order[p])
+
+
+@numba.njit(parallel=True, cache=True)
+def grid_knn(
+    query, points, order, cell_start, lower, cell_width, shape, n_neighbors, max_rings
+):
+    """Find the exact euclidean nearest neighbors of query points among the
+    points of a three dimensional uniform grid.
+
+    Parameters
+    ----------
+    query: array of shape (n_queries, 3)
+        The query points, padded with zero coordinates to three dimensions.
+
+    points: array of shape (n_samples, 3)
+        The points of the grid, ordered by cell and padded with zero
+        coordinates to three dimensions.
+
+    order: array of shape (n_samples,)
+        The index of each of the ``points`` in the original data.
+
+    cell_start: array of shape (n_cells + 1,)
+        The position in ``points`` of the first point of each cell, the cells
+        being numbered in row-major order.
+
+    lower: array of shape (3,)
+        The lowest corner of the grid.
+
+    cell_width: float
+        The width of the (cubic) cells.
+
+    shape: array of shape (3,)
+        The number of cells along each axis.
+
+    n_neighbors: int
+        The number of nearest neighbors to find for each query point.
+
+    max_rings: int
+        The number of rings of cells around the cell of a query point after
+        which its search is given up.
+
+    Returns
+    -------
+    knn_indices: array of shape (n_queries, n_neighbors)
+        The indices of the nearest neighbors of each query point, sorted by
+        distance.
+
+    knn_dists: array of shape (n_queries, n_neighbors)
+        The distances to these neighbors.
+
+    resolved: array of shape (n_queries,)
+        Whether the search of each query point completed within
+        ``max_rings`` rings; the neighbors of the others are not exact.
+    """
+    n_query = query.shape[0]
+    indices = np.full((n_query, n_neighbors), -1, dtype=np.int32)
+    dists = np.full((n_query, n_neighbors), np.inf, dtype=np.float32)
+    resolved = np.zeros(n_query, dtype=np.bool_)
+
+    for i in numba.prange(n_query):
+        q = query[i]
+        heap_dists = dists[i]
+        heap_indices = indices[i]
+        c = np.empty(3, dtype=np.int64)
+        max_ring = 0
+        for a in range(3):
+            c[a] = min(max(int((q[a] - lower[a]) / cell_width), 0), shape[a] - 1)
+            max_ring = max(max_ring, c[a], shape[a] - 1 - c[a])
+
+        for r in range(min(max_ring, max_rings) + 1):
+            # The cells at Chebyshev distance r of the cell of q
+            for x in range(max(c[0] - r, 0), min(c[0] + r, shape[0] - 1) + 1):
+                for y in range(max(c[1] - r, 0), min(c[1] + r, shape[1] - 1) + 1):
+                    first = (x * shape[1] + y) * shape[2]
+                    if r == 0 or abs(x - c[0]) == r or abs(y - c[1]) == r:
+                        for z in range(max(c[2] - r, 0), min(c[2] + r, shape[2] - 1) + 1):
+                            _scan_grid_cell(
+                                q, points, order, cell_start, first + z,
+                                heap_dists, heap_indices,
+                            )
+                    else:
+                        if c[2] - r >= 0:
+                            _scan_grid_cell(
+                                q, points, order, cell_start, first + c[2] - r,
+                                heap_dists, heap_indices,
+                            )
+                        if c[2] + r < shape[2]:
+                            _scan_grid_cell(
+                                q, points, order, cell_start, first + c[2] + r,
+                                heap_dists, heap_indices,
+                            )
+
+            # Distance from q to the cells not scanned yet
+            bound = np.inf
+            for a in range(3):
+                if c[a] - r > 0:
+                    bound = min(bound, q[a] - (lower[a] + (c[a] - r) * cell_width))
+                if c[a] + r < shape[a] - 1:
+                    bound = min(bound, lower[a] + (c[a] + r + 1) * cell_width - q[a])
+            if bound == np.inf or heap_dists[0] <= bound * bound:
+                resolved[i] = True
+                break
+
+        order_i = np.argsort(heap_dists)
+        dists[i] = np.sqrt(heap_dists[order_i])
+        indices[i] = heap_indices[order_i]
+
+    return indices, dists, resolved
+
+
+def _grid_cells(points, lower, extent, cell_width):
+    """The number of cells of a grid along each axis, the cell of each point
+    in row-major order, and the number of points of each cell."""
+    shape = (extent // cell_width).astype(np.int64) + 1
+    coords = ((points - lower) // cell_width).astype(np.int64)
+    np.clip(coords, 0, shape - 1, out=coords)
+    cells = (coords[:, 0] * shape[1] + coords[:, 1]) * shape[2] + coords[:, 2]
+    return shape, cells, np.bincount(cells, minlength=np.prod(shape))
+
+
+def _kd_tree_knn(query, data, n_neighbors):
+    """Exact euclidean neighbors through a k-d tree of scikit-learn."""
+    from sklearn.neighbors import KDTree
+
+    dists, indices = KDTree(data).query(query, n_neighbors)
+    return indices.astype(np.int32), dists.astype(np.float32)
+
+
+def grid_nearest_neighbors(data, n_neighbors, query=None):
+    """Compute the exact euclidean nearest neighbors of points in at most
+    ``GRID_KNN_MAX_DIM`` dimensions, through a uniform grid holding about
+    ``GRID_KNN_CELL_SIZE`` points per cell. The grid spans the data between
+    the ``GRID_KNN_OUTLIER_QUANTILE`` quantiles of every axis, and the points
+    (or queries) beyond them fall in the border cells. The query points
+    that the grid does not resolve quickly, in regions much sparser than the
+    rest, or all of them if the data are too unevenly spread for a uniform
+    grid, are searched through a k-d tree instead.
+
+    Parameters
+    ----------
+    data: array of shape (n_samples, n_features)
+        The points among which to find the neighbors.
+
+    n_neighbors: int
+        The number of nearest neighbors to find for each query point.
+
+    query: array of shape (n_queries, n_features) (optional)
+        The points to find the neighbors of. Defaults to ``data``.
+
+    Returns
+    -------
+    knn_indices: array of shape (n_queries, n_neighbors)
+        The indices in ``data`` of the nearest neighbors of each query point,
+        sorted by distance.
+
+    knn_dists: array of shape (n_queries, n_neighbors)
+        The distances to these neighbors.
+    """
+    n_samples, n_features = data.shape
+    if n_features > GRID_KNN_MAX_DIM:
+        raise ValueError(
+            "Grid nearest neighbors are limited to %d dimensions" % GRID_KNN_MAX_DIM
+        )
+    if query is None:
+        query = data
+
+    points = np.zeros((n_samples, 3), dtype=np.float32)
+    points[:, :n_features] = data
+    lower, upper = np.quantile(
+        points.astype(np.float64),
+        [GRID_KNN_OUTLIER_QUANTILE, 1.0 - GRID_KNN_OUTLIER_QUANTILE],
+        axis=0,
+    )
+    extent = upper - lower
+
+    # Cubic cells, sized so that the box spanned by the grid holds about
+    # GRID_KNN_CELL_SIZE points per cell on average. The axes along which
+    # the data are thinner than a cell are left out of the box, so that
+    # nearly flat data do not make for a huge number of cells.
+    cell_width = 1.0
+    spanned = extent[extent > 0]
+    while spanned.shape[0] > 0:
+        cell_width = (
+            np.prod(spanned) * GRID_KNN_CELL_SIZE / n_samples
+        ) ** (1.0 / spanned.shape[0])
+        if spanned.min() >= cell_width:
+            break
+        spanned = spanned[spanned >= cell_width]
+    n_dims = max(spanned.shape[0], 1)
+    shape, cells, counts = _grid_cells(points, lower, extent, cell_width)
+
+    # The mean number of points in the cell of a point, relative to
+    # GRID_KNN_CELL_SIZE. Each refinement aims at about one.
+    for _ in range(4):
+        crowding = np.dot(counts, counts) / float(GRID_KNN_CELL_SIZE * n_samples)
+        if crowding <= 4.0:
+            break
+        finer_width = max(
+            cell_width / crowding ** (1.0 / n_dims),
+            (np.prod(spanned) / (GRID_KNN_MAX_CELLS * n_samples)) ** (1.0 / n_dims),
+        )
+        if finer_width >= cell_width:
+            break
+        cell_width = finer_width
+        shape, cells, counts = _grid_cells(points, lower, extent, cell_width)
+    crowding = np.dot(counts, counts) / float(GRID_KNN_CELL_SIZE * n_samples)
+    if crowding > GRID_KNN_MAX_CROWDING:
+        return _kd_tree_knn(query, data, n_neighbors)
+
+    order = np.argsort(cells, kind="stable").astype(np.int32)
+    cell_start = np.zeros(counts.shape[0] + 1, dtype=np.int64)
+    np.cumsum(counts, out=cell_start[1:])
+    max_rings = int((GRID_KNN_MAX_SCANNED_CELLS ** (1.0 / n_dims) - 1) / 2)
+
+    padded_query = np.zeros((query.shape[0], 3), dtype=np.float32)
+    padded_query[:, :n_features] = query
+    indices, dists, resolved = grid_knn(
+        padded_query,
+        points[order],
+        order,
+        cell_start,
+        lower,
+        cell_width,
+        shape,
+        n_neighbors,
+        max_rings,
+    )
+    if not np.all(resolved):
+        unresolved = np.flatnonzero(~resolved)
+        indices[unresolved], dists[unresolved] = _kd_tree_knn(
+            query[unresolved], data, n_neighbors
+        )
+    return indices, dists
+
+
+@memoize_specialization
+def make_exact_knn(dist, dist_args):
+    """Create the numba kernels of the exact k-nearest neighbor search
+    specialised for the given distance metric and metric arguments.
+
+    Parameters
+    ----------
+    dist: function
+        A numba JITd distance function which, given two arrays computes a
+        dissimilarity between them.
+
+    dist_args: tuple
+        Any extra arguments that need to be passed to the distance function
+        beyond the two arrays to be compared.
+
+    Returns
+    -------
+    tiled_knn: function
+        ``tiled_knn(query, data, n_neighbors, tile_size)`` finds the nearest
+        neighbors among the rows of ``data`` of each row of ``query``, sorted
+        by distance.
+
+    candidate_distances: function
+        ``candidate_distances(query, data, candidates)`` computes the
+        distance from each row of ``query`` to each of its candidate
+        neighbors, given by their indices in ``data``.
+    """
+
+    @numba.njit(parallel=True)
+    def tiled_knn(query, data, n_neighbors, tile_size):
+        n_query = query.shape[0]
+        indices = np.full((n_query, n_neighbors), -1, dtype=np.int32)
+        dists = np.full((n_query, n_neighbors), np.inf, dtype=np.float32)
+
+        n_tiles = (n_query + tile_size - 1) // tile_size
+        for t in numba.prange(n_tiles):
+            start = t * tile_size
+            end = min(start + tile_size, n_query)
+            for data_start in range(0, data.shape[0], tile_size):
+                data_end = min(data_start + tile_size, data.shape[0])
+                for i in range(start, end):
+                    for j in range(data_start, data_end):
+                        d = dist(query[i], data[j], *dist_args)
+                        if d < dists[i, 0]:
+                            _max_heap_replace_root(dists[i], indices[i], d, j)
+
+            for i in range(start, end):
+                order = np.argsort(dists[i])
+                dists[i] = dists[i][order]
+                indices[i] = indices[i][order]
+
+        return indices, dists
+
+    @numba.njit(parallel=True)
+    def candidate_distances(query, data, candidates):
+        result = np.empty(candidates.shape, dtype=np.float32)
+        for i in numba.prange(candidates.shape[0]):
+            for j in range(candidates.shape[1]):
+                result[i, j] = dist(query[i], data[candidates[i, j]], *dist_args)
+        return result
+
+    return tiled_knn, candidate_distances
+
+
+def _gemm_operand(X, metric, center=None):
+    """The rows of ``X`` transformed so that their dot products rank the
+    distances under ``metric``, and the squared norms of the rows (or None)
+    to add to minus twice the dot products.
+
+    Euclidean operands are moved by ``-center`` (the mean of the data), as
+    the float32 scores of points far from the origin would otherwise cancel
+    out their differences."""
+    if metric in ("euclidean", "l2"):
+        if center is not None:
+            X = (X - center).astype(np.float32)
+        norms = np.einsum("ij,ij->i", X, X, dtype=np.float64)
+        return X, norms.astype(np.float32)
+
+    if metric == "correlation":
+        X = X - X.mean(axis=1, dtype=np.float64).astype(np.float32)[:, None]
+    norms = np.sqrt(np.einsum("ij,ij->i", X, X, dtype=np.float64))
+    norms[norms == 0.0] = 1.0
+    return X / norms.astype(np.float32)[:, None], None
+
+
+def _sklearn_knn(query, data, n_neighbors, metric, metric_kwds):
+    """Exact neighbors using the chunked pairwise distances of scikit-learn,
+    for sparse data and for the metrics densMAP does not implement."""
+    from sklearn.metrics import pairwise_distances_chunked
+
+    def reduce_func(dmat, start):
+        indices = np.argpartition(dmat, n_neighbors - 1, axis=1)[:, :n_neighbors]
+        dists = np.take_along_axis(dmat, indices, axis=1)
+        order = np.argsort(dists, axis=1)
+        return (
+            np.take_along_axis(indices, order, axis=1),
+            np.take_along_axis(dists, order, axis=1),
+        )
+
+    chunks = list(
+        pairwise_distances_chunked(
+            query,
+            data,
+            reduce_func=reduce_func,
+            metric=metric,
+            working_memory=EXACT_KNN_BLOCK_BYTES >> 20,
+            **metric_kwds
+        )
+    )
+    indices = np.vstack([chunk[0] for chunk in chunks]).astype(np.int32)
+    dists = np.vstack([chunk[1] for chunk in chunks]).astype(np.float32)
+    return indices, dists
+
+
+def exact_nearest_neighbors(data, n_neighbors, metric="euclidean", metric_kwds=None, query=None):
+    """Compute the exact ``n_neighbors`` nearest rows of ``data`` to every row
+    of ``query`` (of ``data`` itself if ``query`` is None), by brute force
+    but without storing all the pairwise distances.
+
+    Parameters
+    ----------
+    data: array or sparse matrix of shape (n_samples, n_features)
+        The points among which to find the neighbors. If ``metric`` is
+        'precomputed' this is a square distance matrix.
+
+    n_neighbors: int
+        The number of nearest neighbors to find for each query point.
+
+    metric: string or callable (optional, default 'euclidean')
+        The metric to use: 'precomputed', the name of a metric of
+        ``densmap.distances`` or of ``sklearn.metrics.pairwise_distances``,
+        or a numba compiled distance function.
+
+    metric_kwds: dict (optional, default None)
+        Arguments to pass to the metric.
+
+    query: array or sparse matrix of shape (n_queries, n_features) (optional)
+        The points to find the neighbors of. Defaults to ``data``, in which
+        case every point is its own first neighbor.
+
+    Returns
+    -------
+    knn_indices: array of shape (n_queries, n_neighbors)
+        The indices in ``data`` of the nearest neighbors of each query point,
+        sorted by distance.
+
+    knn_dists: array of shape (n_queries, n_neighbors)
+        The distances to these neighbors.
+    """
+    if metric_kwds is None:
+        metric_kwds = {}
+
+    if metric == "precomputed":
+        if query is not None:
+            raise ValueError("Can not query a precomputed distance matrix")
+        if scipy.sparse.issparse(data):
+            data = data.tocsr()
+            return fast_sparse_knn(data.indptr, data.indices, data.data, n_neighbors)
+        knn_indices = fast_knn_indices(data, n_neighbors)
+        knn_dists = np.take_along_axis(data, knn_indices, axis=1).astype(np.float32)
+        return knn_indices, knn_dists
+
+    if query is None:
+        query = data
+
+    if (
+        scipy.sparse.issparse(data)
+        or scipy.sparse.issparse(query)
+        or not (callable(metric) or metric in dist.named_distances)
+    ):
+        return _sklearn_knn(query, data, n_neighbors, metric, metric_kwds)
+
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    query = np.ascontiguousarray(query, dtype=np.float32)
+    if metric in ("euclidean", "l2") and data.shape[1] <= GRID_KNN_MAX_DIM:
+        return grid_nearest_neighbors(data, n_neighbors, query)
+
+    if callable(metric):
+        distance_func = metric
+    else:
+        distance_func = dist.named_distances[metric]
+    tiled_knn, candidate_distances = make_exact_knn(
+        distance_func, tuple(metric_kwds.values())
+    )
+
+    if metric not in GEMM_METRICS:
+        return tiled_knn(query, data, n_neighbors, EXACT_KNN_TILE_SIZE)
+
+    center = None
+    if metric in ("euclidean", "l2"):
+        center = data.mean(axis=0, dtype=np.float64)
+    data_operand, data_norms = _gemm_operand(data, metric, center)
+    if query is data:
+        query_operand = data_operand
+    else:
+        query_operand, _ = _gemm_operand(query, metric, center)
+    n_candidates = min(EXACT_KNN_OVERFETCH * n_neighbors, data.shape[0])
+
+    knn_indices = np.empty((query.shape[0], n_neighbors), dtype=np.int32)
+    knn_dists = np.empty((query.shape[0], n_neighbors), dtype=np.float32)
+    block_size = max(1, EXACT_KNN_BLOCK_BYTES // (4 * data.shape[0]))
+    for start in range(0, query.shape[0], block_size):
+        end = min(start + block_size, query.shape[0])
+        # Ranks the data points as the distances do, up to rounding
+        scores = query_operand[start:end] @ data_operand.T
+        if data_norms is None:
+            np.negative(scores, out=scores)
+        else:
+            scores *= -2.0
+            scores += data_norms
+        candidates = np.argpartition(scores, n_candidates - 1, axis=1)
+        candidates = candidates[:, :n_candidates].astype(np.int32)
+
+        # Exact distances, as computed by the other neighbor searches
+        dists = candidate_distances(query[start:end], data, candidates)
+        order = np.argsort(dists, axis=1, kind="stable")[:, :n_neighbors]
+        knn_indices[start:end] = np.take_along_axis(candidates, order, axis=1)
+        knn_dists[start:end] = np.take_along_axis(dists, order, axis=1)
+
+    return knn_indices, knn_dists
@@ -19,8 +19,14 @@ from densmap.utils import (
 )
 
 from densmap.rp_tree import search_flat_tree
+from densmap.specializations import memoize_specialization
 
+# The total number of candidate graph updates buffered by the parallel
+# nearest neighbor descent between two merges into the graph
+NN_DESCENT_UPDATE_BUFFER_SIZE = 1 << 22
 
+
+@memoize_specialization
 def make_nn_descent(dist, dist_args):
     """Create a numba accelerated version of nearest neighbor descent
     specialised for the given distance metric and metric arguments. Numba
@@ -40,7 +46,9 @@ def make_nn_descent(dist, dist_args):
     Returns
     -------
     A numba JITd function for nearest neighbor descent computation that is
-    specialised to the given metric.
+    specialised to the given metric. If passed an int64 array of length
+    ``n_iters`` as ``update_counts``, it records in it the number of graph
+    updates of each iteration run.
     """
 
     @numba.njit()
@@ -55,6 +63,7 @@ def make_nn_descent(dist, dist_args):
         rp_tree_init=True,
         leaf_array=None,
         verbose=False,
+        update_counts=None,
     ):
         n_vertices = data.shape[0]
 
@@ -95,15 +104,15 @@ def make_nn_descent(dist, dist_args):
             c = 0
             for i in range(n_vertices):
                 for j in range(max_candidates):
-                    p = int(candidate_neighbors[0, i, j])
+                    p = int(candidate_neighbors[0][i, j])
                     if p < 0 or tau_rand(rng_state) < rho:
                         continue
                     for k in range(max_candidates):
-                        q = int(candidate_neighbors[0, i, k])
+                        q = int(candidate_neighbors[0][i, k])
                         if (
                             q < 0
-                            or not candidate_neighbors[2, i, j]
-                            and not candidate_neighbors[2, i, k]
+                            or not candidate_neighbors[2][i, j]
+                            and not candidate_neighbors[2][i, k]
                         ):
                             continue
 
@@ -111,6 +120,8 @@ def make_nn_descent(dist, dist_args):
                         c += heap_push(current_graph, p, d, q, 1)
                         c += heap_push(current_graph, q, d, p, 1)
 
+            if update_counts is not None:
+                update_counts[n] = c
             if c <= delta * n_neighbors * data.shape[0]:
                 break
 
@@ -119,6 +130,397 @@ def make_nn_descent(dist, dist_args):
     return nn_descent
 
 
+@numba.njit(cache=True)
+def range_bucket_offsets(bucket_counts):
+    """Lay out the buckets of a counting sort of entries by vertex range.
+
+    Parameters
+    ----------
+    bucket_counts: array of shape (n_blocks, n_blocks)
+        The number of entries that each block (row) produces for each range
+        (column).
+
+    Returns
+    -------
+    offsets: array of shape (n_blocks, n_blocks)
+        Where the entries of each block for each range start. The entries of
+        a range come from the blocks in order.
+
+    bucket_starts: array of shape (n_blocks + 1,)
+        Where the entries of each range start, and the total number of
+        entries.
+    """
+    n_blocks = bucket_counts.shape[0]
+    offsets = np.empty((n_blocks, n_blocks), dtype=np.int64)
+    bucket_starts = np.empty(n_blocks + 1, dtype=np.int64)
+    position = 0
+    for target in range(n_blocks):
+        bucket_starts[target] = position
+        for source in range(n_blocks):
+            offsets[source, target] = position
+            position += bucket_counts[source, target]
+    bucket_starts[n_blocks] = position
+    return offsets, bucket_starts
+
+
+@numba.njit(parallel=True, cache=True)
+def build_range_candidates(
+    current_graph, max_candidates, rng_states, range_size, reverse_edges
+):
+    """Build the heaps of new and old candidate neighbors for parallel
+    nearest neighbor descent. Every vertex gets its current neighbors and
+    the vertices that have it as a neighbor, in a random order. The edges
+    are first sorted by the range of the vertex they point to, so that each
+    block pushes the candidates of its own range from its own edges and the
+    edges that point into it, and the result only depends on the random
+    states of the blocks.
+
+    Parameters
+    ----------
+    current_graph: heap
+        The current state of the graph for nearest neighbor descent.
+
+    max_candidates: int
+        The maximum number of new, and of old, candidate neighbors.
+
+    rng_states: array of int64, shape (n_blocks, 3)
+        The internal state of the rng of each block.
+
+    range_size: int
+        The number of vertices in the range of each block.
+
+    reverse_edges: array of int64, shape (n_vertices * n_neighbors,)
+        Work space for the positions of the edges in the graph, sorted by
+        the range of the vertex they point to.
+
+    Returns
+    -------
+    new_candidates, old_candidates: heaps
+        The candidate neighbors reached through new, and through old, edges.
+    """
+    n_vertices = current_graph[0].shape[0]
+    n_neighbors = current_graph[0].shape[1]
+    n_blocks = rng_states.shape[0]
+
+    bucket_counts = np.zeros((n_blocks, n_blocks), dtype=np.int64)
+    for block in numba.prange(n_blocks):
+        for i in range(block * range_size, min((block + 1) * range_size, n_vertices)):
+            for j in range(n_neighbors):
+                idx = int(current_graph[0][i, j])
+                if idx >= 0:
+                    bucket_counts[block, idx // range_size] += 1
+    offsets, bucket_starts = range_bucket_offsets(bucket_counts)
+    for block in numba.prange(n_blocks):
+        for i in range(block * range_size, min((block + 1) * range_size, n_vertices)):
+            for j in range(n_neighbors):
+                idx = int(current_graph[0][i, j])
+                if idx >= 0:
+                    target = idx // range_size
+                    reverse_edges[offsets[block, target]] = i * n_neighbors + j
+                    offsets[block, target] += 1
+
+    new_candidates = make_heap(n_vertices, max_candidates)
+    old_candidates = make_heap(n_vertices, max_candidates)
+    for block in numba.prange(n_blocks):
+        rng_state = rng_states[block]
+        for i in range(block * range_size, min((block + 1) * range_size, n_vertices)):
+            for j in range(n_neighbors):
+                idx = int(current_graph[0][i, j])
+                if idx < 0:
+                    continue
+                d = tau_rand(rng_state)
+                if current_graph[2][i, j]:
+                    heap_push(new_candidates, i, d, idx, 1)
+                else:
+                    heap_push(old_candidates, i, d, idx, 1)
+        for k in range(bucket_starts[block], bucket_starts[block + 1]):
+            i = reverse_edges[k] // n_neighbors
+            j = reverse_edges[k] % n_neighbors
+            idx = int(current_graph[0][i, j])
+            d = tau_rand(rng_state)
+            if current_graph[2][i, j]:
+                heap_push(new_candidates, idx, d, i, 1)
+            else:
+                heap_push(old_candidates, idx, d, i, 1)
+    return new_candidates, old_candidates
+
+
+@numba.njit(parallel=True, cache=True)
+def merge_graph_updates(
+    current_graph,
+    update_rows,
+    update_cols,
+    update_dists,
+    n_updates,
+    range_size,
+    sorted_rows,
+    sorted_cols,
+    sorted_dists,
+):
+    """Push buffered updates into the nearest neighbor graph, in both
+    directions. The vertices are split into contiguous ranges of
+    ``range_size`` vertices, one per buffer. The updates of all the buffers
+    are first sorted by the range of the vertex they modify, keeping the
+    order of the buffers, and each range is then updated by a single thread
+    that only goes through its own updates.
+
+    Parameters
+    ----------
+    current_graph: heap
+        The current state of the graph for nearest neighbor descent.
+
+    update_rows, update_cols, update_dists: arrays of shape (n_blocks, capacity)
+        The two vertices and the distance of each buffered update.
+
+    n_updates: array of shape (n_blocks,)
+        The number of updates in each buffer.
+
+    range_size: int
+        The number of vertices in the range of each buffer.
+
+    sorted_rows, sorted_cols, sorted_dists: arrays of shape (2 * n_blocks * capacity,)
+        Work space for the updates sorted by range, in both directions.
+
+    Returns
+    -------
+    c: int
+        The number of updates that changed the graph.
+    """
+    n_blocks = n_updates.shape[0]
+    bucket_counts = np.zeros((n_blocks, n_blocks), dtype=np.int64)
+    for source in numba.prange(n_blocks):
+        for u in range(n_updates[source]):
+            bucket_counts[source, update_rows[source, u] // range_size] += 1
+            bucket_counts[source, update_cols[source, u] // range_size] += 1
+    offsets, bucket_starts = range_bucket_offsets(bucket_counts)
+    for source in numba.prange(n_blocks):
+        for u in range(n_updates[source]):
+            p = update_rows[source, u]
+            q = update_cols[source, u]
+            d = update_dists[source, u]
+            target = p // range_size
+            k = offsets[source, target]
+            sorted_rows[k] = p
+            sorted_cols[k] = q
+            sorted_dists[k] = d
+            offsets[source, target] = k + 1
+            target = q // range_size
+            k = offsets[source, target]
+            sorted_rows[k] = q
+            sorted_cols[k] = p
+            sorted_dists[k] = d
+            offsets[source, target] = k + 1
+
+    counts = np.zeros(n_blocks, dtype=np.int64)
+    for block in numba.prange(n_blocks):
+        for k in range(bucket_starts[block], bucket_starts[block + 1]):
+            counts[block] += heap_push(
+                current_graph, sorted_rows[k], sorted_dists[k], sorted_cols[k], 1
+            )
+    return counts.sum()
+
+
+@memoize_specialization
+def make_parallel_nn_descent(dist, dist_args):
+    """Create a numba accelerated version of nearest neighbor descent that
+    runs on several threads, specialised for the given distance metric and
+    metric arguments.
+
+    The vertices are split into one contiguous range per block, and each
+    block only ever modifies the heaps of its own range. An iteration builds
+    the candidate neighbors of every range in parallel, then evaluates the
+    candidate pairs of batches of vertices in parallel, each block buffering
+    the resulting (vertex, neighbor, distance) updates, and finally merges
+    all the buffers into the graph, each block applying the updates that
+    target its own range. Edges and updates are sorted by the range they
+    target first, so that each block only goes through its own share of
+    them. No heap is ever written by two threads, and the
+    result only depends on the random states of the blocks, not on the
+    scheduling of the threads.
+
+    Parameters
+    ----------
+    dist: function
+        A numba JITd distance function which, given two arrays computes a
+        dissimilarity between them.
+
+    dist_args: tuple
+        Any extra arguments that need to be passed to the distance function
+        beyond the two arrays to be compared.
+
+    Returns
+    -------
+    A numba JITd function for parallel nearest neighbor descent computation
+    that is specialised to the given metric. It takes an array of random
+    states of shape (n_blocks, 3), one per block, in place of the random
+    state of the serial version.
+    """
+
+    @numba.njit(parallel=True)
+    def parallel_nn_descent(
+        data,
+        n_neighbors,
+        rng_states,
+        max_candidates=50,
+        n_iters=10,
+        delta=0.001,
+        rp_tree_init=True,
+        leaf_array=None,
+        verbose=False,
+        update_counts=None,
+    ):
+        n_vertices = data.shape[0]
+        n_blocks = rng_states.shape[0]
+        range_size = (n_vertices + n_blocks - 1) // n_blocks
+
+        # Each buffer holds at least the updates from one vertex, or one leaf
+        pairs_per_vertex = (
+            max_candidates * (max_candidates - 1) // 2 + max_candidates ** 2
+        )
+        pairs_per_leaf = 1
+        if rp_tree_init:
+            pairs_per_leaf = max(
+                1, leaf_array.shape[1] * (leaf_array.shape[1] - 1) // 2
+            )
+        capacity = max(
+            NN_DESCENT_UPDATE_BUFFER_SIZE // n_blocks, pairs_per_vertex, pairs_per_leaf
+        )
+        update_rows = np.empty((n_blocks, capacity), dtype=np.int32)
+        update_cols = np.empty((n_blocks, capacity), dtype=np.int32)
+        update_dists = np.empty((n_blocks, capacity), dtype=np.float32)
+        n_updates = np.zeros(n_blocks, dtype=np.int64)
+        sorted_rows = np.empty(2 * n_blocks * capacity, dtype=np.int32)
+        sorted_cols = np.empty(2 * n_blocks * capacity, dtype=np.int32)
+        sorted_dists = np.empty(2 * n_blocks * capacity, dtype=np.float32)
+        reverse_edges = np.empty(n_vertices * n_neighbors, dtype=np.int64)
+
+        current_graph = make_heap(n_vertices, n_neighbors)
+        for block in numba.prange(n_blocks):
+            rng_state = rng_states[block]
+            for i in range(
+                block * range_size, min((block + 1) * range_size, n_vertices)
+            ):
+                # Every vertex is its own nearest neighbor, as in the serial
+                # descent, where it is found through the pair of a candidate
+                # with itself
+                heap_push(current_graph, i, dist(data[i], data[i], *dist_args), i, 0)
+                indices = rejection_sample(n_neighbors, n_vertices, rng_state)
+                for j in range(indices.shape[0]):
+                    d = dist(data[i], data[indices[j]], *dist_args)
+                    heap_push(current_graph, i, d, indices[j], 1)
+
+        # Pairs of points in the same leaf of the random projection forest
+        if rp_tree_init:
+            leaf_size = leaf_array.shape[1]
+            leaves_per_block = capacity // pairs_per_leaf
+            for start in range(0, leaf_array.shape[0], leaves_per_block * n_blocks):
+                for block in numba.prange(n_blocks):
+                    n_updates[block] = 0
+                    first = start + block * leaves_per_block
+                    last = min(first + leaves_per_block, leaf_array.shape[0])
+                    for n in range(first, last):
+                        for i in range(leaf_size):
+                            p = leaf_array[n, i]
+                            if p < 0:
+                                break
+                            for j in range(i + 1, leaf_size):
+                                q = leaf_array[n, j]
+                                if q < 0:
+                                    break
+                                d = dist(data[p], data[q], *dist_args)
+                                if (
+                                    d < current_graph[1][p, 0]
+                                    or d < current_graph[1][q, 0]
+                                ):
+                                    update_rows[block, n_updates[block]] = p
+                                    update_cols[block, n_updates[block]] = q
+                                    update_dists[block, n_updates[block]] = d
+                                    n_updates[block] += 1
+                merge_graph_updates(
+                    current_graph,
+                    update_rows,
+                    update_cols,
+                    update_dists,
+                    n_updates,
+                    range_size,
+                    sorted_rows,
+                    sorted_cols,
+                    sorted_dists,
+                )
+
+        vertices_per_block = capacity // pairs_per_vertex
+        for n in range(n_iters):
+            if verbose:
+                print("\t", n, " / ", n_iters)
+
+            new_candidates, old_candidates = build_range_candidates(
+                current_graph, max_candidates, rng_states, range_size, reverse_edges
+            )
+
+            # Neighbors that made it into the new candidates are now old
+            for i in numba.prange(n_vertices):
+                for j in range(n_neighbors):
+                    if not current_graph[2][i, j]:
+                        continue
+                    for k in range(max_candidates):
+                        if new_candidates[0][i, k] == current_graph[0][i, j]:
+                            current_graph[2][i, j] = 0
+                            break
+
+            # Pairs of new candidates, and of new and old candidates, of a
+            # batch of vertices, keeping those that would enter the graph
+            c = 0
+            for start in range(0, n_vertices, vertices_per_block * n_blocks):
+                for block in numba.prange(n_blocks):
+                    n_updates[block] = 0
+                    first = start + block * vertices_per_block
+                    last = min(first + vertices_per_block, n_vertices)
+                    for i in range(first, last):
+                        for j in range(max_candidates):
+                            p = int(new_candidates[0][i, j])
+                            if p < 0:
+                                continue
+                            for k in range(j + 1, 2 * max_candidates):
+                                if k < max_candidates:
+                                    q = int(new_candidates[0][i, k])
+                                else:
+                                    q = int(
+                                        old_candidates[0][i, k - max_candidates]
+                                    )
+                                if q < 0 or q == p:
+                                    continue
+                                d = dist(data[p], data[q], *dist_args)
+                                if (
+                                    d < current_graph[1][p, 0]
+                                    or d < current_graph[1][q, 0]
+                                ):
+                                    update_rows[block, n_updates[block]] = p
+                                    update_cols[block, n_updates[block]] = q
+                                    update_dists[block, n_updates[block]] = d
+                                    n_updates[block] += 1
+                c += merge_graph_updates(
+                    current_graph,
+                    update_rows,
+                    update_cols,
+                    update_dists,
+                    n_updates,
+                    range_size,
+                    sorted_rows,
+                    sorted_cols,
+                    sorted_dists,
+                )
+
+            if update_counts is not None:
+                update_counts[n] = c
+            if c <= delta * n_neighbors * n_vertices:
+                break
+
+        return deheap_sort(current_graph)
+
+    return parallel_nn_descent
+
+
+@memoize_specialization
 def make_initialisations(dist, dist_args):
     @numba.njit(parallel=True)
     def init_from_random(n_neighbors, data, query_points, heap, rng_state):
@@ -166,13 +568,14 @@ def initialise_search(
     return results
 
 
+@memoize_specialization
 def make_initialized_nnd_search(dist, dist_args):
     @numba.njit(parallel=True)
     def initialized_nnd_search(data, indptr, indices, initialization, query_points):
 
         for i in numba.prange(query_points.shape[0]):
 
-            tried = set(initialization[0, i])
+            tried = set(initialization[0][i])
 
             while True:
 
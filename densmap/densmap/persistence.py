@@ -0,0 +1,175 @@
+# Authors: Ashwin Narayan and Hyunghoon Cho
+#
+# License: MIT
+"""Saving fitted densMAP models to, and loading them from, a directory.
+
+The numeric state of a model (the training data, the embedding, the k-nearest
+neighbor graph, the fuzzy simplicial set, the search graph and the random
+projection forest) is written as flat ``.npy`` files, with sparse matrices
+split into their CSR arrays and every random projection tree into its
+fields. The remaining attributes are pickled into a single small file.
+Loading a model can then memory-map the arrays, so that it takes about the
+same time whatever the size of the model. The compiled search functions are
+not saved: the model builds them again on its first ``transform``.
+"""
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.sparse
+
+from densmap.rp_tree import FlatTree
+
+STATE_FILE = "state.pkl"
+FORMAT_VERSION = 1
+
+# Attributes that only cache values derived from the rest of the state
+TRANSIENT_ATTRIBUTES = (
+    "_transform_workspace",
+    "_transform_lock",
+    "_search_functions",
+)
+
+
+def _is_forest(value):
+    return (
+        isinstance(value, list)
+        and len(value) > 0
+        and all(isinstance(tree, FlatTree) for tree in value)
+    )
+
+
+def save_model(model, path):
+    """Save a fitted model to a directory.
+
+    Parameters
+    ----------
+    model: densMAP
+        The fitted model.
+
+    path: str
+        The directory to save the model to. It must not exist, unless it
+        holds a previously saved model, which is then replaced.
+    """
+    if os.path.exists(path) and not os.path.exists(os.path.join(path, STATE_FILE)):
+        raise ValueError(
+            "{} exists and does not hold a saved model".format(path)
+        )
+
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+
+    # write to a temporary directory first so that an interrupted save never
+    # leaves a partially written model behind
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=parent)
+    try:
+        arrays = []
+        sparse = {}
+        forests = {}
+        state = {}
+        for name, value in model.__dict__.items():
+            if name in TRANSIENT_ATTRIBUTES:
+                continue
+            if isinstance(value, np.ndarray) and value.dtype != object:
+                np.save(os.path.join(tmp_dir, name + ".npy"), value)
+                arrays.append(name)
+            elif scipy.sparse.issparse(value):
+                value = value.tocsr()
+                for field in ("data", "indices", "indptr"):
+                    np.save(
+                        os.path.join(tmp_dir, "%s_%s.npy" % (name, field)),
+                        getattr(value, field),
+                    )
+                sparse[name] = value.shape
+            elif _is_forest(value):
+                for i, tree in enumerate(value):
+                    for field in FlatTree._fields:
+                        np.save(
+                            os.path.join(tmp_dir, "%s%d_%s.npy" % (name, i, field)),
+                            getattr(tree, field),
+                        )
+                forests[name] = len(value)
+            else:
+                state[name] = value
+
+        with open(os.path.join(tmp_dir, STATE_FILE), "wb") as f:
+            pickle.dump(
+                {
+                    "format": FORMAT_VERSION,
+                    "class": type(model),
+                    "state": state,
+                    "arrays": arrays,
+                    "sparse": sparse,
+                    "forests": forests,
+                },
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_dir, path)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def load_model(path, mmap=True):
+    """Load a model saved by ``save_model``.
+
+    Parameters
+    ----------
+    path: str
+        The directory the model was saved to.
+
+    mmap: bool (optional, default True)
+        Whether to memory-map the arrays of the model rather than read them
+        into memory. The arrays are mapped copy-on-write: they can be
+        modified in memory, but the changes are never written back.
+
+    Returns
+    -------
+    model: densMAP
+        The fitted model.
+    """
+    with open(os.path.join(path, STATE_FILE), "rb") as f:
+        saved = pickle.load(f)
+    if saved["format"] != FORMAT_VERSION:
+        raise ValueError(
+            "Unsupported saved model format {}".format(saved["format"])
+        )
+
+    mmap_mode = "c" if mmap else None
+
+    def load_array(name):
+        # a plain ndarray view, which the compiled kernels accept as is
+        return np.asarray(
+            np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+        )
+
+    state = saved["state"]
+    for name in saved["arrays"]:
+        state[name] = load_array(name)
+    for name, shape in saved["sparse"].items():
+        state[name] = scipy.sparse.csr_matrix(
+            (
+                load_array(name + "_data"),
+                load_array(name + "_indices"),
+                load_array(name + "_indptr"),
+            ),
+            shape=shape,
+            copy=False,
+        )
+    for name, n_trees in saved["forests"].items():
+        state[name] = [
+            FlatTree(*[load_array("%s%d_%s" % (name, i, field)) for field in FlatTree._fields])
+            for i in range(n_trees)
+        ]
+
+    # restored as unpickling does, without calling __init__
+    model = saved["class"].__new__(saved["class"])
+    model.__setstate__(state)
+    return model
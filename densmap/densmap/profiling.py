@@ -0,0 +1,112 @@
+# Authors: Ashwin Narayan and Hyunghoon Cho
+#
+# License: MIT
+"""Timing and peak memory of the stages of a densMAP fit.
+
+Every stage records its wall-clock time, the peak resident set size of the
+process when it ended and how much it raised that peak, along with
+stage-specific details such as the number of graph updates of each nearest
+neighbor descent iteration. The report of a fit is kept in the ``profile_``
+attribute of the model and can be written as JSON, so that runs can be
+compared with one another.
+"""
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def peak_rss_mb():
+    """The peak resident set size of the process so far, in MiB, or None
+    where it is not available."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes rather than kilobytes
+        peak //= 1024
+    return round(peak / 1024.0, 1)
+
+
+class FitProfile(object):
+    """The stages of a densMAP fit, in the order they ran.
+
+    Each stage is a dict with its ``name``, its wall-clock time in
+    ``seconds``, the peak resident set size of the process when it ended
+    (``peak_rss_mb``), how much the stage raised that peak
+    (``peak_rss_increase_mb``) and any details the stage recorded.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    def begin(self, name, **details):
+        """Start timing a stage and return its record, which can be given
+        further details until ``end`` is called on it."""
+        stage = dict(name=name, **details)
+        stage["_start"] = time.perf_counter()
+        stage["_peak_rss_mb"] = peak_rss_mb()
+        return stage
+
+    def end(self, stage):
+        """Stop timing a stage started by ``begin`` and add it to the
+        report."""
+        stage["seconds"] = round(time.perf_counter() - stage.pop("_start"), 4)
+        before = stage.pop("_peak_rss_mb")
+        stage["peak_rss_mb"] = peak_rss_mb()
+        if before is None:
+            stage["peak_rss_increase_mb"] = None
+        else:
+            stage["peak_rss_increase_mb"] = round(stage["peak_rss_mb"] - before, 1)
+        self.stages.append(stage)
+
+    @contextmanager
+    def stage(self, name, **details):
+        """Time the body of a ``with`` statement as a stage; the record of
+        the stage is bound by ``as`` to add details to it."""
+        stage = self.begin(name, **details)
+        try:
+            yield stage
+        finally:
+            self.end(stage)
+
+    def __getitem__(self, name):
+        """The first stage called ``name``."""
+        for stage in self.stages:
+            if stage["name"] == name:
+                return stage
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        return any(stage["name"] == name for stage in self.stages)
+
+    @property
+    def total_seconds(self):
+        return round(sum(stage["seconds"] for stage in self.stages), 4)
+
+    def to_dict(self):
+        return {"total_seconds": self.total_seconds, "stages": self.stages}
+
+    def to_json(self, path=None):
+        """Write the report as JSON to ``path``, or return it as a string if
+        ``path`` is None."""
+        if path is None:
+            return json.dumps(self.to_dict(), indent=2)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def __repr__(self):
+        lines = ["FitProfile({:.2f} s)".format(self.total_seconds)]
+        for stage in self.stages:
+            lines.append(
+                "  {:<24} {:>9.3f} s  peak {} MiB".format(
+                    stage["name"], stage["seconds"], stage["peak_rss_mb"]
+                )
+            )
+        return "\n".join(lines)
@@ -2,8 +2,8 @@
 #
 # License: BSD 3 clause
 from __future__ import print_function
-from collections import deque, namedtuple
-from warnings import warn
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import numba
@@ -20,15 +20,10 @@ locale.setlocale(locale.LC_NUMERIC, "C")
 # Used for a floating point "nearly zero" comparison
 EPS = 1e-8
 
-RandomProjectionTreeNode = namedtuple(
-    "RandomProjectionTreeNode",
-    ["indices", "is_leaf", "hyperplane", "offset", "left_child", "right_child"],
-)
-
 FlatTree = namedtuple("FlatTree", ["hyperplanes", "offsets", "children", "indices"])
 
 
-@numba.njit(fastmath=True)
+@numba.njit(fastmath=True, nogil=True, cache=True)
 def angular_random_projection_split(data, indices, rng_state):
     """Given a set of ``indices`` for data points from ``data``, create
     a random hyperplane to split the data, returning two arrays indices
@@ -131,7 +126,7 @@ def angular_random_projection_split(data, indices, rng_state):
     return indices_left, indices_right, hyperplane_vector, None
 
 
-@numba.njit(fastmath=True, nogil=True)
+@numba.njit(fastmath=True, nogil=True, cache=True)
 def euclidean_random_projection_split(data, indices, rng_state):
     """Given a set of ``indices`` for data points from ``data``, create
     a random hyperplane to split the data, returning two arrays indices
@@ -220,7 +215,7 @@ def euclidean_random_projection_split(data, indices, rng_state):
     return indices_left, indices_right, hyperplane_vector, hyperplane_offset
 
 
-@numba.njit(fastmath=True)
+@numba.njit(fastmath=True, nogil=True, cache=True)
 def sparse_angular_random_projection_split(inds, indptr, data, indices, rng_state):
     """Given a set of ``indices`` for data points from a sparse data set
     presented in csr sparse format as inds, indptr and data, create
@@ -338,7 +333,7 @@ def sparse_angular_random_projection_split(inds, indptr, data, indices, rng_stat
     return indices_left, indices_right, hyperplane, None
 
 
-@numba.njit(fastmath=True)
+@numba.njit(fastmath=True, nogil=True, cache=True)
 def sparse_euclidean_random_projection_split(inds, indptr, data, indices, rng_state):
     """Given a set of ``indices`` for data points from a sparse data set
     presented in csr sparse format as inds, indptr and data, create
@@ -447,84 +442,253 @@ def sparse_euclidean_random_projection_split(inds, indptr, data, indices, rng_st
     return indices_left, indices_right, hyperplane, hyperplane_offset
 
 
-def make_euclidean_tree(data, indices, rng_state, leaf_size=30):
-    if indices.shape[0] > leaf_size:
-        left_indices, right_indices, hyperplane, offset = euclidean_random_projection_split(
-            data, indices, rng_state
-        )
-
-        left_node = make_euclidean_tree(data, left_indices, rng_state, leaf_size)
-        right_node = make_euclidean_tree(data, right_indices, rng_state, leaf_size)
-
-        node = RandomProjectionTreeNode(
-            None, False, hyperplane, offset, left_node, right_node
-        )
-    else:
-        node = RandomProjectionTreeNode(indices, True, None, None, None, None)
-
-    return node
-
-
-def make_angular_tree(data, indices, rng_state, leaf_size=30):
-    if indices.shape[0] > leaf_size:
-        left_indices, right_indices, hyperplane, offset = angular_random_projection_split(
-            data, indices, rng_state
-        )
-
-        left_node = make_angular_tree(data, left_indices, rng_state, leaf_size)
-        right_node = make_angular_tree(data, right_indices, rng_state, leaf_size)
-
-        node = RandomProjectionTreeNode(
-            None, False, hyperplane, offset, left_node, right_node
-        )
-    else:
-        node = RandomProjectionTreeNode(indices, True, None, None, None, None)
-
-    return node
-
-
-def make_sparse_euclidean_tree(inds, indptr, data, indices, rng_state, leaf_size=30):
-    if indices.shape[0] > leaf_size:
-        left_indices, right_indices, hyperplane, offset = sparse_euclidean_random_projection_split(
-            inds, indptr, data, indices, rng_state
-        )
-
-        left_node = make_sparse_euclidean_tree(
-            inds, indptr, data, left_indices, rng_state, leaf_size
-        )
-        right_node = make_sparse_euclidean_tree(
-            inds, indptr, data, right_indices, rng_state, leaf_size
-        )
+@numba.njit(nogil=True, cache=True)
+def random_split(indices, rng_state):
+    """Split ``indices`` in two at random, for the nodes that a random
+    projection fails to split, e.g. because all their points are the same.
+    Points on a zero hyperplane are sent to a random side, so a node with a
+    zero hyperplane is searched consistently with this split.
+    Parameters
+    ----------
+    indices: array of shape (tree_node_size,)
+        The indices of the elements to be split, at least two.
+    rng_state: array of int64, shape (3,)
+        The internal state of the rng
+    Returns
+    -------
+    indices_left: array
+        The elements of ``indices`` sent to the "left" side.
+    indices_right: array
+        The elements of ``indices`` sent to the "right" side.
+    """
+    side = np.empty(indices.shape[0], np.int8)
+    n_left = 0
+    for i in range(indices.shape[0]):
+        side[i] = tau_rand_int(rng_state) % 2
+        n_left += side[i] == 0
+    if n_left == 0 or n_left == indices.shape[0]:
+        side[0] = 1 - side[0]
+        n_left += 1 if side[0] == 0 else -1
 
-        node = RandomProjectionTreeNode(
-            None, False, hyperplane, offset, left_node, right_node
-        )
-    else:
-        node = RandomProjectionTreeNode(indices, True, None, None, None, None)
+    indices_left = np.empty(n_left, dtype=np.int64)
+    indices_right = np.empty(indices.shape[0] - n_left, dtype=np.int64)
+    n_left = 0
+    n_right = 0
+    for i in range(side.shape[0]):
+        if side[i] == 0:
+            indices_left[n_left] = indices[i]
+            n_left += 1
+        else:
+            indices_right[n_right] = indices[i]
+            n_right += 1
 
-    return node
+    return indices_left, indices_right
+
+
+@numba.njit(nogil=True, cache=True)
+def leaf_indices(order, leaf_bounds, n_leaves, leaf_size):
+    """The indices of the points of each leaf, padded with -1, given the
+    bounds of the leaves in the ``order`` of the points along the tree."""
+    indices = np.full((n_leaves, leaf_size), -1, dtype=np.int64)
+    for leaf in range(n_leaves):
+        start = leaf_bounds[leaf, 0]
+        end = leaf_bounds[leaf, 1]
+        indices[leaf, : end - start] = order[start:end]
+    return indices
+
+
+@numba.njit(nogil=True, cache=True)
+def make_dense_tree(data, rng_state, leaf_size=30, angular=False):
+    """Construct a random projection tree based on dense ``data`` with
+    leaves of size at most ``leaf_size``, as the arrays of a ``FlatTree``.
+    The nodes are split iteratively, their hyperplanes and offsets written
+    directly into arrays grown as needed, so that arbitrarily deep trees
+    can be built. Nodes that a random projection leaves on a single side
+    are split at random (see ``random_split``).
+    Parameters
+    ----------
+    data: array of shape (n_samples, n_features)
+        The original data to be split
+    rng_state: array of int64, shape (3,)
+        The internal state of the rng
+    leaf_size: int (optional, default 30)
+        The maximum size of any leaf node in the tree.
+    angular: bool (optional, default False)
+        Whether to use cosine/angular distance to create splits in the tree,
+        or euclidean distance.
+    Returns
+    -------
+    hyperplanes, offsets, children, indices: arrays
+        The fields of the ``FlatTree``.
+    """
+    n_samples = data.shape[0]
+    # The points of each node are contiguous in order
+    order = np.arange(n_samples)
+    capacity = 2 * (n_samples // leaf_size) + 1
+    hyperplanes = np.zeros((capacity, data.shape[1]), dtype=np.float32)
+    offsets = np.zeros(capacity, dtype=np.float32)
+    children = np.full((capacity, 2), -1, dtype=np.int64)
+    leaf_bounds = np.empty((capacity, 2), dtype=np.int64)
+    n_nodes = 1
+    n_leaves = 0
+
+    # The nodes still to be built, as (node, start, end) in order
+    stack = [(0, 0, n_samples)]
+    while len(stack) > 0:
+        node, start, end = stack.pop()
+        if end - start <= leaf_size:
+            children[node, 0] = -n_leaves
+            leaf_bounds[n_leaves, 0] = start
+            leaf_bounds[n_leaves, 1] = end
+            n_leaves += 1
+            continue
 
+        if angular:
+            left, right, hyperplane, _ = angular_random_projection_split(
+                data, order[start:end], rng_state
+            )
+            offset = 0.0
+        else:
+            left, right, hyperplane, offset = euclidean_random_projection_split(
+                data, order[start:end], rng_state
+            )
+        if left.shape[0] == 0 or right.shape[0] == 0:
+            left, right = random_split(order[start:end], rng_state)
+            hyperplane[:] = 0.0
+            offset = 0.0
+
+        if n_nodes + 2 > capacity:
+            capacity *= 2
+            new_hyperplanes = np.zeros((capacity, data.shape[1]), dtype=np.float32)
+            new_hyperplanes[:n_nodes] = hyperplanes[:n_nodes]
+            hyperplanes = new_hyperplanes
+            new_offsets = np.zeros(capacity, dtype=np.float32)
+            new_offsets[:n_nodes] = offsets[:n_nodes]
+            offsets = new_offsets
+            new_children = np.full((capacity, 2), -1, dtype=np.int64)
+            new_children[:n_nodes] = children[:n_nodes]
+            children = new_children
+            new_leaf_bounds = np.empty((capacity, 2), dtype=np.int64)
+            new_leaf_bounds[:n_leaves] = leaf_bounds[:n_leaves]
+            leaf_bounds = new_leaf_bounds
+
+        hyperplanes[node] = hyperplane
+        offsets[node] = offset
+        children[node, 0] = n_nodes
+        children[node, 1] = n_nodes + 1
+        middle = start + left.shape[0]
+        order[start:middle] = left
+        order[middle:end] = right
+        # The left child is built first, as by a depth first recursion
+        stack.append((n_nodes + 1, middle, end))
+        stack.append((n_nodes, start, middle))
+        n_nodes += 2
+
+    return (
+        hyperplanes[:n_nodes].copy(),
+        offsets[:n_nodes].copy(),
+        children[:n_nodes].copy(),
+        leaf_indices(order, leaf_bounds, n_leaves, leaf_size),
+    )
 
-def make_sparse_angular_tree(inds, indptr, data, indices, rng_state, leaf_size=30):
-    if indices.shape[0] > leaf_size:
-        left_indices, right_indices, hyperplane, offset = sparse_angular_random_projection_split(
-            inds, indptr, data, indices, rng_state
-        )
 
-        left_node = make_sparse_angular_tree(
-            inds, indptr, data, left_indices, rng_state, leaf_size
-        )
-        right_node = make_sparse_angular_tree(
-            inds, indptr, data, right_indices, rng_state, leaf_size
-        )
-
-        node = RandomProjectionTreeNode(
-            None, False, hyperplane, offset, left_node, right_node
-        )
-    else:
-        node = RandomProjectionTreeNode(indices, True, None, None, None, None)
+@numba.njit(nogil=True, cache=True)
+def make_sparse_tree(inds, indptr, data, rng_state, leaf_size=30, angular=False):
+    """Construct a random projection tree based on a sparse data set
+    presented in csr sparse format as inds, indptr and data, with leaves of
+    size at most ``leaf_size``, as the arrays of a ``FlatTree``. This is
+    built as by ``make_dense_tree``; the hyperplane of each node is stored
+    as its (padded) rows of feature indices and values.
+    Parameters
+    ----------
+    inds: array
+        CSR format index array of the matrix
+    indptr: array
+        CSR format index pointer array of the matrix
+    data: array
+        CSR format data array of the matrix
+    rng_state: array of int64, shape (3,)
+        The internal state of the rng
+    leaf_size: int (optional, default 30)
+        The maximum size of any leaf node in the tree.
+    angular: bool (optional, default False)
+        Whether to use cosine/angular distance to create splits in the tree,
+        or euclidean distance.
+    Returns
+    -------
+    hyperplanes, offsets, children, indices: arrays
+        The fields of the ``FlatTree``.
+    """
+    n_samples = indptr.shape[0] - 1
+    order = np.arange(n_samples)
+    capacity = 2 * (n_samples // leaf_size) + 1
+    max_nnz = 1
+    hyperplanes = np.zeros((capacity, 2, max_nnz), dtype=np.float32)
+    offsets = np.zeros(capacity, dtype=np.float32)
+    children = np.full((capacity, 2), -1, dtype=np.int64)
+    leaf_bounds = np.empty((capacity, 2), dtype=np.int64)
+    n_nodes = 1
+    n_leaves = 0
+
+    stack = [(0, 0, n_samples)]
+    while len(stack) > 0:
+        node, start, end = stack.pop()
+        if end - start <= leaf_size:
+            children[node, 0] = -n_leaves
+            leaf_bounds[n_leaves, 0] = start
+            leaf_bounds[n_leaves, 1] = end
+            n_leaves += 1
+            continue
 
-    return node
+        if angular:
+            left, right, hyperplane, _ = sparse_angular_random_projection_split(
+                inds, indptr, data, order[start:end], rng_state
+            )
+            offset = 0.0
+        else:
+            left, right, hyperplane, offset = sparse_euclidean_random_projection_split(
+                inds, indptr, data, order[start:end], rng_state
+            )
+        nnz = hyperplane.shape[1]
+        if left.shape[0] == 0 or right.shape[0] == 0:
+            left, right = random_split(order[start:end], rng_state)
+            nnz = 0
+            offset = 0.0
+
+        if n_nodes + 2 > capacity or nnz > max_nnz:
+            if n_nodes + 2 > capacity:
+                capacity *= 2
+            max_nnz = max(max_nnz, nnz)
+            new_hyperplanes = np.zeros((capacity, 2, max_nnz), dtype=np.float32)
+            new_hyperplanes[:n_nodes, :, : hyperplanes.shape[2]] = hyperplanes[:n_nodes]
+            hyperplanes = new_hyperplanes
+            new_offsets = np.zeros(capacity, dtype=np.float32)
+            new_offsets[:n_nodes] = offsets[:n_nodes]
+            offsets = new_offsets
+            new_children = np.full((capacity, 2), -1, dtype=np.int64)
+            new_children[:n_nodes] = children[:n_nodes]
+            children = new_children
+            new_leaf_bounds = np.empty((capacity, 2), dtype=np.int64)
+            new_leaf_bounds[:n_leaves] = leaf_bounds[:n_leaves]
+            leaf_bounds = new_leaf_bounds
+
+        hyperplanes[node, :, :nnz] = hyperplane[:, :nnz]
+        offsets[node] = offset
+        children[node, 0] = n_nodes
+        children[node, 1] = n_nodes + 1
+        middle = start + left.shape[0]
+        order[start:middle] = left
+        order[middle:end] = right
+        stack.append((n_nodes + 1, middle, end))
+        stack.append((n_nodes, start, middle))
+        n_nodes += 2
+
+    return (
+        hyperplanes[:n_nodes].copy(),
+        offsets[:n_nodes].copy(),
+        children[:n_nodes].copy(),
+        leaf_indices(order, leaf_bounds, n_leaves, leaf_size),
+    )
 
 
 def make_tree(data, rng_state, leaf_size=30, angular=False):
@@ -532,7 +696,7 @@ def make_tree(data, rng_state, leaf_size=30, angular=False):
     of size at most ``leaf_size``.
     Parameters
     ----------
-    data: array of shape (n_samples, n_features)
+    data: array of shape (n_samples, n_features) or csr_matrix
         The original data to be split
     rng_state: array of int64, shape (3,)
         The internal state of the rng
@@ -545,122 +709,19 @@ def make_tree(data, rng_state, leaf_size=30, angular=False):
         or euclidean distance.
     Returns
     -------
-    node: RandomProjectionTreeNode
-        A random projection tree node which links to its child nodes. This
-        provides the full tree below the returned node.
+    tree: FlatTree
+        The random projection tree, flattened into arrays.
     """
-    is_sparse = scipy.sparse.isspmatrix_csr(data)
-    indices = np.arange(data.shape[0])
-
-    # Make a tree recursively until we get below the leaf size
-    if is_sparse:
-        inds = data.indices
-        indptr = data.indptr
-        spdata = data.data
-
-        if angular:
-            return make_sparse_angular_tree(
-                inds, indptr, spdata, indices, rng_state, leaf_size
+    if scipy.sparse.isspmatrix_csr(data):
+        return FlatTree(
+            *make_sparse_tree(
+                data.indices, data.indptr, data.data, rng_state, leaf_size, angular
             )
-        else:
-            return make_sparse_euclidean_tree(
-                inds, indptr, spdata, indices, rng_state, leaf_size
-            )
-    else:
-        if angular:
-            return make_angular_tree(data, indices, rng_state, leaf_size)
-        else:
-            return make_euclidean_tree(data, indices, rng_state, leaf_size)
-
-
-def num_nodes(tree):
-    """Determine the number of nodes in a tree"""
-    if tree.is_leaf:
-        return 1
-    else:
-        return 1 + num_nodes(tree.left_child) + num_nodes(tree.right_child)
-
-
-def num_leaves(tree):
-    """Determine the number of leaves in a tree"""
-    if tree.is_leaf:
-        return 1
-    else:
-        return num_leaves(tree.left_child) + num_leaves(tree.right_child)
-
-
-def max_sparse_hyperplane_size(tree):
-    """Determine the most number on non zeros in a hyperplane entry"""
-    if tree.is_leaf:
-        return 0
-    else:
-        return max(
-            tree.hyperplane.shape[1],
-            max_sparse_hyperplane_size(tree.left_child),
-            max_sparse_hyperplane_size(tree.right_child),
         )
+    return FlatTree(*make_dense_tree(data, rng_state, leaf_size, angular))
 
 
-def recursive_flatten(
-    tree, hyperplanes, offsets, children, indices, node_num, leaf_num
-):
-    if tree.is_leaf:
-        children[node_num, 0] = -leaf_num
-        indices[leaf_num, : tree.indices.shape[0]] = tree.indices
-        leaf_num += 1
-        return node_num, leaf_num
-    else:
-        if len(tree.hyperplane.shape) > 1:
-            # spare case
-            hyperplanes[node_num][:, : tree.hyperplane.shape[1]] = tree.hyperplane
-        else:
-            hyperplanes[node_num] = tree.hyperplane
-        offsets[node_num] = tree.offset
-        children[node_num, 0] = node_num + 1
-        old_node_num = node_num
-        node_num, leaf_num = recursive_flatten(
-            tree.left_child,
-            hyperplanes,
-            offsets,
-            children,
-            indices,
-            node_num + 1,
-            leaf_num,
-        )
-        children[old_node_num, 1] = node_num + 1
-        node_num, leaf_num = recursive_flatten(
-            tree.right_child,
-            hyperplanes,
-            offsets,
-            children,
-            indices,
-            node_num + 1,
-            leaf_num,
-        )
-        return node_num, leaf_num
-
-
-def flatten_tree(tree, leaf_size):
-    n_nodes = num_nodes(tree)
-    n_leaves = num_leaves(tree)
-
-    if len(tree.hyperplane.shape) > 1:
-        # sparse case
-        max_hyperplane_nnz = max_sparse_hyperplane_size(tree)
-        hyperplanes = np.zeros(
-            (n_nodes, tree.hyperplane.shape[0], max_hyperplane_nnz), dtype=np.float32
-        )
-    else:
-        hyperplanes = np.zeros((n_nodes, tree.hyperplane.shape[0]), dtype=np.float32)
-
-    offsets = np.zeros(n_nodes, dtype=np.float32)
-    children = -1 * np.ones((n_nodes, 2), dtype=np.int64)
-    indices = -1 * np.ones((n_leaves, leaf_size), dtype=np.int64)
-    recursive_flatten(tree, hyperplanes, offsets, children, indices, 0, 0)
-    return FlatTree(hyperplanes, offsets, children, indices)
-
-
-@numba.njit()
+@numba.njit(cache=True)
 def select_side(hyperplane, offset, point, rng_state):
     margin = offset
     for d in range(point.shape[0]):
@@ -678,7 +739,7 @@ def select_side(hyperplane, offset, point, rng_state):
         return 1
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def search_flat_tree(point, hyperplanes, offsets, children, indices, rng_state):
     node = 0
     while children[node, 0] > 0:
@@ -692,36 +753,46 @@ def search_flat_tree(point, hyperplanes, offsets, children, indices, rng_state):
 
 
 def make_forest(data, n_neighbors, n_trees, rng_state, angular=False):
-    """Build a random projection forest with ``n_trees``.
+    """Build a random projection forest with ``n_trees``. The trees are
+    built concurrently, on up to ``NUMBA_NUM_THREADS`` threads, each with
+    its own random state drawn from ``rng_state``, so that the forest does
+    not depend on the number of threads.
 
     Parameters
     ----------
-    data
-    n_neighbors
-    n_trees
-    rng_state
-    angular
+    data: array of shape (n_samples, n_features) or csr_matrix
+        The data to build the trees of.
+    n_neighbors: int
+        The number of nearest neighbors the leaves should hold candidates
+        for; the leaves have at most max(10, n_neighbors) points.
+    n_trees: int
+        The number of trees to build.
+    rng_state: array of int64, shape (3,)
+        The internal state of the rng
+    angular: bool (optional, default False)
+        Whether to use angular/cosine distance for random projection tree
+        construction.
 
     Returns
     -------
     forest: list
-        A list of random projection trees.
+        A list of random projection trees, as FlatTree.
     """
-    result = []
     leaf_size = max(10, n_neighbors)
-    try:
-        result = [
-            flatten_tree(make_tree(data, rng_state, leaf_size, angular), leaf_size)
-            for i in range(n_trees)
-        ]
-    except (RuntimeError, RecursionError, SystemError):
-        warn(
-            "Random Projection forest initialisation failed due to recursion"
-            "limit being reached. Something is a little strange with your "
-            "data, and this may take longer than normal to compute."
-        )
-
-    return result
+    tree_rng_states = np.empty((n_trees, 3), dtype=np.int64)
+    for i in range(n_trees):
+        for c in range(3):
+            tree_rng_states[i, c] = tau_rand_int(rng_state)
+
+    def build(tree_rng_state):
+        return make_tree(data, tree_rng_state, leaf_size, angular)
+
+    n_threads = min(n_trees, numba.config.NUMBA_NUM_THREADS)
+    if n_threads <= 1:
+        return [build(tree_rng_state) for tree_rng_state in tree_rng_states]
+    # The tree builders release the GIL
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(build, tree_rng_states))
 
 
 def rptree_leaf_array(rp_forest):
@@ -16,13 +16,14 @@ from densmap.utils import (
     build_candidates,
     deheap_sort,
 )
+from densmap.specializations import memoize_specialization
 
 import locale
 
 locale.setlocale(locale.LC_NUMERIC, "C")
 
 # Just reproduce a simpler version of numpy unique (not numba supported yet)
-@numba.njit()
+@numba.njit(cache=True)
 def arr_unique(arr):
     aux = np.sort(arr)
     flag = np.concatenate((np.ones(1, dtype=np.bool_), aux[1:] != aux[:-1]))
@@ -30,26 +31,27 @@ def arr_unique(arr):
 
 
 # Just reproduce a simpler version of numpy union1d (not numba supported yet)
-@numba.njit()
+@numba.njit(cache=True)
 def arr_union(ar1, ar2):
+    # Copies, as the result is written into by sparse_sum
     if ar1.shape[0] == 0:
-        return ar2
+        return ar2.copy()
     elif ar2.shape[0] == 0:
-        return ar1
+        return ar1.copy()
     else:
         return arr_unique(np.concatenate((ar1, ar2)))
 
 
 # Just reproduce a simpler version of numpy intersect1d (not numba supported
 # yet)
-@numba.njit()
+@numba.njit(cache=True)
 def arr_intersect(ar1, ar2):
     aux = np.concatenate((ar1, ar2))
     aux.sort()
     return aux[:-1][aux[1:] == aux[:-1]]
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_sum(ind1, data1, ind2, data2):
     result_ind = arr_union(ind1, ind2)
     result_data = np.zeros(result_ind.shape[0], dtype=np.float32)
@@ -90,7 +92,7 @@ def sparse_sum(ind1, data1, ind2, data2):
     while i1 < ind1.shape[0]:
         val = data1[i1]
         if val != 0:
-            result_ind[nnz] = i1
+            result_ind[nnz] = ind1[i1]
             result_data[nnz] = val
             nnz += 1
         i1 += 1
@@ -98,7 +100,7 @@ def sparse_sum(ind1, data1, ind2, data2):
     while i2 < ind2.shape[0]:
         val = data2[i2]
         if val != 0:
-            result_ind[nnz] = i2
+            result_ind[nnz] = ind2[i2]
             result_data[nnz] = val
             nnz += 1
         i2 += 1
@@ -110,12 +112,12 @@ def sparse_sum(ind1, data1, ind2, data2):
     return result_ind, result_data
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_diff(ind1, data1, ind2, data2):
     return sparse_sum(ind1, data1, ind2, -data2)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_mul(ind1, data1, ind2, data2):
     result_ind = arr_intersect(ind1, ind2)
     result_data = np.zeros(result_ind.shape[0], dtype=np.float32)
@@ -149,6 +151,7 @@ def sparse_mul(ind1, data1, ind2, data2):
     return result_ind, result_data
 
 
+@memoize_specialization
 def make_sparse_nn_descent(sparse_dist, dist_args):
     """Create a numba accelerated version of nearest neighbor descent
     specialised for the given distance metric and metric arguments on sparse
@@ -169,7 +172,9 @@ def make_sparse_nn_descent(sparse_dist, dist_args):
     Returns
     -------
     A numba JITd function for nearest neighbor descent computation that is
-    specialised to the given metric.
+    specialised to the given metric. If passed an int64 array of length
+    ``n_iters`` as ``update_counts``, it records in it the number of graph
+    updates of each iteration run.
     """
 
     @numba.njit(parallel=True)
@@ -187,6 +192,7 @@ def make_sparse_nn_descent(sparse_dist, dist_args):
         rp_tree_init=True,
         leaf_array=None,
         verbose=False,
+        update_counts=None,
     ):
 
         current_graph = make_heap(n_vertices, n_neighbors)
@@ -250,15 +256,15 @@ def make_sparse_nn_descent(sparse_dist, dist_args):
             c = 0
             for i in range(n_vertices):
                 for j in range(max_candidates):
-                    p = int(candidate_neighbors[0, i, j])
+                    p = int(candidate_neighbors[0][i, j])
                     if p < 0 or tau_rand(rng_state) < rho:
                         continue
                     for k in range(max_candidates):
-                        q = int(candidate_neighbors[0, i, k])
+                        q = int(candidate_neighbors[0][i, k])
                         if (
                             q < 0
-                            or not candidate_neighbors[2, i, j]
-                            and not candidate_neighbors[2, i, k]
+                            or not candidate_neighbors[2][i, j]
+                            and not candidate_neighbors[2][i, k]
                         ):
                             continue
 
@@ -275,6 +281,8 @@ def make_sparse_nn_descent(sparse_dist, dist_args):
                         c += heap_push(current_graph, p, d, q, 1)
                         c += heap_push(current_graph, q, d, p, 1)
 
+            if update_counts is not None:
+                update_counts[n] = c
             if c <= delta * n_neighbors * n_vertices:
                 break
 
@@ -283,7 +291,7 @@ def make_sparse_nn_descent(sparse_dist, dist_args):
     return nn_descent
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def general_sset_intersection(
     indptr1,
     indices1,
@@ -327,7 +335,7 @@ def general_sset_intersection(
     return
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_euclidean(ind1, data1, ind2, data2):
     aux_inds, aux_data = sparse_diff(ind1, data1, ind2, data2)
     result = 0.0
@@ -336,7 +344,7 @@ def sparse_euclidean(ind1, data1, ind2, data2):
     return np.sqrt(result)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_manhattan(ind1, data1, ind2, data2):
     aux_inds, aux_data = sparse_diff(ind1, data1, ind2, data2)
     result = 0.0
@@ -345,7 +353,7 @@ def sparse_manhattan(ind1, data1, ind2, data2):
     return result
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_chebyshev(ind1, data1, ind2, data2):
     aux_inds, aux_data = sparse_diff(ind1, data1, ind2, data2)
     result = 0.0
@@ -354,7 +362,7 @@ def sparse_chebyshev(ind1, data1, ind2, data2):
     return result
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_minkowski(ind1, data1, ind2, data2, p=2.0):
     aux_inds, aux_data = sparse_diff(ind1, data1, ind2, data2)
     result = 0.0
@@ -363,13 +371,13 @@ def sparse_minkowski(ind1, data1, ind2, data2, p=2.0):
     return result ** (1.0 / p)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_hamming(ind1, data1, ind2, data2, n_features):
     num_not_equal = sparse_diff(ind1, data1, ind2, data2)[0].shape[0]
     return float(num_not_equal) / n_features
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_canberra(ind1, data1, ind2, data2):
     abs_data1 = np.abs(data1)
     abs_data2 = np.abs(data2)
@@ -383,7 +391,7 @@ def sparse_canberra(ind1, data1, ind2, data2):
     return np.sum(val_data)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_bray_curtis(ind1, data1, ind2, data2):  # pragma: no cover
     abs_data1 = np.abs(data1)
     abs_data2 = np.abs(data2)
@@ -402,7 +410,7 @@ def sparse_bray_curtis(ind1, data1, ind2, data2):  # pragma: no cover
     return float(numerator) / denominator
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_jaccard(ind1, data1, ind2, data2):
     num_non_zero = arr_union(ind1, ind2).shape[0]
     num_equal = arr_intersect(ind1, ind2).shape[0]
@@ -413,7 +421,7 @@ def sparse_jaccard(ind1, data1, ind2, data2):
         return float(num_non_zero - num_equal) / num_non_zero
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_matching(ind1, data1, ind2, data2, n_features):
     num_true_true = arr_intersect(ind1, ind2).shape[0]
     num_non_zero = arr_union(ind1, ind2).shape[0]
@@ -422,7 +430,7 @@ def sparse_matching(ind1, data1, ind2, data2, n_features):
     return float(num_not_equal) / n_features
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_dice(ind1, data1, ind2, data2):
     num_true_true = arr_intersect(ind1, ind2).shape[0]
     num_non_zero = arr_union(ind1, ind2).shape[0]
@@ -434,7 +442,7 @@ def sparse_dice(ind1, data1, ind2, data2):
         return num_not_equal / (2.0 * num_true_true + num_not_equal)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_kulsinski(ind1, data1, ind2, data2, n_features):
     num_true_true = arr_intersect(ind1, ind2).shape[0]
     num_non_zero = arr_union(ind1, ind2).shape[0]
@@ -448,7 +456,7 @@ def sparse_kulsinski(ind1, data1, ind2, data2, n_features):
         )
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_rogers_tanimoto(ind1, data1, ind2, data2, n_features):
     num_true_true = arr_intersect(ind1, ind2).shape[0]
     num_non_zero = arr_union(ind1, ind2).shape[0]
@@ -457,7 +465,7 @@ def sparse_rogers_tanimoto(ind1, data1, ind2, data2, n_features):
     return (2.0 * num_not_equal) / (n_features + num_not_equal)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_russellrao(ind1, data1, ind2, data2, n_features):
     if ind1.shape[0] == ind2.shape[0] and np.all(ind1 == ind2):
         return 0.0
@@ -470,7 +478,7 @@ def sparse_russellrao(ind1, data1, ind2, data2, n_features):
         return float(n_features - num_true_true) / (n_features)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_sokal_michener(ind1, data1, ind2, data2, n_features):
     num_true_true = arr_intersect(ind1, ind2).shape[0]
     num_non_zero = arr_union(ind1, ind2).shape[0]
@@ -479,7 +487,7 @@ def sparse_sokal_michener(ind1, data1, ind2, data2, n_features):
     return (2.0 * num_not_equal) / (n_features + num_not_equal)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_sokal_sneath(ind1, data1, ind2, data2):
     num_true_true = arr_intersect(ind1, ind2).shape[0]
     num_non_zero = arr_union(ind1, ind2).shape[0]
@@ -491,7 +499,7 @@ def sparse_sokal_sneath(ind1, data1, ind2, data2):
         return num_not_equal / (0.5 * num_true_true + num_not_equal)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_cosine(ind1, data1, ind2, data2):
     aux_inds, aux_data = sparse_mul(ind1, data1, ind2, data2)
     result = 0.0
@@ -509,7 +517,7 @@ def sparse_cosine(ind1, data1, ind2, data2):
         return 1.0 - (result / (norm1 * norm2))
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def sparse_correlation(ind1, data1, ind2, data2, n_features):
 
     mu_x = 0.0
@@ -0,0 +1,62 @@
+# Authors: Ashwin Narayan and Hyunghoon Cho
+#
+# License: MIT
+"""A process-wide registry of the numba functions specialised for a distance
+metric.
+
+Numba does not support higher order functions directly, so nearest neighbor
+descent, the nearest neighbor search and the like are compiled by factories
+(``make_nn_descent``, ``make_initialized_nnd_search``, ...) as closures over
+a distance function and its extra arguments. Every new closure is compiled
+again on its first call, which takes seconds. The factories are therefore
+memoized: a factory called again with the same distance function and
+arguments returns the closures it made the first time, already compiled.
+"""
+import functools
+import threading
+
+import numpy as np
+
+_specializations = {}
+_specializations_lock = threading.Lock()
+
+
+def _hashable(value):
+    """A hashable key standing for a distance function or argument, which
+    tells apart values that numba would compile differently. Raises a
+    TypeError if there is none."""
+    if isinstance(value, tuple):
+        return tuple(_hashable(v) for v in value)
+    if isinstance(value, np.ndarray):
+        return ("ndarray", value.dtype.str, value.shape, value.tobytes())
+    hash(value)
+    return type(value), value
+
+
+def memoize_specialization(factory):
+    """Decorator memoizing a factory of specialised numba functions on its
+    arguments. Array arguments are keyed on their contents, and calls with
+    other unhashable arguments are not memoized."""
+
+    @functools.wraps(factory)
+    def memoized(*args):
+        try:
+            key = (factory.__module__, factory.__name__, _hashable(args))
+        except TypeError:
+            return factory(*args)
+
+        with _specializations_lock:
+            result = _specializations.get(key)
+            if result is None:
+                result = factory(*args)
+                _specializations[key] = result
+        return result
+
+    return memoized
+
+
+def clear_specializations():
+    """Forget all memoized specialisations, so that they are compiled again
+    when next requested."""
+    with _specializations_lock:
+        _specializations.clear()
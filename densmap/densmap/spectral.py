@@ -3,8 +3,6 @@ import numpy as np
 import scipy.sparse
 import scipy.sparse.csgraph
 
-from sklearn.manifold import SpectralEmbedding
-from sklearn.metrics import pairwise_distances
 from warnings import warn
 
 
@@ -43,6 +41,10 @@ def component_layout(
         The ``dim``-dimensional embedding of the ``n_components``-many
         connected components.
     """
+    # Imported here rather than at the top of the module, so that importing
+    # densmap does not load all of sklearn.manifold and sklearn.metrics
+    from sklearn.manifold import SpectralEmbedding
+    from sklearn.metrics import pairwise_distances
 
     component_centroids = np.empty((n_components, data.shape[1]), dtype=np.float64)
 
@@ -109,6 +111,8 @@ def multi_component_layout(
     embedding: array of shape (n_samples, dim)
         The initial embedding of ``graph``.
     """
+    import scipy.sparse.linalg
+    from sklearn.metrics import pairwise_distances
 
     result = np.empty((graph.shape[0], dim), dtype=np.float32)
 
@@ -220,6 +224,8 @@ def spectral_layout(data, graph, dim, random_state, metric="euclidean", metric_k
     embedding: array of shape (n_vertices, dim)
         The spectral embedding of the graph.
     """
+    import scipy.sparse.linalg
+
     n_samples = graph.shape[0]
     n_components, labels = scipy.sparse.csgraph.connected_components(graph)
 
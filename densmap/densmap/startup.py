@@ -0,0 +1,104 @@
+# Authors: Ashwin Narayan and Hyunghoon Cho
+#
+# License: MIT
+"""Compiling the numba kernels of densMAP ahead of their first use.
+
+The kernels are compiled (or loaded from numba's on-disk cache) the first
+time they are called, which makes the first fit or transform of a process
+take seconds longer than the next ones. ``warmup`` goes through the same code
+paths on a small synthetic data set in a background thread, so that this
+happens while the caller is busy loading its data.
+
+The workqueue threading layer set in ``densmap/__init__.py`` aborts the
+process when two threads run parallel kernels at once, so densMAP calls
+made while a warmup runs wait for it to finish (``wait_for_warmup``) before
+running any kernel.
+"""
+import threading
+
+import numpy as np
+
+# Just large enough for fit to take the nearest neighbor descent path, and
+# for the layout optimization to use the parallel kernels
+WARMUP_N_SAMPLES = 4200
+WARMUP_N_FEATURES = 8
+
+# The thread of the last warmup started, if any
+_warmup_thread = None
+
+
+def wait_for_warmup():
+    """Wait for a warmup started by ``warmup`` to finish. Does nothing when
+    none is running, or when called from the warmup thread itself."""
+    thread = _warmup_thread
+    if thread is not None and thread is not threading.current_thread():
+        thread.join()
+
+
+def _warmup(dtype, n_components, metric, metric_kwds):
+    from densmap.densmap_ import densMAP
+
+    rng = np.random.RandomState(42)
+    X = rng.normal(size=(WARMUP_N_SAMPLES, WARMUP_N_FEATURES))
+    if metric == "precomputed":
+        from sklearn.metrics import pairwise_distances
+
+        X = pairwise_distances(X)
+    X = X.astype(dtype)
+    model = densMAP(
+        n_components=n_components,
+        metric=metric,
+        metric_kwds=metric_kwds,
+        n_epochs=11,
+        init="random",
+        random_state=42,
+    ).fit(X)
+    if metric != "precomputed":
+        model.transform(X[:16])
+
+
+def warmup(
+    dtype=np.float32, n_components=2, metric="euclidean", metric_kwds=None, wait=False
+):
+    """Compile the kernels used by densMAP for data of the given type,
+    embedding dimension and metric, in a background thread.
+
+    Parameters
+    ----------
+    dtype: numpy dtype (optional, default np.float32)
+        The dtype of the data that will be embedded.
+
+    n_components: int (optional, default 2)
+        The dimension of the embeddings that will be computed.
+
+    metric: string or callable (optional, default 'euclidean')
+        The metric that will be used, as passed to ``densMAP``.
+
+    metric_kwds: dict (optional, default None)
+        Arguments to the metric, as passed to ``densMAP``.
+
+    wait: bool (optional, default False)
+        Whether to wait for the compilation to finish before returning.
+
+    Returns
+    -------
+    thread: threading.Thread
+        The (daemon) thread compiling the kernels. Fits, transforms and
+        ``local_radius`` calls made while it runs wait for it to finish
+        before running, so that no two threads run parallel kernels at once.
+    """
+    global _warmup_thread
+
+    # Only one warmup at a time, for the same reason
+    wait_for_warmup()
+    thread = threading.Thread(
+        target=_warmup,
+        args=(dtype, n_components, metric, metric_kwds),
+        name="densmap-warmup",
+    )
+    thread.daemon = True
+    _warmup_thread = thread
+    thread.start()
+    if wait:
+        thread.join()
+    return thread
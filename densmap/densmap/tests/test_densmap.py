@@ -6,14 +6,30 @@ from densmap.densmap_ import (
     nearest_neighbors,
     smooth_knn_dist,
     fuzzy_simplicial_set,
+    make_epochs_per_sample,
+    search_graph_csr,
+    _search_graph_csr,
+    _incident_edges,
+    _optimize_layout_parallel_density_stats,
+    _optimize_layout_serial_density_stats,
+    check_input_array,
     DENSMAP,
 )
-from densmap.utils import deheap_sort
+from densmap.utils import deheap_sort, space_filling_curve_order
+from densmap.rp_tree import random_split
+from densmap.density import (
+    squared_edge_lengths,
+    graph_edge_squared_lengths,
+    edge_local_radius,
+)
+from densmap.cache import KNNGraphCache
+from densmap.exact_knn import exact_nearest_neighbors
 from densmap.nndescent import (
     make_initialisations,
     make_initialized_nnd_search,
     initialise_search,
 )
+import densmap
 import densmap.validation as valid
 import densmap.sparse as spdist
 import densmap.distances as dist
@@ -21,6 +37,10 @@ from sklearn import datasets
 from nose import SkipTest
 from functools import wraps
 from tempfile import mkdtemp
+import json
+import pickle
+import subprocess
+import sys
 from scipy.stats import mode
 from sklearn.cluster import KMeans
 from sklearn.manifold.t_sne import trustworthiness
@@ -262,6 +282,33 @@ def test_nn_descent_neighbor_accuracy():
     )
 
 
+def test_parallel_nn_descent_neighbor_accuracy():
+    knn_indices, knn_dists, _ = nearest_neighbors(
+        nn_data, 10, "euclidean", {}, False, np.random.RandomState(42), n_jobs=3
+    )
+
+    tree = KDTree(nn_data)
+    true_indices = tree.query(nn_data, 10, return_distance=False)
+
+    num_correct = 0.0
+    for i in range(nn_data.shape[0]):
+        num_correct += np.sum(np.in1d(true_indices[i], knn_indices[i]))
+
+    percent_correct = num_correct / (nn_data.shape[0] * 10)
+    assert_greater_equal(
+        percent_correct,
+        0.99,
+        "Parallel NN-descent did not get 99% " "accuracy on nearest neighbors",
+    )
+
+    # The result does not depend on the scheduling of the threads
+    expected_indices, expected_dists, _ = nearest_neighbors(
+        nn_data, 10, "euclidean", {}, False, np.random.RandomState(42), n_jobs=3
+    )
+    assert_array_equal(knn_indices, expected_indices)
+    assert_array_equal(knn_dists, expected_dists)
+
+
 def test_angular_nn_descent_neighbor_accuracy():
     knn_indices, knn_dists, _ = nearest_neighbors(
         nn_data, 10, "cosine", {}, True, np.random
@@ -446,6 +493,109 @@ def test_nn_search():
     )
 
 
+def test_search_graph_csr():
+    knn_indices, knn_dists, _ = nearest_neighbors(
+        nn_data, 10, "euclidean", {}, False, np.random
+    )
+    knn_indices[:5, -1] = -1
+
+    indptr, indices = search_graph_csr(knn_indices, knn_dists)
+    assert_equal(indptr.dtype, np.int32)
+    assert_equal(indices.dtype, np.int32)
+
+    n = nn_data.shape[0]
+    valid = (knn_indices >= 0) & (knn_dists != 0)
+    rows = np.repeat(np.arange(n), knn_indices.shape[1])[valid.ravel()]
+    cols = knn_indices[valid]
+    expected = sparse.coo_matrix((np.ones(rows.shape[0]), (rows, cols)), shape=(n, n))
+    expected = expected.maximum(expected.transpose()).tocsr()
+    expected.sort_indices()
+    assert_array_equal(indptr, expected.indptr)
+    assert_array_equal(indices, expected.indices)
+
+    # The row pointers are only narrowed to int32 when they fit
+    wide_indptr, wide_indices = _search_graph_csr(knn_indices, knn_dists)
+    assert_equal(wide_indptr.dtype, np.int64)
+    assert_array_equal(wide_indptr, indptr)
+    assert_array_equal(wide_indices, indices)
+
+
+def test_optimize_layout_density_stats():
+    rng = np.random.RandomState(42)
+    n_vertices, n_edges = 200, 3000
+    head = rng.randint(n_vertices, size=n_edges).astype(np.int32)
+    tail = rng.randint(n_vertices, size=n_edges).astype(np.int32)
+    head[:n_vertices] = np.arange(n_vertices)
+    tail[0] = head[0]
+    embedding = rng.normal(size=(n_vertices, 2)).astype(np.float32)
+    R = rng.normal(size=n_vertices).astype(np.float32)
+    a, b = 1.577, 0.895
+
+    dist_squared = np.sum((embedding[head] - embedding[tail]) ** 2, axis=1)
+    phi = 1.0 / (1.0 + a * dist_squared ** b)
+    expected_phi = np.zeros(n_vertices)
+    expected_re = np.zeros(n_vertices)
+    for ends in (head, tail):
+        np.add.at(expected_phi, ends, phi)
+        np.add.at(expected_re, ends, phi * dist_squared)
+    expected_re = np.log(1e-8 + expected_re / expected_phi)
+
+    indptr, edges = _incident_edges(head, tail, n_vertices)
+    assert_equal(edges.dtype, np.int32)
+    assert_equal(indptr[-1], 2 * n_edges)
+    for j in (0, 1, n_vertices - 1):
+        incident = np.sort(edges[indptr[j] : indptr[j + 1]])
+        expected = np.concatenate(
+            (np.flatnonzero(head == j), np.flatnonzero(tail == j))
+        )
+        assert_array_equal(incident, np.sort(expected))
+    for stats in (
+        _optimize_layout_serial_density_stats,
+        _optimize_layout_parallel_density_stats,
+    ):
+        phi_sum = np.zeros(n_vertices, dtype=np.float32)
+        re_sum = np.zeros(n_vertices, dtype=np.float32)
+        re_mean, re_std, re_cov = stats(
+            embedding,
+            embedding,
+            head,
+            tail,
+            a,
+            b,
+            R,
+            np.float32(1e-8),
+            0.1,
+            indptr,
+            edges,
+            np.zeros(n_edges, dtype=np.float32),
+            np.zeros(n_edges, dtype=np.float32),
+            phi_sum,
+            re_sum,
+        )
+        assert_array_almost_equal(phi_sum, expected_phi, decimal=3)
+        assert_array_almost_equal(re_sum, expected_re, decimal=4)
+        assert_almost_equal(re_mean, np.mean(expected_re), decimal=4)
+        assert_almost_equal(
+            re_std, np.sqrt(np.var(expected_re) + 0.1), decimal=4
+        )
+        assert_almost_equal(
+            re_cov, np.dot(expected_re, R) / (n_vertices - 1), decimal=3
+        )
+
+
+def test_specializations_are_memoized():
+    search = make_initialized_nnd_search(dist.euclidean, ())
+    assert make_initialized_nnd_search(dist.euclidean, ()) is search
+    assert make_initialized_nnd_search(dist.manhattan, ()) is not search
+
+    # Arrays among the arguments are compared by value
+    w = np.ones(5)
+    minkowski = make_initialized_nnd_search(dist.weighted_minkowski, (w, 2))
+    assert make_initialized_nnd_search(dist.weighted_minkowski, (w.copy(), 2)) is minkowski
+    assert make_initialized_nnd_search(dist.weighted_minkowski, (w, 3)) is not minkowski
+    assert make_initialized_nnd_search(dist.weighted_minkowski, (w, 2.0)) is not minkowski
+
+
 def test_euclidean():
     spatial_check("euclidean")
 
@@ -518,6 +668,32 @@ def test_yule():
     binary_check("yule")
 
 
+def test_fast_distance_alternatives():
+    unit_data = normalize(spatial_data, norm="l2")
+    # Up to the rows of zeros, whose cosine distances are recomputed exactly
+    for i in range(spatial_data.shape[0] - 3):
+        assert_almost_equal(
+            dist.squared_euclidean(spatial_data[i], spatial_data[i + 1]),
+            dist.euclidean(spatial_data[i], spatial_data[i + 1]) ** 2,
+        )
+        assert_almost_equal(
+            dist.normalized_cosine(unit_data[i], unit_data[i + 1]),
+            dist.cosine(spatial_data[i], spatial_data[i + 1]),
+        )
+
+    # The neighbors are found with the alternatives, but their distances
+    # are those of the metric
+    for metric in ("euclidean", "cosine"):
+        knn_indices, knn_dists, _ = nearest_neighbors(
+            nn_data, 10, metric, {}, False, np.random
+        )
+        true_dists = pairwise_distances(nn_data, metric=metric)
+        assert_array_almost_equal(
+            knn_dists, np.take_along_axis(true_dists, knn_indices, axis=1), 5
+        )
+        assert np.all(np.diff(knn_dists, axis=1) >= 0)
+
+
 def test_sparse_euclidean():
     sparse_spatial_check("euclidean")
 
@@ -740,7 +916,7 @@ def test_densmap_transform_on_iris():
     fitter = DENSMAP(n_neighbors=10, min_dist=0.01, random_state=42).fit(data)
 
     new_data = iris.data[~iris_selection]
-    embedding = fitter.transform(new_data)
+    embedding, ro, re = fitter.transform(new_data)
 
     trust = trustworthiness(new_data, embedding, 10)
     assert_greater_equal(
@@ -756,7 +932,7 @@ def test_densmap_transform_on_iris_modified_dtype():
     fitter.embedding_ = fitter.embedding_.astype(np.float64)
 
     new_data = iris.data[~iris_selection]
-    embedding = fitter.transform(new_data)
+    embedding, ro, re = fitter.transform(new_data)
 
     trust = trustworthiness(new_data, embedding, 10)
     assert_greater_equal(
@@ -894,6 +1070,27 @@ def test_negative_nepochs():
     assert_raises(ValueError, u.fit, nn_data)
 
 
+def test_bad_dens_refresh():
+    u = DENSMAP(dens_refresh=0)
+    assert_raises(ValueError, u.fit, nn_data)
+    u = DENSMAP(dens_refresh=2.5)
+    assert_raises(ValueError, u.fit, nn_data)
+
+
+def test_bad_exact_knn_threshold():
+    u = DENSMAP(exact_knn_threshold=-1)
+    assert_raises(ValueError, u.fit, nn_data)
+    u = DENSMAP(exact_knn_threshold=1e5)
+    assert_raises(ValueError, u.fit, nn_data)
+
+
+def test_bad_n_jobs():
+    u = DENSMAP(n_jobs=0)
+    assert_raises(ValueError, u.fit, nn_data)
+    u = DENSMAP(n_jobs=2.0)
+    assert_raises(ValueError, u.fit, nn_data)
+
+
 def test_negative_target_nneighbors():
     u = DENSMAP(target_n_neighbors=1)
     assert_raises(ValueError, u.fit, nn_data)
@@ -978,9 +1175,644 @@ def test_densmap_transform_embedding_stability():
     b = np.random.random((1000, 5))
 
     densmap = DENSMAP()
-    u1 = densmap.fit_transform(a[:, :5])
+    u1, _, _ = densmap.fit_transform(a[:, :5])
     u1_orig = u1.copy()
     assert_array_equal(u1_orig, densmap.embedding_)
 
-    u2 = densmap.transform(b)
+    u2, _, _ = densmap.transform(b)
     assert_array_equal(u1_orig, densmap.embedding_)
+
+
+def test_edge_local_radius():
+    graph = sparse.random(
+        nn_data.shape[0], nn_data.shape[0], density=0.01, format="coo", random_state=42
+    )
+    head, tail, mu = graph.row, graph.col, graph.data.astype(np.float32)
+
+    expected_ro = np.zeros(nn_data.shape[0])
+    expected_mu_sum = np.zeros(nn_data.shape[0])
+    for i in range(head.shape[0]):
+        dist_squared = np.sum((nn_data[head[i]] - nn_data[tail[i]]) ** 2)
+        expected_ro[head[i]] += mu[i] * dist_squared
+        expected_ro[tail[i]] += mu[i] * dist_squared
+        expected_mu_sum[head[i]] += mu[i]
+        expected_mu_sum[tail[i]] += mu[i]
+    expected_ro = np.log(expected_ro / expected_mu_sum)
+
+    for data in (nn_data, sparse.csr_matrix(nn_data)):
+        ro, mu_sum = edge_local_radius(
+            head,
+            tail,
+            mu,
+            squared_edge_lengths(data, head, tail),
+            nn_data.shape[0],
+        )
+        assert_array_almost_equal(mu_sum, expected_mu_sum, decimal=4)
+        assert_array_almost_equal(ro, expected_ro, decimal=4)
+
+
+def test_fuzzy_simplicial_set_return_dists():
+    knn_indices, knn_dists, _ = nearest_neighbors(
+        nn_data, 10, "euclidean", {}, False, np.random
+    )
+    graph, graph_dists = fuzzy_simplicial_set(
+        nn_data,
+        10,
+        np.random,
+        "euclidean",
+        {},
+        knn_indices,
+        knn_dists,
+        False,
+        1.0,
+        1.0,
+        False,
+        return_dists=True,
+    )
+    graph = graph.tocoo()
+
+    assert_array_almost_equal(
+        graph_edge_squared_lengths(nn_data, graph.row, graph.col, graph_dists),
+        squared_edge_lengths(nn_data, graph.row, graph.col),
+        decimal=4,
+        err_msg="k-neighbor distances do not match the graph edge lengths",
+    )
+
+
+def test_fuzzy_simplicial_set_compact():
+    knn_indices, knn_dists, _ = nearest_neighbors(
+        nn_data, 10, "euclidean", {}, False, np.random
+    )
+    graph = fuzzy_simplicial_set(
+        nn_data, 10, np.random, "euclidean", {}, knn_indices, knn_dists
+    )
+    assert_equal(graph.dtype, np.float32)
+    assert_equal(graph.indices.dtype, np.int32)
+    assert_equal(graph.indptr.dtype, np.int32)
+
+    # The previous 64-bit graph, with the same edges
+    wide_graph = fuzzy_simplicial_set(
+        nn_data, 10, np.random, "euclidean", {}, knn_indices, knn_dists, compact=False
+    )
+    assert_equal(wide_graph.dtype, np.float64)
+    assert_array_equal(wide_graph.indptr, graph.indptr)
+    assert_array_equal(wide_graph.indices, graph.indices)
+    assert_array_almost_equal(wide_graph.data, graph.data)
+
+    epochs_per_sample = make_epochs_per_sample(graph.data, 200)
+    wide_epochs_per_sample = make_epochs_per_sample(wide_graph.data, 200)
+    assert_equal(epochs_per_sample.dtype, np.float32)
+    assert_equal(wide_epochs_per_sample.dtype, np.float64)
+    assert_array_almost_equal(epochs_per_sample / wide_epochs_per_sample, 1.0)
+
+
+def test_densmap_deterministic_is_reproducible():
+    embeddings = [
+        DENSMAP(
+            n_neighbors=10,
+            n_epochs=100,
+            random_state=42,
+            deterministic=True,
+            final_dens=False,
+        ).fit_transform(iris.data)
+        for _ in range(2)
+    ]
+    assert_array_equal(
+        embeddings[0],
+        embeddings[1],
+        "Deterministic optimization gave different embeddings",
+    )
+
+
+def test_space_filling_curve_order():
+    grid = np.array(
+        [[x, y] for y in range(4) for x in range(4)], dtype=np.float32
+    )
+    order = space_filling_curve_order(grid[::-1])
+    assert_array_equal(np.sort(order), np.arange(16))
+    # Z-order visits each 2x2 quadrant before moving on to the next
+    quadrants = ((grid[::-1][order] // 2) @ np.array([1, 2])).reshape(4, 4)
+    assert_array_equal(quadrants, quadrants[:, :1].repeat(4, axis=1))
+    assert_array_equal(np.sort(quadrants[:, 0]), np.arange(4))
+
+
+def test_densmap_reorder_vertices_keeps_order():
+    u = DENSMAP(
+        n_neighbors=10,
+        n_epochs=100,
+        random_state=42,
+        deterministic=True,
+        final_dens=False,
+        dens_lambda=0.0,
+    )
+    embedding = u.fit_transform(iris.data)
+    # points keep their neighbors from the input in the embedding
+    trust = trustworthiness(iris.data, embedding, n_neighbors=10)
+    assert_greater_equal(
+        trust,
+        0.95,
+        "Insufficiently trustworthy embedding after reordering: "
+        + str(trust),
+    )
+
+
+def test_nearest_neighbors_memmap_input():
+    path = os.path.join(mkdtemp(), "nn_data.npy")
+    np.save(path, nn_data.astype(np.float32))
+    data = np.load(path, mmap_mode="r")
+    assert check_input_array(data) is data
+
+    knn_indices, knn_dists, _ = nearest_neighbors(
+        data, 10, "euclidean", {}, False, np.random.RandomState(42)
+    )
+    expected_indices, expected_dists, _ = nearest_neighbors(
+        np.array(data), 10, "euclidean", {}, False, np.random.RandomState(42)
+    )
+    assert_array_equal(knn_indices, expected_indices)
+    assert_array_almost_equal(knn_dists, expected_dists)
+
+
+def test_check_input_array_non_finite():
+    data = nn_data.astype(np.float32)
+    data[-1, 0] = np.nan
+    assert_raises(ValueError, check_input_array, data)
+
+
+def test_make_forest():
+    rng_state = np.random.RandomState(42).randint(INT32_MIN, INT32_MAX, 3).astype(
+        np.int64
+    )
+    duplicated_data = np.ones((500, 5))
+    for data, angular in (
+        (nn_data, False),
+        (nn_data, True),
+        (sparse_nn_data, False),
+        (sparse_nn_data, True),
+        (duplicated_data, False),
+    ):
+        forest = make_forest(data, 10, 4, rng_state.copy(), angular)
+        assert_equal(len(forest), 4)
+        for tree in forest:
+            # Every point is in exactly one leaf
+            leaves = tree.indices
+            assert_array_equal(np.sort(leaves[leaves >= 0]), np.arange(data.shape[0]))
+            assert_equal(tree.children.shape[0], tree.hyperplanes.shape[0])
+        for tree, expected in zip(
+            forest, make_forest(data, 10, 4, rng_state.copy(), angular)
+        ):
+            assert_array_equal(tree.indices, expected.indices)
+
+    left, right = random_split(np.arange(20), rng_state)
+    assert left.shape[0] > 0 and right.shape[0] > 0
+    assert_array_equal(np.sort(np.concatenate([left, right])), np.arange(20))
+
+
+def test_knn_graph_cache():
+    knn_indices, knn_dists, rp_forest = nearest_neighbors(
+        nn_data, 10, "euclidean", {}, False, np.random
+    )
+    cache = KNNGraphCache(mkdtemp())
+    assert cache.load("a") is None
+    cache.store("a", knn_indices, knn_dists, rp_forest)
+
+    cached_indices, cached_dists, cached_forest = cache.load("a")
+    assert_array_equal(cached_indices, knn_indices)
+    assert_array_equal(cached_dists, knn_dists)
+    assert_equal(len(cached_forest), len(rp_forest))
+    for cached_tree, tree in zip(cached_forest, rp_forest):
+        for cached_array, array in zip(cached_tree, tree):
+            assert_array_equal(cached_array, array)
+
+    # the least recently used entry is evicted once over the size limit
+    cache.max_bytes = cache.entries()[0][1] + 1
+    cache.store("b", knn_indices, knn_dists, rp_forest)
+    assert_equal([key for _, _, key in cache.entries()], ["b"])
+
+
+def test_densmap_knn_cache_reuse():
+    data = np.random.RandomState(0).uniform(size=(4200, 5)).astype(np.float32)
+    cache_dir = mkdtemp()
+    embeddings = [
+        DENSMAP(
+            n_neighbors=10,
+            n_epochs=20,
+            random_state=42,
+            deterministic=True,
+            final_dens=False,
+            knn_cache_dir=cache_dir,
+        ).fit_transform(data)
+        for _ in range(2)
+    ]
+    assert_equal(len(os.listdir(cache_dir)), 1)
+    assert_array_equal(
+        embeddings[0],
+        embeddings[1],
+        "Embedding changed when reusing the cached neighbor graph",
+    )
+
+    # The parallel descent finds another graph, which is cached separately
+    DENSMAP(
+        n_neighbors=10,
+        n_epochs=20,
+        random_state=42,
+        final_dens=False,
+        n_jobs=2,
+        knn_cache_dir=cache_dir,
+    ).fit(data)
+    assert_equal(len(os.listdir(cache_dir)), 2)
+
+
+def test_densmap_precomputed_knn():
+    knn_dists, knn_indices = KDTree(iris.data).query(iris.data, 15)
+    u = DENSMAP(
+        n_neighbors=10,
+        n_epochs=100,
+        random_state=42,
+        final_dens=False,
+        precomputed_knn=(knn_indices, knn_dists),
+    )
+    embedding = u.fit_transform(iris.data)
+    assert_array_equal(u._knn_indices, knn_indices[:, :10])
+    trust = trustworthiness(iris.data, embedding, n_neighbors=10)
+    assert_greater_equal(
+        trust,
+        0.95,
+        "Insufficiently trustworthy embedding from precomputed knn: "
+        + str(trust),
+    )
+
+    u = DENSMAP(n_neighbors=10, precomputed_knn=(knn_indices[:, :5], knn_dists[:, :5]))
+    assert_raises(ValueError, u.fit, iris.data)
+    u = DENSMAP(n_neighbors=10, precomputed_knn=(knn_indices[:-1], knn_dists[:-1]))
+    assert_raises(ValueError, u.fit, iris.data)
+
+
+def test_nearest_neighbors_sparse_precomputed():
+    # a sparse distance matrix holding the 20 nearest neighbors of each point
+    dists, indices = KDTree(iris.data).query(iris.data, 20)
+    dmat = sparse.csr_matrix(
+        (dists.ravel(), indices.ravel(), np.arange(0, dists.size + 1, 20)),
+        shape=(iris.data.shape[0], iris.data.shape[0]),
+    )
+    knn_indices, knn_dists, _ = nearest_neighbors(
+        dmat, 10, "precomputed", {}, False, np.random
+    )
+    assert_array_almost_equal(knn_dists, dists[:, :10])
+    # ties may be broken differently, but the distances must match
+    assert_array_almost_equal(
+        np.linalg.norm(iris.data[knn_indices] - iris.data[:, None], axis=2),
+        dists[:, :10],
+    )
+
+    embedding, ro, re = DENSMAP(
+        n_neighbors=10, n_epochs=100, metric="precomputed", random_state=42
+    ).fit_transform(dmat)
+    assert_equal(embedding.shape, (iris.data.shape[0], 2))
+    assert_equal(np.sum(~np.isfinite(ro)), 0)
+
+
+def test_densmap_transform_batched():
+    data = iris.data[iris_selection]
+    fitter = DENSMAP(
+        n_neighbors=10,
+        min_dist=0.01,
+        random_state=42,
+        final_dens=False,
+        transform_batch_size=16,
+    ).fit(data)
+    original_embedding = fitter.embedding_.copy()
+    assert_equal(fitter.embedding_.dtype, np.float32)
+
+    new_data = iris.data[~iris_selection]
+    embedding = fitter.transform(new_data)
+    assert_equal(embedding.shape, (new_data.shape[0], 2))
+    assert_array_equal(original_embedding, fitter.embedding_)
+
+    trust = trustworthiness(new_data, embedding, n_neighbors=10)
+    assert_greater_equal(
+        trust,
+        0.89,
+        "Insufficiently trustworthy batched transform for iris dataset: {}".format(
+            trust
+        ),
+    )
+
+
+def test_densmap_transform_densities():
+    data = iris.data[iris_selection]
+    fitter = DENSMAP(n_neighbors=10, min_dist=0.01, random_state=42).fit(data)
+
+    new_data = iris.data[~iris_selection]
+    embedding, ro, re = fitter.transform(new_data)
+    assert_equal(ro.shape, (new_data.shape[0],))
+    assert_equal(re.shape, (new_data.shape[0],))
+    assert np.all(np.isfinite(ro))
+    assert np.all(np.isfinite(re))
+
+    # The original space radius of a new point is close to that of its
+    # nearest training point
+    nearest = np.argmin(pairwise_distances(new_data, data), axis=1)
+    corr = np.corrcoef(ro, fitter.ro_[nearest])[0, 1]
+    assert_greater_equal(corr, 0.5)
+
+
+def test_densmap_transform_densities_non_euclidean():
+    # ro is measured in euclidean distance under any metric, in fit as in
+    # transform
+    data = iris.data[iris_selection]
+    fitter = DENSMAP(
+        n_neighbors=10, min_dist=0.01, metric="cosine", random_state=42
+    ).fit(data)
+
+    new_data = iris.data[~iris_selection]
+    embedding, ro, re = fitter.transform(new_data)
+    assert np.all(np.isfinite(ro))
+    nearest = np.argmin(pairwise_distances(new_data, data), axis=1)
+    assert_less(abs(np.mean(ro - fitter.ro_[nearest])), 1.0)
+    corr = np.corrcoef(ro, fitter.ro_[nearest])[0, 1]
+    assert_greater_equal(corr, 0.5)
+
+
+def test_densmap_lazy_final_dens():
+    data = iris.data[iris_selection]
+    params = dict(n_neighbors=10, n_epochs=50, random_state=42, deterministic=True)
+    eager = DENSMAP(**params).fit(data)
+    lazy = DENSMAP(final_dens="lazy", **params)
+    embedding = lazy.fit_transform(data)
+    assert_array_equal(embedding, eager.embedding_)
+    assert "re_" not in lazy.__dict__
+
+    assert_array_almost_equal(lazy.re_, eager.re_)
+    assert "re_" in lazy.__dict__
+    new_data = iris.data[~iris_selection]
+    assert_equal(lazy.transform(new_data).shape, (new_data.shape[0], 2))
+    assert_raises(AttributeError, getattr, lazy, "missing_")
+    assert_raises(AttributeError, getattr, DENSMAP(final_dens="lazy"), "re_")
+
+
+def test_local_radius():
+    data = iris.data[iris_selection]
+    fitter = DENSMAP(n_neighbors=10, n_epochs=50, random_state=42).fit(data)
+    assert_array_almost_equal(
+        densmap.local_radius(fitter.embedding_, n_neighbors=10), fitter.re_
+    )
+
+    # From the nearest neighbors alone
+    knn = exact_nearest_neighbors(fitter.embedding_, 10)
+    assert_array_almost_equal(densmap.local_radius(knn), fitter.re_)
+
+    # Over the fuzzy simplicial set of the original data
+    radius = densmap.local_radius(fitter.embedding_, graph=fitter.graph_)
+    assert_equal(radius.shape, (data.shape[0],))
+    assert np.all(np.isfinite(radius))
+    knn = exact_nearest_neighbors(data, 5)
+    assert_raises(ValueError, densmap.local_radius, knn, fitter.graph_)
+
+
+def test_local_radius_non_euclidean():
+    # Under other metrics, the edges of the graph are still measured in
+    # euclidean distance, not by the k-neighbor distances of the metric
+    data = nn_data[:500].astype(np.float32)
+    knn_indices, knn_dists, _ = nearest_neighbors(
+        data, 10, "cosine", {}, False, np.random.RandomState(42)
+    )
+    graph = fuzzy_simplicial_set(
+        data, 10, np.random, "cosine", {}, knn_indices, knn_dists
+    ).tocoo()
+    expected, _ = edge_local_radius(
+        graph.row,
+        graph.col,
+        graph.data,
+        squared_edge_lengths(data, graph.row, graph.col),
+        data.shape[0],
+        0.0,
+    )
+    radius = densmap.local_radius(
+        data, n_neighbors=10, metric="cosine", random_state=42
+    )
+    assert_array_almost_equal(radius, expected, decimal=4)
+
+
+def test_bad_final_dens():
+    u = DENSMAP(final_dens="yes")
+    assert_raises(ValueError, u.fit, nn_data)
+
+
+def test_densmap_fit_profile():
+    fitter = DENSMAP(
+        n_neighbors=10, n_epochs=20, random_state=42, exact_knn_threshold=0
+    ).fit(nn_data)
+    profile = fitter.profile_
+    for name in [
+        "validate_input",
+        "rp_forest",
+        "nn_descent",
+        "fuzzy_simplicial_set",
+        "search_graph",
+        "init",
+        "ro",
+        "optimize_layout",
+        "optimize_layout_density",
+        "final_dens",
+    ]:
+        assert name in profile
+        assert_greater_equal(profile[name]["seconds"], 0.0)
+
+    nn_descent = profile["nn_descent"]
+    assert 0 < len(nn_descent["update_counts"]) <= nn_descent["n_iters"]
+    assert_equal(
+        profile["optimize_layout"]["n_epochs"]
+        + profile["optimize_layout_density"]["n_epochs"],
+        20,
+    )
+
+    path = os.path.join(mkdtemp(), "profile.json")
+    profile.to_json(path)
+    with open(path) as f:
+        report = json.load(f)
+    assert_equal([stage["name"] for stage in report["stages"]],
+                 [stage["name"] for stage in profile.stages])
+
+
+def test_densmap_save_load():
+    data = np.random.RandomState(0).uniform(size=(4200, 5)).astype(np.float32)
+    fitter = DENSMAP(
+        n_neighbors=10, n_epochs=20, random_state=42, deterministic=True
+    ).fit(data[:4150])
+    path = os.path.join(mkdtemp(), "model")
+    fitter.save(path)
+
+    loaded = DENSMAP.load(path)
+    assert_array_equal(fitter.embedding_, loaded.embedding_)
+    assert_array_equal(fitter.ro_, loaded.ro_)
+    assert_array_equal(fitter._knn_indices, loaded._knn_indices)
+    assert_equal(len(fitter._rp_forest), len(loaded._rp_forest))
+    assert_equal((fitter.graph_ != loaded.graph_).nnz, 0)
+    assert_equal(fitter.get_params(), loaded.get_params())
+
+    # The transform lock is not saved, but created afresh on loading
+    assert_not_in("_transform_lock", fitter.__getstate__())
+    assert loaded._transform_lock is not fitter._transform_lock
+    unpickled = pickle.loads(pickle.dumps(fitter))
+    assert unpickled._transform_lock is not fitter._transform_lock
+
+    embedding, ro, re = fitter.transform(data[4150:])
+    loaded_embedding, loaded_ro, loaded_re = loaded.transform(data[4150:])
+    assert_array_equal(embedding, loaded_embedding)
+    assert_array_equal(ro, loaded_ro)
+    assert_array_equal(re, loaded_re)
+
+    # Saving again replaces the model, but other directories are left alone
+    loaded.save(path)
+    assert_raises(ValueError, fitter.save, os.path.dirname(path))
+
+
+def test_warmup():
+    thread = densmap.warmup(n_components=3, wait=True)
+    assert not thread.is_alive()
+
+
+def test_warmup_then_fit():
+    # With more than one numba thread, parallel kernels run from the warmup
+    # thread and from a fit at the same time abort the whole process, so
+    # this runs in a subprocess
+    script = (
+        "import numpy as np\n"
+        "import densmap\n"
+        "X = np.random.RandomState(0).normal(size=(5000, 5)).astype(np.float32)\n"
+        "thread = densmap.warmup()\n"
+        "emb = densmap.densMAP(n_epochs=50, final_dens=False, random_state=0).fit_transform(X)\n"
+        "assert not thread.is_alive()\n"
+        "assert emb.shape == (5000, 2)\n"
+    )
+    env = dict(os.environ, NUMBA_NUM_THREADS="2")
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    assert result.returncode == 0, result.stdout.decode(errors="replace")
+
+
+def test_exact_nearest_neighbors():
+    data = nn_data[:500].astype(np.float32)
+    query = nn_data[500:600].astype(np.float32)
+    for metric in ["euclidean", "cosine", "correlation", "manhattan", "chebyshev"]:
+        dmat = pairwise_distances(query, data, metric=metric)
+        true_indices = np.argsort(dmat, axis=1, kind="stable")[:, :10]
+        true_dists = np.sort(dmat, axis=1)[:, :10]
+
+        indices, dists = exact_nearest_neighbors(data, 10, metric, query=query)
+        assert_array_almost_equal(dists, true_dists, decimal=5)
+        assert_array_equal(indices, true_indices)
+
+    # Each point is its own nearest neighbor
+    indices, dists = exact_nearest_neighbors(data, 10)
+    assert_array_equal(indices[:, 0], np.arange(data.shape[0]))
+    assert_array_equal(dists[:, 0], 0.0)
+
+    indices, dists = exact_nearest_neighbors(sparse.csr_matrix(data), 10)
+    assert_array_equal(indices[:, 0], np.arange(data.shape[0]))
+    dmat = pairwise_distances(data)
+    precomputed_indices, precomputed_dists = exact_nearest_neighbors(
+        dmat, 10, "precomputed"
+    )
+    assert_array_equal(indices, precomputed_indices)
+    assert_array_almost_equal(dists, precomputed_dists, decimal=5)
+
+    # Data far from the origin, against a float64 k-d tree
+    data = np.random.RandomState(42).normal(size=(1000, 20)) + 1000.0
+    data = data.astype(np.float32)
+    true_dists, true_indices = KDTree(data.astype(np.float64)).query(data, 15)
+    indices, dists = exact_nearest_neighbors(data, 15)
+    assert_array_equal(np.sort(indices, axis=1), np.sort(true_indices, axis=1))
+    assert_array_almost_equal(dists, true_dists, decimal=4)
+
+
+def test_grid_nearest_neighbors():
+    rng = np.random.RandomState(42)
+    for n_components in [1, 2, 3]:
+        data = rng.normal(size=(1000, n_components)).astype(np.float32)
+        # Spread the queries beyond the grid as well
+        query = 3 * rng.normal(size=(100, n_components)).astype(np.float32)
+        dmat = pairwise_distances(query, data)
+        true_indices = np.argsort(dmat, axis=1, kind="stable")[:, :15]
+        true_dists = np.sort(dmat, axis=1)[:, :15]
+
+        indices, dists = exact_nearest_neighbors(data, 15, query=query)
+        assert_array_almost_equal(dists, true_dists, decimal=5)
+        assert_array_equal(indices, true_indices)
+
+    # Nearly flat data
+    data[:, 2] *= 1e-8
+    indices, dists = exact_nearest_neighbors(data, 15)
+    assert_array_almost_equal(dists, np.sort(pairwise_distances(data), axis=1)[:, :15])
+
+    # A distant point does not stretch the grid, and clustered or heavy
+    # tailed data, which do not fit a uniform grid, are still searched exactly
+    outlier = rng.normal(size=(2000, 2)).astype(np.float32)
+    outlier[0] = 1e4
+    clustered = np.vstack(
+        [rng.normal(scale=1e-3, size=(1000, 3)), rng.uniform(-100, 100, size=(1000, 3))]
+    ).astype(np.float32)
+    heavy_tailed = rng.standard_cauchy(size=(2000, 2)).astype(np.float32)
+    for data in [outlier, clustered, heavy_tailed]:
+        dmat = pairwise_distances(data)
+        indices, dists = exact_nearest_neighbors(data, 15)
+        true_indices = np.argsort(dmat, axis=1, kind="stable")[:, :15]
+        assert_array_equal(np.sort(indices, axis=1), np.sort(true_indices, axis=1))
+        assert_array_almost_equal(
+            dists / dmat.max(), np.sort(dmat, axis=1)[:, :15] / dmat.max()
+        )
+
+
+def test_densmap_epoch_callback():
+    calls = []
+
+    def callback(epoch, elapsed, embedding, density_corr):
+        calls.append((epoch, elapsed, embedding.copy(), density_corr))
+        return epoch >= 30
+
+    path = os.path.join(mkdtemp(), "snapshots.npy")
+    fitter = DENSMAP(
+        n_neighbors=10,
+        n_epochs=100,
+        random_state=42,
+        deterministic=True,
+        epoch_callback=callback,
+        snapshot_path=path,
+        snapshot_every=15,
+    ).fit(nn_data)
+
+    assert_equal([call[0] for call in calls], [10, 20, 30])
+    assert np.all(np.diff([call[1] for call in calls]) >= 0)
+    assert all(-1.0 <= call[3] <= 1.0 for call in calls)
+    # The embedding is given in the order of the data
+    assert_array_equal(calls[-1][2], fitter.embedding_)
+    assert not np.array_equal(calls[0][2], fitter.embedding_)
+    assert any(stage.get("stopped", False) for stage in fitter.profile_.stages)
+
+    snapshots = np.load(path, mmap_mode="r")
+    assert_equal(snapshots.shape, (100 // 15, nn_data.shape[0], 2))
+    assert_array_equal(snapshots[1], fitter.embedding_)
+    assert_array_equal(snapshots[2], 0.0)
+
+    # The callback does not change the embedding
+    params = dict(n_neighbors=10, n_epochs=20, random_state=42, deterministic=True)
+    plain = DENSMAP(**params).fit(nn_data)
+    monitored = DENSMAP(epoch_callback=lambda *args: None, **params).fit(nn_data)
+    assert_array_equal(plain.embedding_, monitored.embedding_)
+
+
+def test_bad_epoch_callback():
+    assert_raises(ValueError, DENSMAP(epoch_callback=1).fit, nn_data)
+    assert_raises(ValueError, DENSMAP(callback_every=0).fit, nn_data)
+    assert_raises(ValueError, DENSMAP(snapshot_every=-1).fit, nn_data)
+    path = os.path.join(mkdtemp(), "snapshots.npy")
+    assert_raises(
+        ValueError,
+        DENSMAP(n_epochs=20, snapshot_path=path, snapshot_every=30).fit,
+        nn_data,
+    )
+    assert not os.path.exists(path)
@@ -8,7 +8,7 @@ import numpy as np
 import numba
 
 
-@numba.njit(parallel=True)
+@numba.njit(parallel=True, cache=True)
 def fast_knn_indices(X, n_neighbors):
     """A fast computation of knn indices.
 
@@ -35,7 +35,58 @@ def fast_knn_indices(X, n_neighbors):
     return knn_indices
 
 
-@numba.njit("i4(i8[:])")
+@numba.njit(parallel=True, cache=True)
+def fast_sparse_knn(indptr, indices, data, n_neighbors):
+    """The k-nearest neighbors of each row of a sparse (CSR) distance matrix,
+    among the entries stored in that row. Each point is its own first
+    neighbor, whether or not the diagonal is stored; rows with fewer than
+    ``n_neighbors - 1`` stored off-diagonal entries are padded with index -1
+    and infinite distance.
+
+    Parameters
+    ----------
+    indptr: array
+        CSR format index pointer array of the distance matrix
+
+    indices: array
+        CSR format index array of the distance matrix
+
+    data: array
+        CSR format data array of the distance matrix
+
+    n_neighbors: int
+        The number of nearest neighbors to compute for each row.
+
+    Returns
+    -------
+    knn_indices: array of shape (n_samples, n_neighbors)
+        The indices on the ``n_neighbors`` closest points in each row.
+
+    knn_dists: array of shape (n_samples, n_neighbors)
+        The distances to the ``n_neighbors`` closest points in each row.
+    """
+    n_samples = indptr.shape[0] - 1
+    knn_indices = np.full((n_samples, n_neighbors), -1, dtype=np.int32)
+    knn_dists = np.full((n_samples, n_neighbors), np.inf, dtype=np.float32)
+    for row in numba.prange(n_samples):
+        knn_indices[row, 0] = row
+        knn_dists[row, 0] = 0.0
+        row_indices = indices[indptr[row] : indptr[row + 1]]
+        row_data = data[indptr[row] : indptr[row + 1]]
+        order = np.argsort(row_data)
+        n_found = 1
+        for i in range(order.shape[0]):
+            if n_found >= n_neighbors:
+                break
+            if row_indices[order[i]] == row:
+                continue
+            knn_indices[row, n_found] = row_indices[order[i]]
+            knn_dists[row, n_found] = row_data[order[i]]
+            n_found += 1
+    return knn_indices, knn_dists
+
+
+@numba.njit(cache=True)
 def tau_rand_int(state):
     """A fast (pseudo)-random number generator.
 
@@ -58,10 +109,10 @@ def tau_rand_int(state):
         ((state[2] & 4294967280) << 17) & 0xFFFFFFFF
     ) ^ ((((state[2] << 3) & 0xFFFFFFFF) ^ state[2]) >> 11)
 
-    return state[0] ^ state[1] ^ state[2]
+    return np.int32(state[0] ^ state[1] ^ state[2])
 
 
-@numba.njit("f4(i8[:])")
+@numba.njit(cache=True)
 def tau_rand(state):
     """A fast (pseudo)-random number generator for floats in the range [0,1]
 
@@ -75,10 +126,10 @@ def tau_rand(state):
     A (pseudo)-random float32 in the interval [0, 1]
     """
     integer = tau_rand_int(state)
-    return abs(float(integer) / 0x7FFFFFFF)
+    return np.float32(abs(float(integer) / 0x7FFFFFFF))
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def norm(vec):
     """Compute the (standard l2) norm of a vector.
 
@@ -96,7 +147,7 @@ def norm(vec):
     return np.sqrt(result)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def rejection_sample(n_samples, pool_size, rng_state):
     """Generate n_samples many integers from 0 to pool_size such that no
     integer is selected twice. The duplication constraint is achieved via
@@ -132,16 +183,15 @@ def rejection_sample(n_samples, pool_size, rng_state):
     return result
 
 
-@numba.njit("f8[:, :, :](i8,i8)")
+@numba.njit(cache=True)
 def make_heap(n_points, size):
     """Constructor for the numba enabled heap objects. The heaps are used
     for approximate nearest neighbor search, maintaining a list of potential
     neighbors sorted by their distance. We also flag if potential neighbors
-    are newly added to the list or not. Internally this is stored as
-    a single ndarray; the first axis determines whether we are looking at the
-    array of candidate indices, the array of distances, or the flag array for
-    whether elements are new or not. Each of these arrays are of shape
-    (``n_points``, ``size``)
+    are newly added to the list or not. Internally this is stored as a tuple
+    of three arrays: the int32 candidate indices, their float32 distances
+    and the uint8 flags of whether elements are new or not. Each of these
+    arrays are of shape (``n_points``, ``size``)
 
     Parameters
     ----------
@@ -153,19 +203,17 @@ def make_heap(n_points, size):
 
     Returns
     -------
-    heap: An ndarray suitable for passing to other numba enabled heap functions.
+    heap: A tuple of arrays suitable for passing to other numba enabled heap
+    functions.
     """
-    result = np.zeros(
-        (3, int(n_points), int(size)), dtype=np.float64
-    )
-    result[0] = -1
-    result[1] = np.infty
-    result[2] = 0
+    indices = np.full((int(n_points), int(size)), -1, dtype=np.int32)
+    distances = np.full((int(n_points), int(size)), np.inf, dtype=np.float32)
+    flags = np.zeros((int(n_points), int(size)), dtype=np.uint8)
 
-    return result
+    return indices, distances, flags
 
 
-@numba.njit("i8(f8[:,:,:],i8,f8,i8,i8)")
+@numba.njit(cache=True)
 def heap_push(heap, row, weight, index, flag):
     """Push a new element onto the heap. The heap stores potential neighbors
     for each data point. The ``row`` parameter determines which data point we
@@ -175,7 +223,7 @@ def heap_push(heap, row, weight, index, flag):
 
     Parameters
     ----------
-    heap: ndarray generated by ``make_heap``
+    heap: tuple of arrays generated by ``make_heap``
         The heap object to push into
 
     row: int
@@ -195,9 +243,9 @@ def heap_push(heap, row, weight, index, flag):
     success: The number of new elements successfully pushed into the heap.
     """
     row = int(row)
-    indices = heap[0, row]
-    weights = heap[1, row]
-    is_new = heap[2, row]
+    indices = heap[0][row]
+    weights = heap[1][row]
+    is_new = heap[2][row]
 
     if weight >= weights[0]:
         return 0
@@ -207,49 +255,10 @@ def heap_push(heap, row, weight, index, flag):
         if index == indices[i]:
             return 0
 
-    # insert val at position zero
-    weights[0] = weight
-    indices[0] = index
-    is_new[0] = flag
-
-    # descend the heap, swapping values until the max heap criterion is met
-    i = 0
-    while True:
-        ic1 = 2 * i + 1
-        ic2 = ic1 + 1
-
-        if ic1 >= heap.shape[2]:
-            break
-        elif ic2 >= heap.shape[2]:
-            if weights[ic1] > weight:
-                i_swap = ic1
-            else:
-                break
-        elif weights[ic1] >= weights[ic2]:
-            if weight < weights[ic1]:
-                i_swap = ic1
-            else:
-                break
-        else:
-            if weight < weights[ic2]:
-                i_swap = ic2
-            else:
-                break
-
-        weights[i] = weights[i_swap]
-        indices[i] = indices[i_swap]
-        is_new[i] = is_new[i_swap]
+    return _sift_into_heap(indices, weights, is_new, weight, index, flag)
 
-        i = i_swap
 
-    weights[i] = weight
-    indices[i] = index
-    is_new[i] = flag
-
-    return 1
-
-
-@numba.njit("i8(f8[:,:,:],i8,f8,i8,i8)")
+@numba.njit(cache=True)
 def unchecked_heap_push(heap, row, weight, index, flag):
     """Push a new element onto the heap. The heap stores potential neighbors
     for each data point. The ``row`` parameter determines which data point we
@@ -259,7 +268,7 @@ def unchecked_heap_push(heap, row, weight, index, flag):
 
     Parameters
     ----------
-    heap: ndarray generated by ``make_heap``
+    heap: tuple of arrays generated by ``make_heap``
         The heap object to push into
 
     row: int
@@ -278,17 +287,22 @@ def unchecked_heap_push(heap, row, weight, index, flag):
     -------
     success: The number of new elements successfully pushed into the heap.
     """
-    indices = heap[0, row]
-    weights = heap[1, row]
-    is_new = heap[2, row]
+    indices = heap[0][row]
+    weights = heap[1][row]
+    is_new = heap[2][row]
 
     if weight >= weights[0]:
         return 0
 
-    # insert val at position zero
-    weights[0] = weight
-    indices[0] = index
-    is_new[0] = flag
+    return _sift_into_heap(indices, weights, is_new, weight, index, flag)
+
+
+@numba.njit(cache=True)
+def _sift_into_heap(indices, weights, is_new, weight, index, flag):
+    """Replace the root of a single max heap, given by its ``indices``,
+    ``weights`` and ``is_new`` rows, and descend the new element until the
+    max heap criterion is met."""
+    size = indices.shape[0]
 
     # descend the heap, swapping values until the max heap criterion is met
     i = 0
@@ -296,9 +310,9 @@ def unchecked_heap_push(heap, row, weight, index, flag):
         ic1 = 2 * i + 1
         ic2 = ic1 + 1
 
-        if ic1 >= heap.shape[2]:
+        if ic1 >= size:
             break
-        elif ic2 >= heap.shape[2]:
+        elif ic2 >= size:
             if weights[ic1] > weight:
                 i_swap = ic1
             else:
@@ -327,7 +341,7 @@ def unchecked_heap_push(heap, row, weight, index, flag):
     return 1
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def siftdown(heap1, heap2, elt):
     """Restore the heap property for a heap with an out of place element
     at position ``elt``. This works with a heap pair where heap1 carries
@@ -360,7 +374,7 @@ def siftdown(heap1, heap2, elt):
             elt = swap
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def deheap_sort(heap):
     """Given an array of heaps (of indices and weights), unpack the heap
     out to give and array of sorted lists of indices and weights by increasing
@@ -369,13 +383,14 @@ def deheap_sort(heap):
 
     Parameters
     ----------
-    heap : array of shape (3, n_samples, n_neighbors)
+    heap : tuple of arrays of shape (n_samples, n_neighbors)
         The heap to turn into sorted lists.
 
     Returns
     -------
     indices, weights: arrays of shape (n_samples, n_neighbors)
-        The indices and weights sorted by increasing weight.
+        The indices and weights sorted by increasing weight. These are the
+        arrays of the heap, sorted in place.
     """
     indices = heap[0]
     weights = heap[1]
@@ -405,17 +420,17 @@ def deheap_sort(heap):
                 0,
             )
 
-    return indices.astype(np.int64), weights
+    return indices, weights
 
 
-@numba.njit("i8(f8[:, :, :],i8)")
+@numba.njit(cache=True)
 def smallest_flagged(heap, row):
     """Search the heap for the smallest element that is
     still flagged.
 
     Parameters
     ----------
-    heap: array of shape (3, n_samples, n_neighbors)
+    heap: tuple of arrays of shape (n_samples, n_neighbors)
         The heaps to search
 
     row: int
@@ -428,9 +443,9 @@ def smallest_flagged(heap, row):
         of the ``row``th heap, or -1 if no flagged
         elements remain in the heap.
     """
-    ind = heap[0, row]
-    dist = heap[1, row]
-    flag = heap[2, row]
+    ind = heap[0][row]
+    dist = heap[1][row]
+    flag = heap[2][row]
 
     min_dist = np.inf
     result_index = -1
@@ -441,13 +456,13 @@ def smallest_flagged(heap, row):
             result_index = i
 
     if result_index >= 0:
-        flag[result_index] = 0.0
+        flag[result_index] = 0
         return int(ind[result_index])
     else:
         return -1
 
 
-@numba.njit(parallel=True)
+@numba.njit(parallel=True, cache=True)
 def build_candidates(
     current_graph,
     n_vertices,
@@ -486,19 +501,19 @@ def build_candidates(
     )
     for i in range(n_vertices):
         for j in range(n_neighbors):
-            if current_graph[0, i, j] < 0:
+            if current_graph[0][i, j] < 0:
                 continue
-            idx = current_graph[0, i, j]
-            isn = current_graph[2, i, j]
+            idx = current_graph[0][i, j]
+            isn = current_graph[2][i, j]
             d = tau_rand(rng_state)
             heap_push(candidate_neighbors, i, d, idx, isn)
             heap_push(candidate_neighbors, idx, d, i, isn)
-            current_graph[2, i, j] = 0
+            current_graph[2][i, j] = 0
 
     return candidate_neighbors
 
 
-@numba.njit(parallel=True)
+@numba.njit(parallel=True, cache=True)
 def new_build_candidates(
     current_graph,
     n_vertices,
@@ -542,10 +557,10 @@ def new_build_candidates(
 
     for i in numba.prange(n_vertices):
         for j in range(n_neighbors):
-            if current_graph[0, i, j] < 0:
+            if current_graph[0][i, j] < 0:
                 continue
-            idx = current_graph[0, i, j]
-            isn = current_graph[2, i, j]
+            idx = current_graph[0][i, j]
+            isn = current_graph[2][i, j]
             d = tau_rand(rng_state)
             if tau_rand(rng_state) < rho:
                 c = 0
@@ -581,12 +596,12 @@ def new_build_candidates(
                     )
 
                 if c > 0:
-                    current_graph[2, i, j] = 0
+                    current_graph[2][i, j] = 0
 
     return new_candidate_neighbors, old_candidate_neighbors
 
 
-@numba.njit(parallel=True)
+@numba.njit(parallel=True, cache=True)
 def submatrix(dmat, indices_col, n_neighbors):
     """Return a submatrix given an orginal matrix and the indices to keep.
 
@@ -616,6 +631,67 @@ def submatrix(dmat, indices_col, n_neighbors):
     return submat
 
 
+@numba.njit(parallel=True, cache=True)
+def morton_codes(points, n_bits):
+    """Position of each point along a Z-order (Morton) space-filling curve
+    over the bounding box of the points.
+
+    Parameters
+    ----------
+    points: array of shape (n_samples, n_dims)
+        The points to encode; ``n_dims * n_bits`` must be less than 64.
+
+    n_bits: int
+        The number of bits each coordinate is quantized to.
+
+    Returns
+    -------
+    codes: array of shape (n_samples,)
+        The interleaved bits of the quantized coordinates of each point.
+    """
+    n_samples, n_dims = points.shape
+    lower = np.empty(n_dims, dtype=np.float64)
+    scale = np.empty(n_dims, dtype=np.float64)
+    n_cells = (1 << n_bits) - 1
+    for d in range(n_dims):
+        lower[d] = points[:, d].min()
+        extent = points[:, d].max() - lower[d]
+        if extent > 0:
+            scale[d] = n_cells / extent
+        else:
+            scale[d] = 0.0
+
+    codes = np.zeros(n_samples, dtype=np.int64)
+    for i in numba.prange(n_samples):
+        code = 0
+        for bit in range(n_bits - 1, -1, -1):
+            for d in range(n_dims):
+                cell = np.int64((points[i, d] - lower[d]) * scale[d])
+                code = (code << 1) | ((cell >> bit) & 1)
+        codes[i] = code
+    return codes
+
+
+def space_filling_curve_order(points):
+    """An ordering of the points along a Z-order curve, so that points that
+    are close to each other tend to be close in the ordering. Only the first
+    three coordinates are used.
+
+    Parameters
+    ----------
+    points: array of shape (n_samples, n_dims)
+        The points to order.
+
+    Returns
+    -------
+    order: array of shape (n_samples,)
+        The indices of the points in curve order.
+    """
+    points = points[:, :3]
+    n_bits = min(21, 63 // points.shape[1])
+    return np.argsort(morton_codes(points, n_bits), kind="mergesort")
+
+
 # Generates a timestamp for use in logging messages when verbose=True
 def ts():
     return time.ctime(time.time())
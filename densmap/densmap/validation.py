@@ -3,9 +3,10 @@ import numba
 
 from sklearn.neighbors import KDTree
 from densmap.distances import named_distances
+from densmap.specializations import memoize_specialization
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def trustworthiness_vector_bulk(
     indices_source, indices_embedded, max_k
 ):  # pragma: no cover
@@ -32,6 +33,7 @@ def trustworthiness_vector_bulk(
     return trustworthiness
 
 
+@memoize_specialization
 def make_trustworthiness_calculator(metric):  # pragma: no cover
     @numba.njit(parallel=True)
     def trustworthiness_vector_lowmem(source, indices_embedded, max_k):